@@ -0,0 +1,168 @@
+import importlib
+import math
+import time
+
+import numpy as np
+import pytest
+
+from conftest import best_of
+import fake_bpy
+
+PROPERTIES = {
+    'normal_map': True,
+    'depth_map': True,
+    'albedo_map': True,
+    'shading_map': True,
+    'size': 512,
+    'tiled': False,
+    'tile_overlap': 128,
+    'tile_batch_size': 2,
+    'normal_space': 'TANGENT',
+    'multi_view': False,
+    'view_count': 4,
+    'view_elevation': 0.35,
+    'frame_range': False,
+    'all_selected': False,
+    'batch_size': 4,
+    'progressive': False,
+    'preview_size': 256,
+    'save_to_disk': False,
+}
+
+@pytest.fixture(scope="module")
+def generate_texture(tiny_model, input_images):
+    preferences = {
+        'model': tiny_model,
+        'config': "",
+        'idle_timeout': 0,
+        'min_free_memory': 0,
+        'precision': 'fp32',
+        'channels_last': False,
+        'compile_unet': False,
+        'fuse_lora': False,
+        'tiny_vae': "",
+        'fast_vae': 'off',
+        'memory_budget': 0,
+        'use_result_cache': False,
+        'use_worker': False,
+        'torch_profile': False,
+        'profile_dir': "",
+    }
+    render = np.concatenate([input_images[0], np.ones((512, 512, 1), dtype=np.float32)], axis=2)
+    bpy = fake_bpy.create(render, preferences, PROPERTIES)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        fake_bpy.install(monkeypatch, bpy)
+        module = importlib.import_module("intrinsic_lora_addon.generate_texture")
+        yield module
+        module.release(include_worker=False)
+
+def test_generate_end_to_end(generate_texture, metrics):
+    """Render, all four tasks and the bake, through generate_texture with bpy stubbed out."""
+    run = lambda: generate_texture.execute()
+    assert run() is None
+    metrics.record("generate_texture", best_of(run, repeats=3), "s")
+
+def test_all_selected(generate_texture, metrics):
+    """Eight selected objects rendered, generated as one batch and baked each into its own material."""
+    import bpy
+    props = bpy.context.scene.intrinsic_lora_properties
+    selected = bpy.context.selected_objects
+    bpy.context.selected_objects = [fake_bpy.mesh_object(f"Prop{index}") for index in range(8)]
+    props.all_selected = True
+    try:
+        run = lambda: generate_texture.execute()
+        assert run() is None
+        metrics.record("all_selected_objects", 8 / best_of(run, repeats=2), "objects/s", higher_is_better=True)
+    finally:
+        props.all_selected = False
+        bpy.context.selected_objects = selected
+
+def test_frame_range(generate_texture, tmp_path, metrics, monkeypatch):
+    """Eight frames through the overlapped render, inference and merge pipeline."""
+    import bpy
+    scene = bpy.context.scene
+    scene.frame_start, scene.frame_end, scene.frame_current = 1, 8, 1
+    scene.render.filepath = str(tmp_path)
+    monkeypatch.setattr(bpy.path, "abspath", lambda path: path)
+    monkeypatch.setattr(bpy.path, "clean_name", lambda name: name)
+    target = bpy.context.selected_objects[0]
+
+    def run():
+        render = generate_texture.FrameRangeRender(target)
+        while render.poll() == 'running':
+            time.sleep(0.005)
+        assert render.status == 'done', render.message
+    run()
+    metrics.record("frame_range_fps", 8 / best_of(run, repeats=2), "frames/s", higher_is_better=True)
+
+def uv_sphere(segments: int = 64, rings: int = 32):
+    """World space triangles, UV triangles and face normals of a unit sphere."""
+    u, v = np.meshgrid(np.linspace(0., 1., segments + 1), np.linspace(0., 1., rings + 1))
+    theta = u * 2 * math.pi
+    phi = v * math.pi
+    points = np.stack([np.sin(phi) * np.cos(theta), np.sin(phi) * np.sin(theta), -np.cos(phi)], axis=-1)
+    uvs = np.stack([u, v], axis=-1)
+    quads = [(r, s) for r in range(rings) for s in range(segments)]
+    corners = []
+    for r, s in quads:
+        corners.append([(r, s), (r, s + 1), (r + 1, s + 1)])
+        corners.append([(r, s), (r + 1, s + 1), (r + 1, s)])
+    index = np.array(corners)
+    triangles = points[index[..., 0], index[..., 1]]
+    uv_triangles = uvs[index[..., 0], index[..., 1]]
+    normals = triangles.mean(axis=1)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    return triangles, uv_triangles, normals
+
+def look_at_view(azimuth: float, distance: float = 3., fov: float = 0.8) -> dict:
+    location = np.array([math.cos(azimuth), math.sin(azimuth), 0.3]) * distance
+    forward = -location / np.linalg.norm(location)
+    right = np.cross(forward, [0., 0., 1.])
+    right /= np.linalg.norm(right)
+    up = np.cross(right, forward)
+    camera = np.eye(4)
+    camera[:3, 0], camera[:3, 1], camera[:3, 2], camera[:3, 3] = right, up, -forward, location
+    near, far, focal = 0.1, 100., 1. / math.tan(fov / 2)
+    projection = np.array([
+        [focal, 0., 0., 0.],
+        [0., focal, 0., 0.],
+        [0., 0., (far + near) / (near - far), 2 * far * near / (near - far)],
+        [0., 0., -1., 0.],
+    ])
+    return {'view_matrix': np.linalg.inv(camera), 'projection_matrix': projection, 'perspective': True, 'camera_location': location}
+
+def test_merge_views(metrics):
+    """The multi view bake: four views of a sphere projected into a 512 UV texture."""
+    from intrinsic_lora_addon.uv_projection import merge_views
+
+    triangles, uv_triangles, normals = uv_sphere()
+    views = [look_at_view(index * math.pi / 2) for index in range(4)]
+    rng = np.random.default_rng(0)
+    view_maps = [{'albedo': rng.random((512, 512, 3), dtype=np.float32), 'depth': rng.random((512, 512), dtype=np.float32)} for _ in views]
+    run = lambda: merge_views(triangles, uv_triangles, normals, views, view_maps, 512)
+    merged = run()
+    assert merged['coverage'].max() > 0
+    metrics.record("merge_views", best_of(run, repeats=3), "s")
+
+def test_convert_normal_map(metrics):
+    """Object to tangent space conversion of a 4K normal map on a sphere."""
+    from intrinsic_lora_addon.uv_projection import convert_normal_map, interpolate, uv_texels
+
+    _, uv_triangles, normals = uv_sphere()
+    normals = np.repeat(normals[:, None], 3, axis=1)
+    # the U direction of the sphere's UVs
+    tangents = np.cross([0., 0., 1.], normals)
+    tangents /= np.maximum(np.linalg.norm(tangents, axis=-1, keepdims=True), 1e-12)
+    signs = np.ones(normals.shape[:2])
+
+    size = 4096
+    # an object space map of the surface normals itself is flat in tangent space
+    tri, texel, barycentric = uv_texels(uv_triangles, size, size)
+    normal_map = np.full((size * size, 3), 0.5, dtype=np.float32)
+    normal_map[texel] = interpolate(normals, tri, barycentric) * 0.5 + 0.5
+    normal_map = normal_map.reshape(size, size, 3)
+
+    run = lambda: convert_normal_map(normal_map, uv_triangles, normals, tangents, signs)
+    converted = run().reshape(-1, 3)[texel]
+    assert np.abs(converted - [0.5, 0.5, 1.]).max() < 1e-3
+    metrics.record("convert_normal_map_4k", best_of(run, repeats=3), "s")
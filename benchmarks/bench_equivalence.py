@@ -0,0 +1,62 @@
+"""
+Checks that the fast paths give the same maps as the plain ones, on small random layers.
+"""
+import copy
+from collections import OrderedDict
+
+import pytest
+
+torch = pytest.importorskip("torch")
+peft = pytest.importorskip("peft")
+pytest.importorskip("diffusers")
+
+def plain_model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(OrderedDict([('to_q', torch.nn.Linear(16, 16)), ('act', torch.nn.GELU()), ('to_k', torch.nn.Linear(16, 16))]))
+
+def lora_model(model, targets: dict):
+    """A copy of model with a random LoRA per task on the layers in targets[task]."""
+    model = copy.deepcopy(model)
+    for task, modules in targets.items():
+        # init_lora_weights=False leaves lora_B random, so every task changes the output
+        peft.inject_adapter_in_model(peft.LoraConfig(r=4, lora_alpha=4, target_modules=modules, init_lora_weights=False), model, adapter_name=task)
+    return model
+
+@torch.no_grad()
+def test_routed_batch_matches_single_tasks():
+    """One routed batch of mixed tasks gives each sample what its task's adapter alone gives."""
+    from intrinsic_lora_addon.lora_registry import LoraRegistry, set_active_adapter
+    model = lora_model(plain_model(), {'normal': ['to_q', 'to_k'], 'depth': ['to_q'], 'albedo': ['to_k']})
+    registry = LoraRegistry(model, None, 'cpu')
+    registry.adapters = ['normal', 'depth', 'albedo']
+    tasks = ['normal', 'depth', 'albedo', 'normal', 'depth']
+    x = torch.randn(len(tasks), 16)
+    with registry.routed(tasks):
+        routed = model(x)
+    for task in dict.fromkeys(tasks):
+        set_active_adapter(model, task)
+        indices = [index for index, t in enumerate(tasks) if t == task]
+        torch.testing.assert_close(routed[indices], model(x[indices]))
+
+@torch.no_grad()
+def test_fused_switch_matches_adapters():
+    """Fused weights give what the adapter gives, also after switching from a task that fused other layers."""
+    from types import SimpleNamespace
+    from intrinsic_lora_addon.fused_lora import FusedLoraRegistry, fuse_lora
+    from intrinsic_lora_addon.lora_registry import set_active_adapter
+    base = plain_model()
+    x = torch.randn(4, 16)
+    base_output = base(x)
+    model = lora_model(base, {'normal': ['to_q', 'to_k'], 'depth': ['to_q']})
+    references = {}
+    fused = {}
+    for task in ('normal', 'depth'):
+        set_active_adapter(model, task)
+        references[task] = model(x)
+        fused[task] = fuse_lora(model, task)
+    registry = FusedLoraRegistry(base, SimpleNamespace(load=fused.__getitem__), 'cpu', torch.float32)
+    for task in ('normal', 'depth', 'normal', 'depth'):
+        registry.activate(task)
+        torch.testing.assert_close(base(x), references[task])
+    registry.unload()
+    torch.testing.assert_close(base(x), base_output)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from conftest import TASKS, PeakRSS, best_of
+
+@pytest.fixture(scope="module")
+def generator(tiny_model):
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+    generator = IntrinsicLoRAImageGenerator(tiny_model, device='cpu')
+    yield generator
+    generator.close()
+
+def test_load_time(tiny_model, metrics):
+    from intrinsic_lora_addon import lora_registry
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+
+    def load():
+        IntrinsicLoRAImageGenerator(tiny_model, device='cpu').close()
+
+    # from scratch, the first load converts the checkpoint into the component store
+    shutil.rmtree(os.path.join(lora_registry.WEIGHTS_DIR, "components"), ignore_errors=True)
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        load()
+    metrics.record("convert", time.perf_counter() - start, "s")
+    metrics.record("convert_peak_rss", rss.peak_mb, "MB")
+    with PeakRSS() as rss:
+        load()
+    metrics.record("load_peak_rss", rss.peak_mb, "MB")
+    metrics.record("load", best_of(load, repeats=3), "s")
+
+@pytest.mark.parametrize("task", TASKS)
+def test_task_latency(generator, input_images, metrics, task):
+    run = lambda: generator.generate_batch(input_images[:1], [task], output_type='np')
+    # the first call switches adapter
+    run()
+    metrics.record(f"latency_{task}", best_of(run), "s")
+
+def test_preview_latency(generator, input_images, metrics):
+    """All tasks at the preview resolution of a progressive render."""
+    run = lambda: generator.generate_batch(input_images[:1], TASKS, output_type='np', resolution=256)
+    run()
+    metrics.record("preview_latency", best_of(run, repeats=3), "s")
+
+def test_adapter_switch(generator, input_images, metrics):
+    """A round of single task calls, switching adapter every time."""
+    def run():
+        for task in TASKS:
+            generator.generate_batch(input_images[:1], [task], output_type='np')
+    run()
+    metrics.record("latency_task_round", best_of(run, repeats=3), "s")
+
+def test_multi_task_throughput(generator, input_images, metrics):
+    run = lambda: generator.generate_batch(input_images, TASKS, output_type='np')
+    run()
+    with PeakRSS() as rss:
+        seconds = best_of(run, repeats=3)
+    metrics.record("multi_task_throughput", len(input_images) * len(TASKS) / seconds, "maps/s", higher_is_better=True)
+    metrics.record("multi_task_peak_rss", rss.peak_mb, "MB")
+
+@pytest.fixture(scope="module")
+def tiny_vae(tmp_path_factory):
+    """A random tiny autoencoder, scaled down like the tiny model's vae."""
+    from diffusers import AutoencoderTiny
+    directory = str(tmp_path_factory.mktemp("tiny_vae"))
+    AutoencoderTiny(encoder_block_out_channels=(8, 8, 8, 8), decoder_block_out_channels=(8, 8, 8, 8), num_encoder_blocks=(1, 1, 1, 1), num_decoder_blocks=(1, 1, 1, 1)).save_pretrained(directory)
+    return directory
+
+@pytest.mark.parametrize("fast_vae", ["decode", "both"])
+def test_tiny_vae_latency(tiny_model, tiny_vae, input_images, metrics, fast_vae):
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+    generator = IntrinsicLoRAImageGenerator(tiny_model, device='cpu', tiny_vae=tiny_vae)
+    try:
+        run = lambda: generator.generate_batch(input_images[:1], ['normal'], output_type='np', fast_vae=fast_vae)
+        run()
+        metrics.record(f"tiny_vae_{fast_vae}_latency_normal", best_of(run), "s")
+    finally:
+        generator.close()
+
+def test_memory_budget(tiny_model, input_images, metrics):
+    """A budget below the tiny model's needs, so every stage runs split, sliced and tiled."""
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+    generator = IntrinsicLoRAImageGenerator(tiny_model, device='cpu', memory_budget_mb=1)
+    try:
+        run = lambda: generator.generate_batch(input_images, TASKS, output_type='np', batch_size=4)
+        run()
+        metrics.record("memory_budget_latency", best_of(run, repeats=3), "s")
+        metrics.record("memory_budget_peak_rss", generator.last_peak_memory['peak_rss_mb'], "MB")
+    finally:
+        generator.close()
+
+def test_fused_latency(tiny_model, input_images, metrics):
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+
+    # the first load fuses and saves the weights, the second memory maps them
+    IntrinsicLoRAImageGenerator(tiny_model, device='cpu', fuse_lora=True).close()
+    start = time.perf_counter()
+    generator = IntrinsicLoRAImageGenerator(tiny_model, device='cpu', fuse_lora=True)
+    metrics.record("fused_load", time.perf_counter() - start, "s")
+    try:
+        run = lambda: generator.generate_batch(input_images[:1], ['normal'], output_type='np')
+        run()
+        metrics.record("fused_latency_normal", best_of(run), "s")
+    finally:
+        generator.close()
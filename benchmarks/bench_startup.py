@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import BENCHMARK_DIR
+
+HEAVY_MODULES = ['torch', 'torchvision', 'diffusers', 'peft', 'PIL']
+
+# runs in a fresh interpreter, nothing imported yet
+STARTUP_SCRIPT = """
+import json, sys, time
+from unittest.mock import MagicMock
+import numpy as np
+import pytest
+import fake_bpy
+from conftest import current_rss
+
+bpy = fake_bpy.create(np.zeros((1, 1, 4), dtype=np.float32), {'preload_libraries': False}, {})
+monkeypatch = pytest.MonkeyPatch()
+fake_bpy.install(monkeypatch, bpy)
+rss = current_rss()
+start = time.perf_counter()
+import intrinsic_lora_addon
+intrinsic_lora_addon.register()
+register_seconds = time.perf_counter() - start
+register_rss = current_rss() - rss
+loaded = [name for name in %r if name in sys.modules]
+
+preload_seconds = None
+if '--preload' in sys.argv:
+    start = time.perf_counter()
+    from intrinsic_lora_addon.generator_manager import preload
+    preload()
+    preload_seconds = time.perf_counter() - start
+print(json.dumps({'register_seconds': register_seconds, 'register_rss': register_rss, 'loaded': loaded, 'preload_seconds': preload_seconds}))
+""" % (HEAVY_MODULES,)
+
+def run_startup(*args) -> dict:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(BENCHMARK_DIR), BENCHMARK_DIR]))
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, *args], cwd=BENCHMARK_DIR, env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def test_register_without_ml_stack(metrics):
+    """Enabling the addon only imports bpy and numpy, the model libraries wait for the first render."""
+    result = run_startup()
+    assert result['loaded'] == []
+    metrics.record("addon_register", result['register_seconds'], "s")
+    metrics.record("addon_register_rss", result['register_rss'] / (1024 * 1024), "MB")
+
+def test_deferred_import(metrics):
+    """What registration used to cost on top: importing torch, diffusers and the generator."""
+    pytest.importorskip("torch")
+    pytest.importorskip("diffusers")
+    result = run_startup("--preload")
+    metrics.record("model_libraries_import", result['preload_seconds'], "s")
@@ -0,0 +1,222 @@
+"""
+Benchmarks for model loading, inference and the bake path, on a tiny random-weight
+Stable Diffusion model.
+
+    python -m pytest benchmarks
+    python -m pytest benchmarks --update-baseline
+
+Nothing is downloaded: the model, the task LoRAs and the prompt embeddings are
+created in a temporary folder, and bpy is replaced by a stub. Every measurement
+is compared against baseline.json and the benchmark fails when it is worse by
+more than the threshold, or is skipped when baseline.json has no value for it
+yet. The measurements of the last run are written to results.json.
+"""
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+import pytest
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "baseline.json")
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, "results.json")
+TASKS = ['normal', 'depth', 'albedo', 'shading']
+
+def pytest_addoption(parser):
+    parser.addoption("--update-baseline", action="store_true", help="Write the measurements to baseline.json instead of comparing")
+    parser.addoption("--threshold", type=float, default=None, help="Allowed regression as a fraction, overrides baseline.json")
+
+class Metrics:
+    """Collects measurements and checks them against the baseline."""
+
+    def __init__(self, baseline: dict, threshold: float, update: bool):
+        self.baseline = baseline
+        self.threshold = threshold
+        self.update = update
+        self.results = {}
+
+    def record(self, name: str, value: float, unit: str, higher_is_better: bool = False):
+        self.results[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+        expected = self.baseline.get('metrics', {}).get(name)
+        print(f"\n{name}: {value:.4g} {unit}" + (f" (baseline {expected['value']:.4g})" if expected else " (no baseline)"))
+        if self.update:
+            return
+        if expected is None:
+            pytest.skip(f"{name} has no baseline, record one with --update-baseline")
+        if higher_is_better:
+            regressed = value < expected['value'] * (1. - self.threshold)
+        else:
+            regressed = value > expected['value'] * (1. + self.threshold)
+        if regressed:
+            pytest.fail(f"{name} regressed: {value:.4g} {unit} against a baseline of {expected['value']:.4g} {unit} (threshold {self.threshold:.0%})")
+
+    def save(self):
+        with open(RESULTS_FILE, 'w') as f:
+            json.dump(self.results, f, indent=2)
+        if self.update:
+            self.baseline.setdefault('metrics', {}).update(self.results)
+            with open(BASELINE_FILE, 'w') as f:
+                json.dump(self.baseline, f, indent=2)
+
+@pytest.fixture(scope="session")
+def metrics(request):
+    baseline = {'threshold': 0.25, 'metrics': {}}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    threshold = request.config.getoption("--threshold")
+    collected = Metrics(baseline, threshold if threshold is not None else baseline.get('threshold', 0.25), request.config.getoption("--update-baseline"))
+    yield collected
+    collected.save()
+
+def best_of(function, repeats: int = 5) -> float:
+    """Shortest wall time of repeats calls, in seconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # no /proc, only the process lifetime peak is available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+class PeakRSS:
+    """Samples the resident set size in the background. peak_mb is the peak above the RSS at the start."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._thread = threading.Thread(target=self.sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    def sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    @property
+    def peak_mb(self) -> float:
+        return (self.peak - self.start) / (1024 * 1024)
+
+def build_tiny_model(directory: str):
+    """Save a tiny random unet, vae and scheduler, a checkpoint file and a random LoRA per task."""
+    import torch
+    from diffusers import AutoencoderKL, DDPMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from diffusers.utils import convert_state_dict_to_diffusers
+    from peft import LoraConfig
+    from peft.utils import get_peft_model_state_dict
+    from safetensors.torch import save_file
+    from intrinsic_lora_addon.lora_registry import LORA_FILES
+
+    torch.manual_seed(0)
+    unet = UNet2DConditionModel(
+        sample_size=64,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+    # four blocks downsample by 8 like the real vae
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        latent_channels=4,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        block_out_channels=(8, 8, 16, 16),
+        layers_per_block=1,
+        norm_num_groups=8,
+        sample_size=512,
+    )
+    unet.save_pretrained(os.path.join(directory, "unet"))
+    vae.save_pretrained(os.path.join(directory, "vae"))
+    DDPMScheduler(num_train_timesteps=1000).save_pretrained(os.path.join(directory, "scheduler"))
+    checkpoint = os.path.join(directory, "tiny-sd.safetensors")
+    save_file({key: value.contiguous() for key, value in unet.state_dict().items()}, checkpoint)
+
+    weights_dir = os.path.join(directory, "pretrained_weights")
+    os.makedirs(weights_dir, exist_ok=True)
+    for task, file_name in LORA_FILES.items():
+        # init_lora_weights=False leaves lora_B random, so every task changes the output
+        unet.add_adapter(LoraConfig(r=4, lora_alpha=4, target_modules=["to_q", "to_k", "to_v", "to_out.0"], init_lora_weights=False), adapter_name=task)
+        state_dict = convert_state_dict_to_diffusers(get_peft_model_state_dict(unet, adapter_name=task))
+        StableDiffusionPipeline.save_lora_weights(weights_dir, unet_lora_layers=state_dict, weight_name=file_name, safe_serialization=True)
+    return checkpoint, weights_dir
+
+def load_tiny_pipeline(pretrained_model_link_or_path, torch_dtype=None, **kwargs):
+    """Replaces StableDiffusionPipeline.from_single_file, loading the tiny model saved next to the checkpoint."""
+    from diffusers import AutoencoderKL, DDPMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    directory = os.path.dirname(pretrained_model_link_or_path)
+    return StableDiffusionPipeline(
+        vae=AutoencoderKL.from_pretrained(os.path.join(directory, "vae"), torch_dtype=torch_dtype),
+        text_encoder=None,
+        tokenizer=None,
+        unet=UNet2DConditionModel.from_pretrained(os.path.join(directory, "unet"), torch_dtype=torch_dtype),
+        scheduler=DDPMScheduler.from_pretrained(os.path.join(directory, "scheduler")),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory):
+    """Path of the tiny checkpoint, with the addon pointed at its LoRAs and caches."""
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("diffusers")
+    pytest.importorskip("peft")
+    from diffusers import StableDiffusionPipeline
+    from intrinsic_lora_addon import intrinsic_lora, lora_registry
+    from intrinsic_lora_addon import prompt_cache as prompt_cache_module
+    from intrinsic_lora_addon.component_store import ComponentStore
+    from intrinsic_lora_addon.fused_lora import FusedLoraStore
+    from intrinsic_lora_addon.prompt_cache import PromptEmbeddingCache
+
+    directory = str(tmp_path_factory.mktemp("tiny_model"))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        checkpoint, weights_dir = build_tiny_model(directory)
+        monkeypatch.setattr(lora_registry, "WEIGHTS_DIR", weights_dir)
+        monkeypatch.setattr(prompt_cache_module, "FINGERPRINTS_FILE", os.path.join(weights_dir, "fingerprints.json"))
+        monkeypatch.setattr(prompt_cache_module, "_fingerprints", None)
+        embeddings_dir = os.path.join(weights_dir, "prompt_embeddings")
+        monkeypatch.setattr(intrinsic_lora, "PromptEmbeddingCache", functools.partial(PromptEmbeddingCache, directory=embeddings_dir))
+        monkeypatch.setattr(intrinsic_lora, "FusedLoraStore", functools.partial(FusedLoraStore, directory=os.path.join(weights_dir, "fused")))
+        monkeypatch.setattr(intrinsic_lora, "ComponentStore", functools.partial(ComponentStore, directory=os.path.join(weights_dir, "components")))
+        monkeypatch.setattr(StableDiffusionPipeline, "from_single_file", staticmethod(load_tiny_pipeline))
+
+        # there is no text encoder, the prompts come from the embedding cache
+        prompt_cache = PromptEmbeddingCache(checkpoint, directory=embeddings_dir)
+        generator = torch.Generator().manual_seed(0)
+        for task in TASKS:
+            prompt_cache.put(task, torch.randn((1, 77, 32), generator=generator))
+        yield checkpoint
+
+@pytest.fixture(scope="session")
+def input_images():
+    rng = np.random.default_rng(0)
+    return [rng.random((512, 512, 3), dtype=np.float32) for _ in range(4)]
@@ -0,0 +1,123 @@
+"""
+A stand-in for bpy and mathutils, enough to run generate_texture outside Blender.
+
+Everything not set up here is a MagicMock, so operators and node trees are
+accepted and do nothing. The render is whatever array is passed in, the target
+is a unit quad facing the scene camera.
+"""
+import sys
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import numpy as np
+
+class Operator:
+    pass
+
+class Panel:
+    pass
+
+class PropertyGroup:
+    pass
+
+class AddonPreferences:
+    pass
+
+class ExportHelper:
+    pass
+
+class Matrix:
+    """The parts of mathutils.Matrix that generate_texture uses."""
+
+    def __init__(self, array):
+        self.array = np.asarray(array, dtype=np.float64)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def inverted(self):
+        return Matrix(np.linalg.inv(self.array))
+
+    @property
+    def translation(self):
+        return self.array[:3, 3]
+
+class Collection:
+    """A bpy_prop_collection with foreach_get over fixed arrays."""
+
+    def __init__(self, length: int, **attributes):
+        self.length = length
+        self.attributes = attributes
+
+    def __len__(self):
+        return self.length
+
+    def foreach_get(self, name, buffer):
+        buffer[:] = np.asarray(self.attributes[name]).ravel()
+
+def quad_mesh():
+    """A 2x2 quad at z=0 facing +Z, as two triangles with UVs covering 0-1."""
+    co = np.array([[-1., -1., 0.], [1., -1., 0.], [1., 1., 0.], [-1., 1., 0.]])
+    uv = co[:, :2] * 0.5 + 0.5
+    triangles = np.array([[0, 1, 2], [0, 2, 3]])
+    return SimpleNamespace(
+        calc_loop_triangles=lambda: None,
+        calc_tangents=lambda uvmap=None: None,
+        loop_triangles=Collection(2, loops=triangles, vertices=triangles, normal=np.tile([0., 0., 1.], (2, 1))),
+        vertices=Collection(4, co=co),
+        loops=Collection(4, normal=np.tile([0., 0., 1.], (4, 1)), tangent=np.tile([1., 0., 0.], (4, 1)), bitangent_sign=np.ones(4)),
+        uv_layers=SimpleNamespace(active=SimpleNamespace(name="UVMap", data=Collection(4, uv=uv))),
+    )
+
+def perspective(fov: float = 0.8, near: float = 0.1, far: float = 100.) -> np.ndarray:
+    focal = 1. / np.tan(fov / 2)
+    return np.array([
+        [focal, 0., 0., 0.],
+        [0., focal, 0., 0.],
+        [0., 0., (far + near) / (near - far), 2 * far * near / (near - far)],
+        [0., 0., -1., 0.],
+    ])
+
+def mesh_object(name: str = 'Target'):
+    """A mesh object with the quad mesh at the origin."""
+    obj = MagicMock()
+    obj.type = 'MESH'
+    obj.name = name
+    obj.matrix_world = Matrix(np.eye(4))
+    obj.data.uv_layers = ["UVMap"]
+    obj.data.materials = [MagicMock()]
+    obj.active_material_index = 0
+    obj.evaluated_get.return_value.to_mesh.return_value = quad_mesh()
+    return obj
+
+def create(render: np.ndarray, preferences: dict, properties: dict):
+    """Build the stub. render is an HxWx4 linear float array, top row first."""
+    bpy = MagicMock()
+    bpy.types = SimpleNamespace(Operator=Operator, Panel=Panel, PropertyGroup=PropertyGroup, AddonPreferences=AddonPreferences, Scene=SimpleNamespace())
+
+    bpy.context.preferences.addons.__getitem__.return_value.preferences = SimpleNamespace(**preferences)
+    bpy.context.scene.intrinsic_lora_properties = SimpleNamespace(**properties)
+    bpy.context.screen.areas = [SimpleNamespace(type='VIEW_3D', regions=[], spaces=[MagicMock()])]
+
+    bpy.context.selected_objects = [mesh_object()]
+
+    # looking down -Z at the quad from 3 units away
+    camera_matrix = np.eye(4)
+    camera_matrix[2, 3] = 3.
+    bpy.context.scene.camera = SimpleNamespace(matrix_world=Matrix(camera_matrix), data=SimpleNamespace(type='PERSP'), calc_matrix_camera=lambda depsgraph, **kwargs: Matrix(perspective()))
+
+    viewer = bpy.data.images.__getitem__.return_value
+    viewer.size = (render.shape[1], render.shape[0])
+    # Blender's pixel buffers start at the bottom row
+    pixels = np.ascontiguousarray(render[::-1], dtype=np.float32).ravel()
+    viewer.pixels.foreach_get.side_effect = lambda buffer: np.copyto(buffer, pixels)
+    return bpy
+
+def install(monkeypatch, bpy):
+    monkeypatch.setitem(sys.modules, 'bpy', bpy)
+    monkeypatch.setitem(sys.modules, 'bpy.props', bpy.props)
+    monkeypatch.setitem(sys.modules, 'bpy.types', bpy.types)
+    monkeypatch.setitem(sys.modules, 'mathutils', MagicMock())
+    io_utils = SimpleNamespace(ExportHelper=ExportHelper)
+    monkeypatch.setitem(sys.modules, 'bpy_extras', SimpleNamespace(io_utils=io_utils))
+    monkeypatch.setitem(sys.modules, 'bpy_extras.io_utils', io_utils)
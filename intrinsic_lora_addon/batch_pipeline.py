@@ -0,0 +1,146 @@
+"""
+Building blocks for the batch runners: a bounded inference queue and a resumable manifest.
+"""
+import json
+import os
+import queue
+import threading
+import time
+
+from intrinsic_lora_addon.inference_worker import InferenceCancelled
+
+class InferenceThread(threading.Thread):
+    """Runs generate_batch in the background over items from a bounded queue.
+
+    Each item is a key and a list of images (e.g. the views of one object). Whatever
+    is queued is batched together, up to batch_size images. Results come out of
+    the outputs queue as (key, results, timings), with results an exception if the
+    batch failed. A None marks the end after close().
+
+    With load, a function returning the generator, generator can be None and is
+    loaded on the thread first, so a cold load doesn't hold up the caller.
+    """
+
+    def __init__(self, generator, tasks: list, batch_size: int = 4, max_queued: int = 8, options: dict = None, load=None):
+        super().__init__(daemon=True)
+        self.generator = generator
+        self.load = load
+        self.load_error = None
+        self.tasks = tasks
+        self.batch_size = max(1, batch_size)
+        self.options = options or {}
+        self.inputs = queue.Queue(maxsize=max(1, max_queued))
+        self.outputs = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def submit(self, key, images: list):
+        """Queue images for inference, blocking while the queue is full."""
+        self.inputs.put((key, images, time.perf_counter()))
+
+    def close(self, block: bool = True) -> bool:
+        """Mark the end of the inputs. Without block, returns False instead of waiting while the queue is full."""
+        try:
+            self.inputs.put(None, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def cancel(self):
+        """Drop whatever is queued and stop the running batch at its next stage."""
+        self.cancelled.set()
+        while True:
+            try:
+                self.inputs.get_nowait()
+            except queue.Empty:
+                break
+        self.inputs.put(None)
+
+    def check_cancelled(self, stage, progress):
+        if self.cancelled.is_set():
+            raise InferenceCancelled()
+
+    def run(self):
+        if self.generator is None:
+            try:
+                self.generator = self.load()
+            except Exception as e:
+                self.load_error = e
+        closed = False
+        while not closed:
+            item = self.inputs.get()
+            if item is None:
+                break
+            items = [item]
+            while sum(len(images) for _, images, _ in items) < self.batch_size:
+                try:
+                    item = self.inputs.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                items.append(item)
+            self.process(items)
+        self.outputs.put(None)
+
+    def process(self, items: list):
+        images = [image for _, item_images, _ in items for image in item_images]
+        start = time.perf_counter()
+        try:
+            if self.load_error is not None:
+                raise self.load_error
+            results = self.generator.generate_batch(images, self.tasks, progress_callback=self.check_cancelled, output_type='np', **self.options)
+        except Exception as e:
+            for key, _, _ in items:
+                self.outputs.put((key, e, {}))
+            return
+        elapsed = time.perf_counter() - start
+        offset = 0
+        for key, item_images, queued in items:
+            count = len(item_images)
+            timings = {
+                'queued_seconds': start - queued,
+                'inference_seconds': elapsed * count / len(images),
+                'batch_images': len(images),
+            }
+            peak_memory = getattr(self.generator, 'last_peak_memory', None)
+            if peak_memory:
+                timings.update(peak_memory)
+            self.outputs.put((key, results[offset:offset + count], timings))
+            offset += count
+
+class Manifest:
+    """JSON record of finished work, rewritten after every entry so an interrupted run can resume."""
+
+    def __init__(self, path: str, settings: dict = None):
+        self.path = path
+        self.data = {'settings': settings or {}, 'entries': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+            self.data.setdefault('entries', {})
+            if settings:
+                self.data['settings'] = settings
+
+    def is_done(self, key: str, tasks: list = None) -> bool:
+        entry = self.data['entries'].get(key)
+        if entry is None or entry.get('error'):
+            return False
+        outputs = entry.get('outputs', {})
+        if tasks and not all(task in outputs for task in tasks):
+            return False
+        return all(os.path.exists(path) for path in outputs.values())
+
+    def add(self, key: str, outputs: dict = None, timings: dict = None, error: str = None):
+        entry = {'outputs': outputs or {}, 'timings': timings or {}}
+        if error:
+            entry['error'] = error
+        self.data['entries'][key] = entry
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.tmp", 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(f"{self.path}.tmp", self.path)
@@ -0,0 +1,214 @@
+"""
+Headless batch runner: render -> infer -> bake for objects in a list of .blend files.
+
+    blender -b --python intrinsic_lora_addon/blender_batch.py -- --model sd15.safetensors --output maps/ a.blend b.blend:Chair,Table
+
+Each entry is a .blend file, optionally followed by :Object,Object. Without object
+names every mesh with a UV map is processed. Entries can also be listed one per
+line in a file given with --jobs. The maps are projected straight into each
+object's UV layout and saved as PNG files, with a manifest.json that lets an
+interrupted run pick up where it stopped.
+
+Rendering and baking run on Blender's main thread while the previous objects
+are in inference on a background thread.
+"""
+import argparse
+import os
+import queue
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import addon_utils
+import bpy
+
+PACKAGE = os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_jobs(entries: list) -> list:
+    jobs = []
+    for entry in entries:
+        entry = entry.strip()
+        if not entry or entry.startswith('#'):
+            continue
+        blend, _, names = entry.partition('.blend:')
+        if names:
+            jobs.append((os.path.abspath(blend + '.blend'), [name for name in names.split(',') if name]))
+        else:
+            jobs.append((os.path.abspath(entry), None))
+    return jobs
+
+def configure(args):
+    prefs = bpy.context.preferences.addons[PACKAGE].preferences
+    prefs.model = args.model
+    prefs.config = args.config or ""
+    prefs.use_worker = False
+    prefs.precision = args.precision
+    prefs.channels_last = args.channels_last
+    prefs.compile_unet = args.compile
+    prefs.fuse_lora = args.fuse_lora
+    prefs.tiny_vae = args.tiny_vae or ""
+    prefs.fast_vae = args.fast_vae if args.tiny_vae else 'off'
+    prefs.memory_budget = args.memory_budget
+    prefs.use_result_cache = not args.no_cache
+    prefs.cache_dir = args.cache_dir or ""
+    prefs.cache_size = args.cache_size
+    props = bpy.context.scene.intrinsic_lora_properties
+    for task in ('normal', 'depth', 'albedo', 'shading'):
+        setattr(props, f"{task}_map", task in args.tasks)
+    props.size = args.size
+    props.tiled = args.tiled
+    props.multi_view = args.views > 1
+    props.view_count = max(args.views, 2)
+    props.save_to_disk = False
+    props.batch_size = args.batch_size
+    return props
+
+def select_only(obj):
+    for other in bpy.context.selected_objects:
+        other.select_set(False)
+    obj.select_set(True)
+    bpy.context.view_layer.objects.active = obj
+
+def process_file(blend: str, object_names, args, manifest, generate_texture, InferenceThread) -> int:
+    from intrinsic_lora_addon.image_utils import has_node_material, save_image
+    bpy.ops.wm.open_mainfile(filepath=blend)
+    props = configure(args)
+    if object_names is None:
+        objects = [obj for obj in bpy.context.scene.objects if obj.type == 'MESH' and obj.data.uv_layers]
+    else:
+        objects = [bpy.data.objects[name] for name in object_names if name in bpy.data.objects]
+        for name in set(object_names) - {obj.name for obj in objects}:
+            manifest.add(f"{blend}:{name}", error="Object not found")
+    pending = [obj for obj in objects if not manifest.is_done(f"{blend}:{obj.name}", args.tasks)]
+    print(f"{blend}: {len(objects)} objects, {len(objects) - len(pending)} already done", flush=True)
+    if not pending:
+        return 0
+
+    generator = generate_texture.get_generator()
+    inference = InferenceThread(generator, generate_texture.get_tasks(props), args.batch_size, args.queue_size, generate_texture.get_inference_options(props))
+    inference.start()
+    started = {}
+    failed = 0
+
+    def bake_finished(block: bool) -> bool:
+        """Bake whatever came out of inference. Returns False once inference has finished."""
+        nonlocal failed
+        while True:
+            try:
+                item = inference.outputs.get(block=block)
+            except queue.Empty:
+                return True
+            if item is None:
+                return False
+            key, results, timings = item
+            obj_name, views, render_seconds = started.pop(key)
+            if isinstance(results, Exception):
+                failed += 1
+                manifest.add(key, error=str(results))
+                continue
+            bake_start = time.perf_counter()
+            try:
+                obj = bpy.data.objects[obj_name]
+                select_only(obj)
+                images = generate_texture.apply_results(obj, results, views)
+                stem = os.path.join(args.output, os.path.splitext(os.path.basename(blend))[0], bpy.path.clean_name(obj_name))
+                outputs = {task: save_image(image, f"{stem}_{task}.png") for task, image in images.items()}
+            except Exception as e:
+                failed += 1
+                manifest.add(key, error=str(e))
+                print(f"Failed {key}: {e}", file=sys.stderr, flush=True)
+                continue
+            timings['render_seconds'] = render_seconds
+            timings['bake_seconds'] = time.perf_counter() - bake_start
+            manifest.add(key, outputs, timings)
+            print(f"{key} {timings['inference_seconds']:.2f}s", flush=True)
+
+    finished = False
+    try:
+        for obj in pending:
+            key = f"{blend}:{obj.name}"
+            render_start = time.perf_counter()
+            try:
+                if not has_node_material(obj):
+                    raise ValueError("Object has no material with nodes to bake into")
+                select_only(obj)
+                renders, views = generate_texture.render_views(obj, props)
+            except Exception as e:
+                failed += 1
+                manifest.add(key, error=str(e))
+                print(f"Failed {key}: {e}", file=sys.stderr, flush=True)
+                continue
+            started[key] = (obj.name, views, time.perf_counter() - render_start)
+            # blocks while the queue is full, bounding how far rendering runs ahead
+            inference.submit(key, renders)
+            bake_finished(block=False)
+        inference.close()
+        while bake_finished(block=True):
+            pass
+        finished = True
+    finally:
+        if not finished:
+            # something outside a single object failed, stop what's still queued
+            inference.cancel()
+        inference.join()
+
+    if args.save_blend:
+        bpy.ops.wm.save_mainfile()
+    return failed
+
+def main():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(prog='blender -b --python blender_batch.py --', description='Intrinsic LoRA batch render and bake')
+    parser.add_argument('blends', nargs='*', help='file.blend or file.blend:Object,Object')
+    parser.add_argument('--jobs', default=None, help='File with one blend entry per line')
+    parser.add_argument('--model', required=True, help='Stable Diffusion 1.5 checkpoint (.safetensors)')
+    parser.add_argument('--config', default=None, help='Original config for the checkpoint, required offline')
+    parser.add_argument('--output', required=True, help='Folder for the baked maps')
+    parser.add_argument('--manifest', default=None, help='Manifest path, defaults to OUTPUT/manifest.json')
+    parser.add_argument('--tasks', nargs='+', default=['normal', 'depth', 'albedo', 'shading'], choices=['normal', 'depth', 'albedo', 'shading'])
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--tiled', action='store_true')
+    parser.add_argument('--views', type=int, default=1, help='Cameras around each object, 1 uses the scene camera')
+    parser.add_argument('--batch-size', type=int, default=4, help='Images per model batch')
+    parser.add_argument('--queue-size', type=int, default=4, help='Objects rendered ahead of the model')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'int8'], help='bf16 autocasts, int8 quantizes the unet linear layers and runs on the CPU')
+    parser.add_argument('--channels-last', action='store_true', help='Channels last memory format for the unet and vae')
+    parser.add_argument('--compile', action='store_true', help='Compile the unet with torch.compile')
+    parser.add_argument('--fuse-lora', action='store_true', help='Merge the LoRAs into the unet weights, cached on disk per task')
+    parser.add_argument('--tiny-vae', default=None, help='Tiny autoencoder (taesd) weights, a .safetensors file or a diffusers folder')
+    parser.add_argument('--fast-vae', default='decode', choices=['decode', 'both'], help='VAE stages run through the tiny autoencoder')
+    parser.add_argument('--memory-budget', type=int, default=0, help='Memory cap in MB for the model, 0 for no cap')
+    parser.add_argument('--cache-dir', default=None, help='Result cache folder, can be shared between machines')
+    parser.add_argument('--cache-size', type=int, default=2048, help='Result cache size in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Always run the model')
+    parser.add_argument('--save-blend', action='store_true', help='Save each .blend with the new texture nodes')
+    args = parser.parse_args(argv)
+
+    entries = list(args.blends)
+    if args.jobs:
+        with open(args.jobs) as f:
+            entries.extend(f.readlines())
+    jobs = parse_jobs(entries)
+
+    addon_utils.enable(PACKAGE, default_set=True, persistent=True)
+    from intrinsic_lora_addon import generate_texture
+    from intrinsic_lora_addon.batch_pipeline import InferenceThread, Manifest
+
+    manifest = Manifest(args.manifest or os.path.join(args.output, 'manifest.json'), {'model': args.model, 'tasks': args.tasks, 'size': args.size, 'views': args.views})
+    failed = 0
+    for blend, object_names in jobs:
+        try:
+            failed += process_file(blend, object_names, args, manifest, generate_texture, InferenceThread)
+        except Exception as e:
+            failed += 1
+            manifest.add(blend, error=str(e))
+            print(f"Failed {blend}: {e}", file=sys.stderr, flush=True)
+    stats = generate_texture.get_cache_stats()
+    if stats:
+        print("Result cache: {hits} hits, {misses} misses, {size_mb:.0f} MB".format(**stats), flush=True)
+    generate_texture.release(include_worker=False)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
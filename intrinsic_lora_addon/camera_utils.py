@@ -1,56 +1,121 @@
 import bpy
+import math
+import numpy as np
+from mathutils import Vector
+from intrinsic_lora_addon.image_utils import linear_to_srgb
+from intrinsic_lora_addon.profiling import profiler
 
+@profiler.timed()
+def render_viewport(width, height, output_folder=None, name="intrinsic_render") -> np.ndarray:
+    """Render the scene and return the result as a float32 HxWx4 array, sRGB, top row first.
 
+    The pixels are read from a temporary compositor Viewer node, as the Render Result
+    itself has no pixel buffer. If the scene had no compositor nodes, the node tree made
+    for the render is emptied again afterwards. The render is only written to disk if
+    output_folder is given.
+    """
+    scene = bpy.context.scene
+    scene.render.resolution_x = width
+    scene.render.resolution_y = height
+    use_nodes = scene.use_nodes
+    use_compositing = scene.render.use_compositing
+    # enabling nodes on a scene without a tree creates one with default nodes
+    created_tree = scene.node_tree is None
+    scene.use_nodes = True
+    scene.render.use_compositing = True
+    tree = scene.node_tree
+    active_node = tree.nodes.active
+    render_layers = tree.nodes.new('CompositorNodeRLayers')
+    viewer = tree.nodes.new('CompositorNodeViewer')
+    tree.links.new(render_layers.outputs['Image'], viewer.inputs['Image'])
+    tree.nodes.active = viewer
+    try:
+        with profiler.stage('render'):
+            bpy.ops.render.render()
+        if output_folder:
+            with profiler.stage('save_png'):
+                scene.render.image_settings.file_format = "PNG"
+                bpy.data.images["Render Result"].save_render(f"{output_folder}/{name}.png")
+        with profiler.stage('read_pixels'):
+            viewer_image = bpy.data.images["Viewer Node"]
+            image_width, image_height = viewer_image.size
+            pixels = np.empty(image_width * image_height * 4, dtype=np.float32)
+            viewer_image.pixels.foreach_get(pixels)
+    finally:
+        if created_tree:
+            tree.nodes.clear()
+        else:
+            tree.nodes.remove(viewer)
+            tree.nodes.remove(render_layers)
+            tree.nodes.active = active_node
+        scene.use_nodes = use_nodes
+        scene.render.use_compositing = use_compositing
 
-def render_viewport(width, height, output_folder):
-    bpy.context.scene.render.resolution_x = width
-    bpy.context.scene.render.resolution_y = height
-    bpy.context.scene.render.image_settings.file_format = "PNG"
-    bpy.ops.render.render(write_still=True)
-    
-    outputPath = f"{output_folder}/intrinsic_render.png"
-    bpy.data.images["Render Result"].save_render(outputPath)
-    return bpy.data.images["Render Result"]
-
-
-def project_uvs(obj):
-    view_params = save_viewport_position()
-    bpy.context.active_object.select_set(False)
-    bpy.context.view_layer.objects.active = obj
-    bpy.ops.object.mode_set(mode = 'EDIT')
-    for area in bpy.context.screen.areas:
-        if area.type == 'VIEW_3D':
-            for region in area.regions:
-                if region.type == 'WINDOW':
-                    with bpy.context.temp_override(area=area, region=region, edit_object=obj):
-                        bpy.ops.view3d.view_camera()
-                        bpy.ops.uv.project_from_view()
-    bpy.ops.object.mode_set(mode = 'OBJECT')
-    apply_viewport_position(view_params)
-
-""" 
-Source:
-https://b3d.interplanety.org/en/saving-and-restoring-the-3d-viewport-position/
-
-"""
-VIEWPORT_ATTRIBUTES = [
-    'view_matrix', 'view_distance', 'view_perspective', 
-    'use_box_clip', 'use_clip_planes', 'is_perspective',
-    'show_sync_view', 'clip_planes'
-]
-
-def save_viewport_position():
-    r3d = get_r3d()
-    copy_if_possible = lambda x: x.copy() if hasattr(x, 'copy') else x
-    data = {attr: copy_if_possible(getattr(r3d, attr)) for attr in VIEWPORT_ATTRIBUTES}
-    return data
-
-def apply_viewport_position(data):
-    r3d = get_r3d()
-    for attr in VIEWPORT_ATTRIBUTES:
-        setattr(r3d, attr, data[attr])
-
-def get_r3d():
-    area = next(area for area in bpy.context.screen.areas if area.type == "VIEW_3D")
-    r3d = area.spaces[0].region_3d
-    return r3d
\ No newline at end of file
+    pixels = pixels.reshape(image_height, image_width, 4)[::-1].copy()
+    pixels[..., :3] = linear_to_srgb(pixels[..., :3])
+    return pixels
+
+
+def create_view_cameras(obj, count, elevation):
+    """Create count cameras orbiting obj at the given elevation (radians), framing its bounds.
+
+    The first camera starts at the scene camera's azimuth and copies its lens.
+    """
+    scene = bpy.context.scene
+    corners = [obj.matrix_world @ Vector(corner) for corner in obj.bound_box]
+    center = sum(corners, Vector()) / len(corners)
+    radius = max((corner - center).length for corner in corners)
+
+    azimuth = 0.0
+    if scene.camera:
+        camera_data = scene.camera.data.copy()
+        offset = scene.camera.matrix_world.translation - center
+        azimuth = math.atan2(offset.y, offset.x)
+    else:
+        camera_data = bpy.data.cameras.new("IntrinsicViewCamera")
+    distance = radius / math.sin(camera_data.angle / 2) * 1.1
+    camera_data.clip_end = max(camera_data.clip_end, distance + radius * 2)
+
+    cameras = []
+    for index in range(count):
+        angle = azimuth + 2 * math.pi * index / count
+        direction = Vector((math.cos(elevation) * math.cos(angle), math.cos(elevation) * math.sin(angle), math.sin(elevation)))
+        camera = bpy.data.objects.new(f"IntrinsicViewCamera.{index}", camera_data)
+        camera.location = center + direction * distance
+        camera.rotation_euler = (-direction).to_track_quat('-Z', 'Y').to_euler()
+        scene.collection.objects.link(camera)
+        cameras.append(camera)
+    bpy.context.view_layer.update()
+    return cameras
+
+def remove_view_cameras(cameras):
+    camera_data = {camera.data for camera in cameras}
+    for camera in cameras:
+        bpy.data.objects.remove(camera)
+    for data in camera_data:
+        if data.users == 0:
+            bpy.data.cameras.remove(data)
+
+def render_camera_views(cameras, width, height, output_folder=None) -> list:
+    """Render the scene from each camera, see render_viewport"""
+    scene = bpy.context.scene
+    scene_camera = scene.camera
+    renders = []
+    try:
+        for index, camera in enumerate(cameras):
+            scene.camera = camera
+            renders.append(render_viewport(width, height, output_folder, f"intrinsic_render_{index}"))
+    finally:
+        scene.camera = scene_camera
+    return renders
+
+def get_view(camera, width, height) -> dict:
+    """View and projection matrices of a camera, as used by uv_projection"""
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    projection = camera.calc_matrix_camera(depsgraph, x=width, y=height, scale_x=bpy.context.scene.render.pixel_aspect_x, scale_y=bpy.context.scene.render.pixel_aspect_y)
+    return {
+        'view_matrix': np.array(camera.matrix_world.inverted(), dtype=np.float64),
+        'projection_matrix': np.array(projection, dtype=np.float64),
+        'perspective': camera.data.type != 'ORTHO',
+        'camera_location': np.array(camera.matrix_world.translation, dtype=np.float64),
+    }
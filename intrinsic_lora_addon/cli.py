@@ -0,0 +1,302 @@
+"""
+Command line runner, no Blender needed.
+
+    python -m intrinsic_lora_addon.cli images --model sd15.safetensors --input renders/ --output maps/
+
+streams every image in a folder through the model in batches and writes one PNG
+per task next to a manifest.json. Rerunning the same command skips the images
+already in the manifest.
+
+    python -m intrinsic_lora_addon.cli report --model sd15.safetensors --input renders/ --output report.json
+
+runs the same images in each precision/backend mode and reports latency and the
+error against fp32 for every task, to pick the fastest mode within tolerance.
+With --tiny-vae, the modes +tiny_decode and +tiny (encode and decode) compare the
+tiny autoencoder against the full vae the same way.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from intrinsic_lora_addon.batch_pipeline import InferenceThread, Manifest
+from intrinsic_lora_addon.intrinsic_lora import PRECISIONS
+from intrinsic_lora_addon.lora_registry import LORA_FILES
+from intrinsic_lora_addon.profiling import max_peak_memory
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.webp')
+
+def find_images(input_dir: str) -> list:
+    paths = []
+    for root, _, files in os.walk(input_dir):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(paths)
+
+def load_image(path: str) -> np.ndarray:
+    with Image.open(path) as image:
+        return np.asarray(image.convert('RGB'), dtype=np.float32) / 255.
+
+def output_path(output_dir: str, relative_path: str, task: str) -> str:
+    stem, _ = os.path.splitext(relative_path)
+    return os.path.join(output_dir, f"{stem}_{task}.png")
+
+def run_images(args) -> int:
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator, to_image
+    from intrinsic_lora_addon.result_cache import get_result_cache
+
+    paths = find_images(args.input)
+    settings = {'model': args.model, 'config': args.config, 'tasks': args.tasks, 'tiled': args.tiled, 'fast_vae': args.fast_vae if args.tiny_vae else None}
+    manifest = Manifest(args.manifest or os.path.join(args.output, 'manifest.json'), settings)
+    pending = [path for path in paths if not manifest.is_done(path, args.tasks)]
+    print(f"{len(paths)} images, {len(paths) - len(pending)} already done", flush=True)
+    if not pending:
+        return 0
+
+    start = time.perf_counter()
+    generator = IntrinsicLoRAImageGenerator(args.model, config=args.config, **get_backend(args))
+    if not args.no_cache:
+        generator.result_cache = get_result_cache(args.cache_dir, args.cache_size)
+    manifest.data['settings']['load_seconds'] = time.perf_counter() - start
+
+    options = {'tiled': args.tiled, 'tile_overlap': args.tile_overlap, 'tile_batch_size': args.tile_batch_size, 'fast_vae': settings['fast_vae']}
+    inference = InferenceThread(generator, args.tasks, args.batch_size, args.queue_size, options)
+    inference.start()
+
+    load_times = {}
+    def load_all():
+        try:
+            for path in pending:
+                load_start = time.perf_counter()
+                try:
+                    image = load_image(os.path.join(args.input, path))
+                except OSError as e:
+                    inference.outputs.put((path, e, {}))
+                    continue
+                load_times[path] = time.perf_counter() - load_start
+                inference.submit(path, [image])
+        finally:
+            inference.close()
+    loader = threading.Thread(target=load_all, daemon=True)
+    loader.start()
+
+    failed = 0
+    finished = 0
+    peak_memory = None
+    while True:
+        item = inference.outputs.get()
+        if item is None:
+            break
+        path, results, timings = item
+        if isinstance(results, Exception):
+            failed += 1
+            manifest.add(path, error=str(results))
+            print(f"Failed {path}: {results}", file=sys.stderr, flush=True)
+            continue
+        write_start = time.perf_counter()
+        outputs = {}
+        for task, image in results[0].items():
+            outputs[task] = output_path(args.output, path, task)
+            os.makedirs(os.path.dirname(outputs[task]), exist_ok=True)
+            to_image(image).save(outputs[task])
+        timings['load_seconds'] = load_times.pop(path, 0.0)
+        timings['write_seconds'] = time.perf_counter() - write_start
+        if 'peak_rss_mb' in timings:
+            peak_memory = max_peak_memory(peak_memory, {'peak_rss_mb': timings['peak_rss_mb'], 'gpu_peak_mb': timings['gpu_peak_mb']})
+        manifest.add(path, outputs, timings)
+        finished += 1
+        print(f"[{finished}/{len(pending)}] {path} {timings['inference_seconds']:.2f}s", flush=True)
+
+    loader.join()
+    inference.join()
+    if peak_memory:
+        manifest.data['settings']['peak_memory'] = peak_memory
+        manifest.save()
+        gpu = f", {peak_memory['gpu_peak_mb']:.0f} MB GPU" if peak_memory['gpu_peak_mb'] is not None else ""
+        print(f"Peak memory: {peak_memory['peak_rss_mb']:.0f} MB{gpu}", flush=True)
+    if generator.result_cache is not None:
+        manifest.data['settings']['cache'] = generator.result_cache.stats()
+        manifest.save()
+        print("Result cache: {hits} hits, {misses} misses, {size_mb:.0f} MB".format(**generator.result_cache.stats()), flush=True)
+    generator.close()
+    return 1 if failed else 0
+
+def parse_mode(mode: str) -> dict:
+    """Backend settings from a mode name such as bf16+channels_last+compile+fused+tiny_decode."""
+    precision, *flags = mode.split('+')
+    if precision not in PRECISIONS or not set(flags) <= {'channels_last', 'compile', 'fused', 'tiny_decode', 'tiny'} or (precision == 'int8' and 'fused' in flags) or {'tiny_decode', 'tiny'} <= set(flags):
+        raise argparse.ArgumentTypeError(f'Invalid mode {mode}')
+    fast_vae = 'both' if 'tiny' in flags else 'decode' if 'tiny_decode' in flags else None
+    return {'precision': precision, 'channels_last': 'channels_last' in flags, 'compile_unet': 'compile' in flags, 'fuse_lora': 'fused' in flags, 'fast_vae': fast_vae}
+
+def check_mode(mode: str) -> str:
+    parse_mode(mode)
+    return mode
+
+def get_backend(args) -> dict:
+    return {'precision': args.precision, 'channels_last': args.channels_last, 'compile_unet': args.compile, 'fuse_lora': args.fuse_lora, 'tiny_vae': args.tiny_vae, 'memory_budget_mb': args.memory_budget}
+
+def map_error(task: str, reference: np.ndarray, result: np.ndarray) -> dict:
+    """Error of a generated map against a reference map of the same task."""
+    if task == 'normal':
+        a = reference * 2. - 1.
+        b = result * 2. - 1.
+        cosine = np.sum(a * b, axis=-1) / np.maximum(np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1), 1e-12)
+        angle = np.degrees(np.arccos(np.clip(cosine, -1., 1.)))
+        return {'mean_angle_deg': float(angle.mean()), 'p95_angle_deg': float(np.percentile(angle, 95))}
+    difference = np.abs(reference.astype(np.float64) - result)
+    mse = float(np.mean(difference ** 2))
+    return {'mean_abs_error': float(difference.mean()), 'max_abs_error': float(difference.max()), 'psnr': float(10 * np.log10(1. / mse)) if mse > 0 else float('inf')}
+
+def within_tolerance(task: str, error: dict, args) -> bool:
+    if task == 'normal':
+        return error['mean_angle_deg'] <= args.normal_tolerance
+    if task == 'depth':
+        return error['mean_abs_error'] <= args.depth_tolerance
+    return error['mean_abs_error'] <= args.color_tolerance
+
+def run_report(args) -> int:
+    from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+
+    paths = find_images(args.input)[:args.limit]
+    if not paths:
+        print(f"No images found in {args.input}", file=sys.stderr)
+        return 1
+    images = [load_image(os.path.join(args.input, path)) for path in paths]
+    options = {'tiled': args.tiled, 'tile_overlap': args.tile_overlap, 'tile_batch_size': args.tile_batch_size}
+    # fp32 is the reference everything else is compared against
+    modes = ['fp32'] + [mode for mode in args.modes if mode != 'fp32']
+    if args.tiny_vae:
+        modes += [mode for mode in ('fp32+tiny_decode', 'fp32+tiny') if mode not in modes]
+
+    report = {'settings': {'model': args.model, 'images': paths, 'tasks': args.tasks, 'repeats': args.repeats, 'options': options}, 'modes': {}}
+    reference = {}
+    for mode in modes:
+        backend = parse_mode(mode)
+        fast_vae = backend.pop('fast_vae')
+        mode_options = dict(options, fast_vae=fast_vae)
+        print(f"{mode}: loading", flush=True)
+        start = time.perf_counter()
+        try:
+            if fast_vae and not args.tiny_vae:
+                raise ValueError('Needs --tiny-vae')
+            generator = IntrinsicLoRAImageGenerator(args.model, config=args.config, tiny_vae=args.tiny_vae if fast_vae else None, **backend)
+        except Exception as e:
+            report['modes'][mode] = {'error': str(e)}
+            print(f"{mode}: {e}", file=sys.stderr, flush=True)
+            continue
+        entry = {'device': generator.device, 'load_seconds': time.perf_counter() - start, 'tasks': {}}
+        try:
+            # the first run pays for lazy initialization and compilation
+            start = time.perf_counter()
+            generator.generate_batch(images[:1], args.tasks, output_type='np', **mode_options)
+            entry['first_run_seconds'] = time.perf_counter() - start
+            for task in args.tasks:
+                times = []
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    results = generator.generate_batch(images, [task], output_type='np', **mode_options)
+                    times.append((time.perf_counter() - start) / len(images))
+                task_entry = {'seconds_per_image': min(times), 'mean_seconds_per_image': sum(times) / len(times)}
+                outputs = [result[task] for result in results]
+                if mode == 'fp32':
+                    reference[task] = outputs
+                else:
+                    errors = [map_error(task, expected, actual) for expected, actual in zip(reference[task], outputs)]
+                    task_entry['error'] = {name: float(np.mean([error[name] for error in errors])) for name in errors[0]}
+                    task_entry['within_tolerance'] = within_tolerance(task, task_entry['error'], args)
+                entry['tasks'][task] = task_entry
+            start = time.perf_counter()
+            generator.generate_batch(images, args.tasks, output_type='np', **mode_options)
+            entry['all_tasks_seconds_per_image'] = (time.perf_counter() - start) / len(images)
+        finally:
+            generator.close()
+        entry['within_tolerance'] = all(task_entry.get('within_tolerance', True) for task_entry in entry['tasks'].values())
+        report['modes'][mode] = entry
+
+    measured = {mode: entry for mode, entry in report['modes'].items() if 'error' not in entry}
+    passing = [mode for mode, entry in measured.items() if entry['within_tolerance']]
+    report['fastest_within_tolerance'] = min(passing, key=lambda mode: measured[mode]['all_tasks_seconds_per_image']) if passing else None
+
+    print(f"{'mode':<28}{'load s':>8}{'s/image':>9}  " + "  ".join(f"{task:>16}" for task in args.tasks))
+    for mode, entry in measured.items():
+        columns = []
+        for task in args.tasks:
+            task_entry = entry['tasks'][task]
+            error = task_entry.get('error')
+            if error is None:
+                columns.append(f"{task_entry['seconds_per_image']:>7.2f}s    ref")
+            else:
+                value = error['mean_angle_deg'] if task == 'normal' else error['mean_abs_error']
+                columns.append(f"{task_entry['seconds_per_image']:>7.2f}s {value:>6.3f}{'' if task_entry['within_tolerance'] else '!'}")
+        print(f"{mode:<28}{entry['load_seconds']:>8.1f}{entry['all_tasks_seconds_per_image']:>9.2f}  " + "  ".join(f"{column:>16}" for column in columns))
+    print(f"Fastest within tolerance: {report['fastest_within_tolerance']}")
+
+    if args.output:
+        directory = os.path.dirname(os.path.abspath(args.output))
+        os.makedirs(directory, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+def add_inference_arguments(parser):
+    parser.add_argument('--model', required=True, help='Stable Diffusion 1.5 checkpoint (.safetensors)')
+    parser.add_argument('--config', default=None, help='Original config for the checkpoint, required offline')
+    parser.add_argument('--tasks', nargs='+', default=list(LORA_FILES), choices=list(LORA_FILES))
+    parser.add_argument('--tiled', action='store_true', help='Run at full resolution in overlapping 512 tiles')
+    parser.add_argument('--tile-overlap', type=int, default=128)
+    parser.add_argument('--tile-batch-size', type=int, default=2)
+
+def add_backend_arguments(parser):
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='bf16 autocasts, int8 quantizes the unet linear layers and runs on the CPU')
+    parser.add_argument('--channels-last', action='store_true', help='Channels last memory format for the unet and vae')
+    parser.add_argument('--compile', action='store_true', help='Compile the unet with torch.compile')
+    parser.add_argument('--fuse-lora', action='store_true', help='Merge the LoRAs into the unet weights, cached on disk per task. Not with int8')
+    parser.add_argument('--tiny-vae', default=None, help='Tiny autoencoder (taesd) weights, a .safetensors file or a diffusers folder')
+    parser.add_argument('--fast-vae', default='decode', choices=['decode', 'both'], help='VAE stages run through the tiny autoencoder when --tiny-vae is given')
+    parser.add_argument('--memory-budget', type=int, default=0, help='Memory cap in MB for the model, split batches, slice attention, tile the vae and offload on CUDA to stay within it. 0 for no cap')
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache-dir', default=None, help='Result cache folder, can be shared between machines. Defaults to ~/.cache/intrinsic_lora/results')
+    parser.add_argument('--cache-size', type=int, default=2048, help='Result cache size in MB')
+    parser.add_argument('--no-cache', action='store_true', help='Always run the model')
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='intrinsic_lora_addon.cli', description='Intrinsic LoRA batch tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    images = commands.add_parser('images', help='Generate maps for every image in a folder')
+    add_inference_arguments(images)
+    add_backend_arguments(images)
+    add_cache_arguments(images)
+    images.add_argument('--input', required=True, help='Folder of input images, searched recursively')
+    images.add_argument('--output', required=True, help='Folder for the generated maps')
+    images.add_argument('--manifest', default=None, help='Manifest path, defaults to OUTPUT/manifest.json')
+    images.add_argument('--batch-size', type=int, default=4, help='Images per model batch')
+    images.add_argument('--queue-size', type=int, default=8, help='Images loaded ahead of the model')
+    images.set_defaults(run=run_images)
+
+    report = commands.add_parser('report', help='Compare latency and accuracy of the precision/backend modes against fp32')
+    add_inference_arguments(report)
+    report.add_argument('--input', required=True, help='Folder of input images, searched recursively')
+    report.add_argument('--limit', type=int, default=4, help='Number of images to measure on')
+    report.add_argument('--modes', nargs='+', type=check_mode, default=['fp32', 'bf16', 'int8', 'fp32+channels_last', 'bf16+channels_last', 'fp32+fused'], help='precision[+channels_last][+compile][+fused][+tiny_decode|+tiny]')
+    report.add_argument('--tiny-vae', default=None, help='Tiny autoencoder (taesd) weights, adds the +tiny_decode and +tiny modes')
+    report.add_argument('--repeats', type=int, default=3)
+    report.add_argument('--normal-tolerance', type=float, default=3.0, help='Mean normal angle error in degrees')
+    report.add_argument('--depth-tolerance', type=float, default=0.02, help='Mean absolute depth error, depth in 0-1')
+    report.add_argument('--color-tolerance', type=float, default=0.02, help='Mean absolute albedo and shading error')
+    report.add_argument('--output', default=None, help='Write the report as JSON')
+    report.set_defaults(run=run_report)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Diffusers format copies of the parts of a single file checkpoint the generator uses.
+
+StableDiffusionPipeline.from_single_file parses the whole checkpoint and converts
+every key from the original layout on each load, and builds a scheduler and a
+pipeline that are never used for sampling. The store runs that conversion once
+per checkpoint and keeps only the unet and the vae, plus the text encoder and
+tokenizer when the prompts still have to be encoded, as diffusers folders. Later
+loads read those safetensors files directly.
+"""
+import json
+import os
+import shutil
+from diffusers import AutoencoderKL, StableDiffusionPipeline, UNet2DConditionModel
+from transformers import CLIPTextModel, CLIPTokenizer
+from intrinsic_lora_addon.lora_registry import WEIGHTS_DIR
+from intrinsic_lora_addon.prompt_cache import file_fingerprint
+
+COMPONENTS_DIR = os.path.join(WEIGHTS_DIR, "components")
+MANIFEST_FILE = "manifest.json"
+
+class ComponentStore:
+    """Converted components of one checkpoint, keyed on (checkpoint hash, config hash, dtype).
+
+    A checkpoint that changed on disk hashes differently and is converted again,
+    and the folders converted from the earlier version of the same file are removed.
+    """
+
+    def __init__(self, checkpoint_path, config=None, dtype=None, directory=COMPONENTS_DIR):
+        self.checkpoint_path = os.path.abspath(checkpoint_path)
+        self.config = config
+        self.dtype = dtype
+        self.directory = directory
+        config_hash = file_fingerprint(config) if config else 'default'
+        self.dtype_name = str(dtype).replace('torch.', '')
+        self.key = f"{file_fingerprint(checkpoint_path)}_{config_hash}_{self.dtype_name}"
+        self.path = os.path.join(directory, self.key)
+
+    def manifest(self, path: str = None) -> dict:
+        try:
+            with open(os.path.join(path or self.path, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def has(self, text_encoder: bool = False) -> bool:
+        components = self.manifest().get('components', [])
+        return 'unet' in components and 'vae' in components and (not text_encoder or 'text_encoder' in components)
+
+    def convert(self, text_encoder: bool = False) -> dict:
+        """Convert the checkpoint and save its components. Returns them like load()."""
+        pipeline = StableDiffusionPipeline.from_single_file(self.checkpoint_path, original_config_file=self.config, local_files_only=True if self.config else False, load_safety_checker=False, torch_dtype=self.dtype)
+        components = {'unet': pipeline.unet, 'vae': pipeline.vae, 'text_encoder': None, 'tokenizer': None}
+        if text_encoder:
+            components['text_encoder'] = pipeline.text_encoder
+            components['tokenizer'] = pipeline.tokenizer
+        components['num_train_timesteps'] = pipeline.scheduler.config.num_train_timesteps
+        self.save(components)
+        return components
+
+    def save(self, components: dict):
+        self.remove_stale()
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        saved = []
+        for name in ('unet', 'vae', 'text_encoder', 'tokenizer'):
+            if components.get(name) is not None:
+                components[name].save_pretrained(os.path.join(temp_path, name))
+                saved.append(name)
+        manifest = {'checkpoint': self.checkpoint_path, 'config': self.config, 'dtype': self.dtype_name, 'components': saved, 'num_train_timesteps': components['num_train_timesteps']}
+        with open(os.path.join(temp_path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        # another process may have converted the same checkpoint meanwhile
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(temp_path, self.path)
+
+    def load(self, text_encoder: bool = False) -> dict:
+        """The unet, vae, text encoder and tokenizer (None unless asked for) and the scheduler's num_train_timesteps."""
+        manifest = self.manifest()
+        components = {
+            'unet': UNet2DConditionModel.from_pretrained(os.path.join(self.path, 'unet'), torch_dtype=self.dtype),
+            'vae': AutoencoderKL.from_pretrained(os.path.join(self.path, 'vae'), torch_dtype=self.dtype),
+            'text_encoder': None,
+            'tokenizer': None,
+            'num_train_timesteps': manifest['num_train_timesteps'],
+        }
+        if text_encoder:
+            components['text_encoder'] = CLIPTextModel.from_pretrained(os.path.join(self.path, 'text_encoder'), torch_dtype=self.dtype)
+            components['tokenizer'] = CLIPTokenizer.from_pretrained(os.path.join(self.path, 'tokenizer'))
+        return components
+
+    def remove_stale(self) -> int:
+        """Remove the folders converted from an earlier version of this checkpoint file. Returns the number removed."""
+        if not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name == self.key or not os.path.isdir(path):
+                continue
+            manifest = self.manifest(path)
+            if (manifest.get('checkpoint'), manifest.get('config'), manifest.get('dtype')) == (self.checkpoint_path, self.config, self.dtype_name):
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
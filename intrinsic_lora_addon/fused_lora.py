@@ -0,0 +1,130 @@
+import json
+import os
+import time
+import numpy as np
+import torch
+from peft.tuners.tuners_utils import BaseTunerLayer
+from safetensors.torch import save_file
+from intrinsic_lora_addon.lora_registry import WEIGHTS_DIR, get_lora_path
+from intrinsic_lora_addon.prompt_cache import file_fingerprint
+
+FUSED_DIR = os.path.join(WEIGHTS_DIR, "fused")
+
+SAFETENSORS_DTYPES = {
+    'F32': (np.float32, torch.float32),
+    'F16': (np.float16, torch.float16),
+    'BF16': (np.int16, torch.bfloat16),
+}
+
+def fuse_lora(unet, task: str) -> dict:
+    """Base weights with task's LoRA merged in, for every unet layer the LoRA touches.
+
+    Keys are the weight names of the plain unet, i.e. once the LoRA layers are removed.
+    """
+    tensors = {}
+    for name, module in unet.named_modules():
+        if isinstance(module, BaseTunerLayer) and task in module.lora_A:
+            weight = module.get_base_layer().weight
+            tensors[f"{name}.weight"] = (weight + module.get_delta_weight(task).to(weight.dtype)).detach().cpu().contiguous()
+    return tensors
+
+def mmap_safetensors(path: str) -> dict:
+    """Tensors of a safetensors file backed by a copy-on-write memory map of it.
+
+    Nothing is read until a tensor is used, and unchanged pages are shared with
+    every other process mapping the same file.
+    """
+    with open(path, 'rb') as f:
+        header_size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_size))
+    header.pop('__metadata__', None)
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size)
+    tensors = {}
+    for name, info in header.items():
+        numpy_dtype, torch_dtype = SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        array = data[start:end].view(numpy_dtype).reshape(info['shape'])
+        tensors[name] = torch.from_numpy(array).view(torch_dtype)
+    return tensors
+
+class FusedLoraStore:
+    """Fused per-task unet weights as safetensors files, keyed on (checkpoint hash, LoRA file hash, task, dtype)."""
+
+    def __init__(self, checkpoint_path, dtype, directory=FUSED_DIR):
+        self.checkpoint_hash = file_fingerprint(checkpoint_path)
+        self.dtype = str(dtype).replace('torch.', '')
+        self.directory = directory
+
+    def path(self, task: str) -> str:
+        return os.path.join(self.directory, f"{self.checkpoint_hash}_{file_fingerprint(get_lora_path(task))}_{task}_{self.dtype}.safetensors")
+
+    def has(self, task: str) -> bool:
+        return os.path.exists(self.path(task))
+
+    def save(self, task: str, tensors: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(task)
+        save_file(tensors, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, task: str) -> dict:
+        return mmap_safetensors(self.path(task))
+
+class FusedLoraRegistry:
+    """Switches tasks by swapping fused weights into the plain unet's layers.
+
+    The unet runs without any LoRA layers, so there is no low-rank matmul per
+    layer. The flip side is that one unet call can only run one task. The base
+    weights of every layer a task replaced are kept, and put back for the layers
+    the next task's LoRA doesn't touch.
+    """
+
+    def __init__(self, unet, store: FusedLoraStore, device, dtype, channels_last: bool = False):
+        self.unet = unet
+        self.store = store
+        self.device = device
+        self.dtype = dtype
+        self.channels_last = channels_last
+        self.tensors = {}
+        # weight name -> the unet's own tensor, for every layer a task replaced
+        self.base = {}
+        self.active = None
+        self.load_times = {}
+        self.last_switch_time = 0.0
+        self.parameters = dict(unet.named_parameters())
+
+    def load(self, task: str):
+        if task in self.tensors:
+            return
+        start = time.perf_counter()
+        self.tensors[task] = self.store.load(task)
+        self.load_times[task] = time.perf_counter() - start
+
+    def activate(self, task: str) -> float:
+        """Make task's fused weights the unet's weights. Returns the switch time in seconds."""
+        self.load(task)
+        if task == self.active:
+            self.last_switch_time = 0.0
+            return self.last_switch_time
+        start = time.perf_counter()
+        fused = self.tensors[task]
+        if self.active is not None:
+            for name in self.tensors[self.active].keys() - fused.keys():
+                self.parameters[name].data = self.base[name]
+        for name, tensor in fused.items():
+            self.base.setdefault(name, self.parameters[name].data)
+            # on the CPU with a matching dtype this keeps the memory map, no copy
+            tensor = tensor.to(self.device, self.dtype)
+            if self.channels_last and tensor.dim() == 4:
+                tensor = tensor.contiguous(memory_format=torch.channels_last)
+            self.parameters[name].data = tensor
+        self.active = task
+        self.last_switch_time = time.perf_counter() - start
+        return self.last_switch_time
+
+    def unload(self):
+        for name, tensor in self.base.items():
+            self.parameters[name].data = tensor
+        self.base = {}
+        self.tensors = {}
+        self.active = None
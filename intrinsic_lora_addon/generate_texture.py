@@ -1,77 +1,520 @@
 import bpy
+import functools
 import logging
-from intrinsic_lora_addon.camera_utils import project_uvs, render_viewport
-from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from intrinsic_lora_addon.batch_pipeline import InferenceThread
+from intrinsic_lora_addon.camera_utils import create_view_cameras, get_view, remove_view_cameras, render_camera_views, render_viewport
+from intrinsic_lora_addon.generator_manager import manager, preload
+from intrinsic_lora_addon.inference_worker import LocalJob, RemoteGenerator, WorkerClient, WorkerJob
+from intrinsic_lora_addon.profiling import PROFILE_DIR, max_peak_memory, profiler
+from intrinsic_lora_addon.result_cache import get_result_cache
+from intrinsic_lora_addon.uv_projection import camera_to_world_normals, convert_normal_map, merge_views
 
-from intrinsic_lora_addon.image_utils import bake_from_active, create_projector_object, set_projector_position_and_orientation, setup_projector_material, assign_material_to_projector, remove_projector, transform_normal_map
+from intrinsic_lora_addon.image_utils import GENERATED_KEY, NODE_PREFIX, add_image_node, get_mesh_arrays, get_tangent_arrays, has_node_material, image_from_array, remove_unused_datablocks, save_image, transform_normal_map
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
-def generate(obj) -> str:
-    props = bpy.context.scene.intrinsic_lora_properties
-    output_folder = bpy.context.scene.render.filepath
+# highest memory use of the model batches of the last render, see PeakMemory.result()
+_peak_memory = None
+
+def get_tasks(props) -> list:
+    return [task for task, enabled in (('depth', props.depth_map), ('normal', props.normal_map), ('albedo', props.albedo_map), ('shading', props.shading_map)) if enabled]
+
+def get_inference_options(props) -> dict:
+    return {'tiled': props.tiled, 'tile_overlap': props.tile_overlap, 'tile_batch_size': props.tile_batch_size, 'batch_size': props.batch_size, 'fast_vae': get_fast_vae()}
+
+def get_preview_options(props) -> dict:
+    """Options of the quick first pass of a progressive render: untiled, at the preview resolution."""
+    return dict(get_inference_options(props), tiled=False, resolution=props.preview_size, fast_vae=get_fast_vae(preview=True))
+
+def get_fast_vae(preview: bool = False):
+    """The vae stages to run through the tiny autoencoder, None for the full vae."""
+    prefs = get_preferences()
+    if not prefs.tiny_vae or prefs.fast_vae == 'off':
+        return None
+    if prefs.fast_vae == 'preview':
+        return 'both' if preview else None
+    return prefs.fast_vae
+
+@profiler.timed()
+def render_views(obj, props, output_folder=None):
+    """Render the images to generate from. Returns the renders and their views."""
     size = props.size
-    rendered_image = render_viewport(size, size, output_folder)
-
-    model = bpy.context.preferences.addons['intrinsic_lora_addon'].preferences.model
-    config = bpy.context.preferences.addons['intrinsic_lora_addon'].preferences.config
-
-    
-    generator = IntrinsicLoRAImageGenerator(pretrained_model_name_or_path=model, config=config)
-
-    depth_map = None
-    normal_map = None
-    albedo_map = None
-    shade_map = None
-    image_path = f"{output_folder}/intrinsic_render.png"
-    if props.depth_map:
-        generator.generate_image(image_path, output_folder, task='depth')
-        depth_map = bpy.data.images.load(f"{output_folder}/intrinsic_render_depth.png")
-    if props.normal_map:
-        generator.generate_image(image_path, output_folder, task='normal')
-        normal_map = bpy.data.images.load(f"{output_folder}/intrinsic_render_normal.png")
-    if props.albedo_map:
-        generator.generate_image(image_path, output_folder, task='albedo')
-        albedo_map = bpy.data.images.load(f"{output_folder}/intrinsic_render_albedo.png")
-    if props.shading_map:
-        generator.generate_image(image_path, output_folder, task='shading')
-        shade_map = bpy.data.images.load(f"{output_folder}/intrinsic_render_shading.png")
-
-    target_object = obj
-    
-    bpy.context.active_object.select_set(False)
-    
-    projector = create_projector_object(target_object)
-    bpy.context.view_layer.objects.active = projector
-    set_projector_position_and_orientation(projector, target_object)
-    projector_material = setup_projector_material(depth_map, normal_map, albedo_map, shade_map)
-    assign_material_to_projector(projector, projector_material)
-    bpy.ops.object.mode_set(mode = 'OBJECT')
-    project_uvs(projector)
-    
-    bake_from_active(projector, target_object, depth_map, normal_map, albedo_map, shade_map, size)
-
-    if props.delete_projector:
-        remove_projector(projector)
-        
-    generator.close()
-    del generator
-    generator = None
-
-def convert_normal_map():
+    if not props.multi_view:
+        renders = [render_viewport(size, size, output_folder)]
+        return renders, [get_view(bpy.context.scene.camera, size, size)]
+    cameras = create_view_cameras(obj, props.view_count, props.view_elevation)
+    try:
+        renders = render_camera_views(cameras, size, size, output_folder)
+        views = [get_view(camera, size, size) for camera in cameras]
+    finally:
+        remove_view_cameras(cameras)
+    return renders, views
+
+def render_targets(objects: list, props, output_folder=None):
+    """Render the views of every object into one list. Returns the renders and (obj, views, offset) per object.
+
+    A single view renders the scene from its camera, which is the same for every
+    object, so it's rendered once and all of them bake from it.
+    """
+    if not props.multi_view:
+        renders, views = render_views(objects[0], props, output_folder)
+        return renders, [(obj, views, 0) for obj in objects]
+    renders = []
+    targets = []
+    for obj in objects:
+        obj_renders, views = render_views(obj, props, output_folder)
+        targets.append((obj, views, len(renders)))
+        renders.extend(obj_renders)
+    return renders, targets
+
+def apply_target_results(targets: list, results: list, images: dict = None) -> dict:
+    """apply_results for each object from render_targets. Returns the images by object name."""
+    images = images or {}
+    return {obj.name: apply_results(obj, results[offset:offset + len(views)], views, images.get(obj.name)) for obj, views, offset in targets}
+
+def generate(objects: list) -> str:
+    props = bpy.context.scene.intrinsic_lora_properties
+    output_folder = bpy.context.scene.render.filepath if props.save_to_disk else None
+    renders, targets = render_targets(objects, props, output_folder)
+
+    with profiler.stage('get_generator'):
+        generator = get_generator()
+
+    with profiler.stage('generate_batch'):
+        results = generator.generate_batch(renders, get_tasks(props), output_folder, output_type='np', **get_inference_options(props))
+    record_peak_memory(generator.last_peak_memory)
+    apply_target_results(targets, results)
+
+class BackgroundRender:
+    """Render objects, then run the model without blocking Blender. poll() it from a timer until it's no longer running.
+
+    The renders of all objects go through the model as one batch, and each
+    object's maps are baked into its own material. With props.progressive a quick pass at the preview resolution runs first, and its
+    maps are baked as soon as it's done. The full pass then bakes into the same
+    images, so the material shows the preview until the full maps replace it.
+    Runs in the inference worker when it's enabled, otherwise on a thread.
+    """
+
+    def __init__(self, objects: list):
+        props = bpy.context.scene.intrinsic_lora_properties
+        self.output_folder = bpy.context.scene.render.filepath if props.save_to_disk else None
+        self.tasks = get_tasks(props)
+        self.passes = [get_inference_options(props)]
+        if props.progressive:
+            self.passes.insert(0, get_preview_options(props))
+        self.preview = False
+        self.images = None
+        self.message = None
+        self.job = None
+        self.local_peak_memory = None
+        self.renders, self.targets = render_targets(objects, props, self.output_folder)
+        self.start_pass()
+
+    def start_pass(self):
+        options = self.passes.pop(0)
+        self.preview = bool(self.passes)
+        # only the full maps are saved
+        output_folder = None if self.preview else self.output_folder
+        prefs = get_preferences()
+        with profiler.stage('submit'):
+            if prefs.use_worker:
+                self.job = get_worker_client().submit(self.renders, self.tasks, prefs.model, prefs.config or None, options, get_cache_settings(), get_backend(), get_torch_trace_dir())
+            else:
+                settings = get_generator_settings()
+                self.job = LocalJob(lambda progress: self.run_local(settings, options, output_folder, progress))
+
+    def run_local(self, settings: dict, options: dict, output_folder, progress_callback) -> list:
+        """Generate in this process. Runs on the LocalJob's thread, so it doesn't touch bpy."""
+        with profiler.stage('get_generator'):
+            generator = load_generator(**settings)
+        with profiler.stage('generate_batch'):
+            results = generator.generate_batch(self.renders, self.tasks, output_folder, progress_callback, output_type='np', **options)
+        self.local_peak_memory = generator.last_peak_memory
+        return results
+
+    @property
+    def stage(self) -> str:
+        return f"{'preview ' if self.preview else ''}{self.job.stage} {self.job.progress:.0%}"
+
+    def poll(self) -> str:
+        status = self.job.poll()
+        if status != 'done':
+            self.message = self.job.message
+            return status
+        profiler.add_spans(self.job.profile)
+        record_peak_memory(self.job.peak_memory if isinstance(self.job, WorkerJob) else self.local_peak_memory)
+        if not self.preview and self.output_folder and isinstance(self.job, WorkerJob):
+            self.save_results()
+        self.images = apply_target_results(self.targets, self.job.results, self.images)
+        if not self.passes:
+            return 'done'
+        try:
+            self.start_pass()
+        except (OSError, TimeoutError) as e:
+            self.message = f"Could not reach the inference worker: {e}"
+            return 'error'
+        return 'running'
+
+    def cancel(self):
+        self.job.cancel()
+
+    def save_results(self):
+        from intrinsic_lora_addon.intrinsic_lora import to_image
+        with profiler.stage('save_png'):
+            for index, result in enumerate(self.job.results):
+                name = "intrinsic_render" if len(self.job.results) == 1 else f"intrinsic_render_{index}"
+                for task, image in result.items():
+                    to_image(image).save(f"{self.output_folder}/{name}_{task}.png")
+
+class FrameRangeRender:
+    """Maps for every frame of the scene's frame range, saved as PNG sequences and added to obj's material.
+
+    The stages overlap: while frame N+1 renders on the main thread, the frames
+    queued before it are in inference on a background thread, batched together,
+    and frame N-1 is merged into the UV layout on another. The main thread only
+    renders and writes the merged maps, so a frame takes about as long as the
+    slowest stage rather than all of them. poll() it from a timer until it's no
+    longer running.
+    """
+
+    def __init__(self, obj):
+        scene = bpy.context.scene
+        props = scene.intrinsic_lora_properties
+        prefs = get_preferences()
+        self.obj = obj
+        self.name = obj.name
+        self.props = props
+        self.tasks = get_tasks(props)
+        self.frames = list(range(scene.frame_start, scene.frame_end + 1))
+        self.pending = list(self.frames)
+        self.original_frame = scene.frame_current
+        self.folder = bpy.path.abspath(scene.render.filepath)
+        self.started = {}
+        self.merging = {}
+        self.images = {}
+        self.saved = 0
+        self.closed = False
+        self.finished = False
+        self.status = 'running'
+        self.message = None
+        generator = load = None
+        if prefs.use_worker:
+            generator = RemoteGenerator(get_worker_client(), prefs.model, prefs.config or None, get_backend(), get_cache_settings(), get_torch_trace_dir())
+        else:
+            # the model loads on the inference thread while the first frames render
+            settings = get_generator_settings()
+            load = functools.partial(load_generator, **settings)
+        # enough frames queued to fill a batch while the next one renders
+        frames_queued = max(1, props.batch_size // (props.view_count if props.multi_view else 1))
+        self.inference = InferenceThread(generator, self.tasks, props.batch_size, frames_queued, get_inference_options(props), load)
+        self.inference.start()
+        self.merger = ThreadPoolExecutor(max_workers=1, thread_name_prefix="intrinsic_lora_merge")
+
+    @property
+    def stage(self) -> str:
+        if self.inference.generator is None:
+            return "loading model"
+        return f"frame {self.saved}/{len(self.frames)}, {len(self.frames) - len(self.pending) - self.saved} in progress"
+
+    def frame_path(self, task: str, frame: int) -> str:
+        return os.path.join(self.folder, f"{bpy.path.clean_name(self.name)}_{task}_{frame:04d}.png")
+
+    def poll(self) -> str:
+        if self.status != 'running':
+            return self.status
+        try:
+            self.collect()
+            self.save_merged()
+            if self.pending and not self.inference.inputs.full():
+                self.render_frame(self.pending.pop(0))
+            elif not self.pending and not self.closed:
+                # retried on the next poll while the queue is full
+                self.closed = self.inference.close(block=False)
+        except Exception as e:
+            self.fail(str(e))
+            return self.status
+        if self.finished and not self.merging:
+            self.finish()
+        return self.status
+
+    def render_frame(self, frame: int):
+        scene = bpy.context.scene
+        scene.frame_set(frame)
+        renders, views = render_views(self.obj, self.props)
+        # the mesh as it is on this frame, it's merged after the scene has moved on
+        self.started[frame] = (views, get_mesh_arrays(self.obj), get_normal_frames(self.obj, self.props, self.tasks))
+        self.inference.submit(frame, renders)
+
+    def collect(self):
+        """Hand the frames out of inference to the merge thread."""
+        while True:
+            try:
+                item = self.inference.outputs.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                self.finished = True
+                return
+            frame, results, timings = item
+            if isinstance(results, Exception):
+                raise results
+            if 'peak_rss_mb' in timings:
+                record_peak_memory({'peak_rss_mb': timings['peak_rss_mb'], 'gpu_peak_mb': timings['gpu_peak_mb']})
+            views, mesh_arrays, normal_frames = self.started.pop(frame)
+            self.merging[frame] = self.merger.submit(merge_results, mesh_arrays, results, views, self.props.size, normal_frames)
+
+    def save_merged(self):
+        for frame, future in list(self.merging.items()):
+            if not future.done():
+                continue
+            del self.merging[frame]
+            merged = future.result()
+            with profiler.stage('save_frame'):
+                for task in self.tasks:
+                    array = merged[task]
+                    self.images[task] = image_from_array(f"{self.name}_{task}_frame", array, color=task in ('albedo', 'shading'), image=self.images.get(task))
+                    save_image(self.images[task], self.frame_path(task, frame))
+            self.saved += 1
+
+    def finish(self):
+        """Add an image sequence node per task, playing the saved frames on the frames they were made for."""
+        self.cleanup()
+        for task in self.tasks:
+            image = bpy.data.images.load(self.frame_path(task, self.frames[0]), check_existing=True)
+            image.source = 'SEQUENCE'
+            image[GENERATED_KEY] = True
+            if task not in ('albedo', 'shading'):
+                image.colorspace_settings.name = 'Non-Color'
+            node = add_image_node(self.obj, image, f"{NODE_PREFIX} {self.name} {task}")
+            node.image_user.frame_duration = len(self.frames)
+            node.image_user.frame_start = self.frames[0]
+            node.image_user.frame_offset = self.frames[0] - 1
+            node.image_user.use_auto_refresh = True
+        self.status = 'done'
+
+    def fail(self, message: str):
+        self.cancel()
+        self.status = 'error'
+        self.message = message
+
+    def cancel(self):
+        """Stop rendering. Frames already saved stay on disk."""
+        self.inference.cancel()
+        self.cleanup()
+        self.status = 'cancelled'
+
+    def cleanup(self):
+        self.merger.shutdown(wait=False, cancel_futures=True)
+        for image in self.images.values():
+            bpy.data.images.remove(image)
+        self.images = {}
+        bpy.context.scene.frame_set(self.original_frame)
+
+@profiler.timed()
+def merge_results(mesh_arrays: tuple, results: list, views: list, size: int, normal_frames: tuple = None) -> dict:
+    """Merge the maps of all views into the UV layout of a mesh from get_mesh_arrays. Returns the arrays by task.
+
+    The normal map is merged in world space, and converted to tangent space with
+    normal_frames from get_normal_frames. Doesn't touch bpy, so it can run on a background thread.
+    """
+    triangles, uv_triangles, normals = mesh_arrays
+    # camera space normals only agree between views once they're in world space
+    view_maps = [{task: camera_to_world_normals(image, view) if task == 'normal' else image for task, image in result.items()} for result, view in zip(results, views)]
+    with profiler.stage('merge_views'):
+        merged = merge_views(triangles, uv_triangles, normals, views, view_maps, size)
+    if normal_frames is not None and 'normal' in merged:
+        with profiler.stage('normal_to_tangent'):
+            merged['normal'] = convert_normal_map(merged['normal'], *normal_frames, to_tangent=True)
+    return merged
+
+def get_normal_frames(obj, props, tasks: list):
+    """World space tangent frames of obj for merge_results, or None when the normal map stays in world space."""
+    if 'normal' not in tasks or props.normal_space != 'TANGENT':
+        return None
+    try:
+        return get_tangent_arrays(obj, world_space=True)
+    except RuntimeError as e:
+        logger.warning(f"Can't compute tangents for {obj.name}, its normal map stays in world space. Triangulate n-gons first. ({e})")
+        return None
+
+@profiler.timed()
+def apply_results(obj, results: list, views: list, images: dict = None) -> dict:
+    """Merge the maps of all views straight into obj's UV layout, weighted by visibility and facing angle.
+
+    Returns the images by task. The images and their nodes from an earlier render of
+    obj, or images passed in, e.g. from a preview, are updated instead of adding new ones.
+    """
+    props = bpy.context.scene.intrinsic_lora_properties
+    merged = merge_results(get_mesh_arrays(obj), results, views, props.size, get_normal_frames(obj, props, list(results[0])))
+    previous = images or {}
+    images = {}
+    for task in results[0]:
+        images[task] = image_from_array(f"{obj.name}_{task}", merged[task], color=task in ('albedo', 'shading'), image=previous.get(task))
+        if task not in previous:
+            add_image_node(obj, images[task], f"{NODE_PREFIX} {obj.name} {task}")
+    return images
+
+def get_preferences():
+    return bpy.context.preferences.addons['intrinsic_lora_addon'].preferences
+
+def get_generator():
+    return load_generator(**get_generator_settings())
+
+def get_generator_settings() -> dict:
+    """Everything load_generator needs from the preferences, read on the main thread."""
+    prefs = get_preferences()
+    manager.idle_timeout = prefs.idle_timeout * 60
+    manager.min_free_memory_mb = prefs.min_free_memory
+    return {'model': prefs.model, 'config': prefs.config or None, 'backend': get_backend(), 'cache': get_cache_settings()}
+
+def load_generator(model: str, config: str, backend: dict, cache: dict):
+    generator = manager.get(model, config=config, **backend)
+    generator.result_cache = get_result_cache(**cache) if cache else None
+    return generator
+
+def get_backend() -> dict:
+    prefs = get_preferences()
+    tiny_vae = bpy.path.abspath(prefs.tiny_vae) if prefs.tiny_vae and prefs.fast_vae != 'off' else None
+    return {'precision': prefs.precision, 'channels_last': prefs.channels_last, 'compile_unet': prefs.compile_unet, 'fuse_lora': prefs.fuse_lora and prefs.precision != 'int8', 'tiny_vae': tiny_vae, 'memory_budget_mb': prefs.memory_budget}
+
+def get_torch_trace_dir():
+    """Folder for torch profiler traces of the model stages, or None when model profiling is off."""
+    prefs = get_preferences()
+    if not prefs.torch_profile:
+        return None
+    return bpy.path.abspath(prefs.profile_dir) if prefs.profile_dir else PROFILE_DIR
+
+def get_cache_settings():
+    """Result cache directory and size for the generator, or None when caching is off."""
+    prefs = get_preferences()
+    if not prefs.use_result_cache:
+        return None
+    return {'directory': bpy.path.abspath(prefs.cache_dir) if prefs.cache_dir else None, 'max_size_mb': prefs.cache_size}
+
+def get_cache_stats(scan: bool = True):
+    """Result cache statistics of this session, None before the first lookup. See ResultCache.stats for scan."""
+    settings = get_cache_settings()
+    if settings is None:
+        return None
+    cache = get_result_cache(**settings)
+    if not cache.hits and not cache.misses:
+        return None
+    return cache.stats(scan)
+
+def get_worker_client():
+    prefs = get_preferences()
+    return WorkerClient(port=prefs.worker_port, python_executable=prefs.worker_python or None, idle_timeout=prefs.idle_timeout * 60)
+
+def warm_up():
+    prefs = get_preferences()
+    if not prefs.model:
+        return "No model configured. Set the model path in the addon preferences."
+    if prefs.use_worker:
+        get_worker_client().warm_up(prefs.model, prefs.config or None, get_backend())
+    else:
+        get_generator()
+
+def prewarm():
+    """Import the model libraries on a background thread, so the first render doesn't wait for them."""
+    threading.Thread(target=preload, name="intrinsic_lora_preload", daemon=True).start()
+
+def release(include_worker=True):
+    released = manager.release()
+    if include_worker and get_preferences().use_worker:
+        released += get_worker_client().release()
+    if not released:
+        return "No model loaded."
+
+def check_generators():
+    prefs = get_preferences()
+    manager.idle_timeout = prefs.idle_timeout * 60
+    manager.min_free_memory_mb = prefs.min_free_memory
+    if manager.check():
+        logger.info("Released idle intrinsic lora model")
+
+def clean_up() -> str:
+    images, nodes, freed = remove_unused_datablocks()
+    if not images and not nodes:
+        return "Nothing to clean up."
+    return f"Removed {images} unused images and {nodes} empty image nodes, {freed / 2**20:.0f} MB reclaimed."
+
+def convert_normal_map(conversion: str = 'OBJECT_TO_TANGENT'):
+    """conversion is one of OBJECT_TO_TANGENT, WORLD_TO_TANGENT, TANGENT_TO_OBJECT and TANGENT_TO_WORLD."""
     if len(bpy.context.selected_objects) > 0:
         obj = bpy.context.selected_objects[0]
-        transform_normal_map(obj)
+        return transform_normal_map(obj, to_tangent=conversion.endswith('_TO_TANGENT'), world_space='WORLD' in conversion)
     else:
         return "No object selected. Please select an object."
  
-def execute():
+def get_targets(single: bool = False):
+    """Returns the objects to generate for, or an error message.
+
+    With All Selected that's every selected mesh with a UV map and a material with nodes
+    for the maps, otherwise (or with single) the first selected object.
+    """
+    props = bpy.context.scene.intrinsic_lora_properties
+    if single or not props.all_selected:
+        obj, error = get_target()
+        return ([obj] if obj else None), error
+    meshes = [obj for obj in bpy.context.selected_objects if obj.type == 'MESH' and obj.data.uv_layers]
+    objects = [obj for obj in meshes if has_node_material(obj)]
+    if len(objects) < len(meshes):
+        logger.warning(f"Skipping {', '.join(obj.name for obj in meshes if obj not in objects)}, no material with nodes.")
+    if not objects:
+        return None, "No selected mesh has a UV map and a material with nodes." if meshes else "No selected mesh has a UV map."
+    if not props.multi_view and bpy.context.scene.camera is None:
+        return None, "Scene has no camera."
+    return objects, None
+
+def get_target():
+    """Returns the object to generate for, or an error message."""
     if len(bpy.context.selected_objects) > 0:
         obj = bpy.context.selected_objects[0]
         if obj.type == 'CAMERA':
-            return "Cannot generate texture for camera. Please select an object."
-        return generate(obj)
+            return None, "Cannot generate texture for camera. Please select an object."
+        if obj.type != 'MESH' or not obj.data.uv_layers:
+            return None, "Object has no UV map."
+        if not has_node_material(obj):
+            return None, "Object has no material with nodes."
+        if not bpy.context.scene.intrinsic_lora_properties.multi_view and bpy.context.scene.camera is None:
+            return None, "Scene has no camera."
+        return obj, None
     else:
-        return "No object selected. Please select an object."
\ No newline at end of file
+        return None, "No object selected. Please select an object."
+
+def execute():
+    objects, error = get_targets()
+    if error:
+        return error
+    with profile_run():
+        return generate(objects)
+
+def profile_run():
+    """Start recording the stages of a render."""
+    global _peak_memory
+    _peak_memory = None
+    profiler.torch_trace_dir = get_torch_trace_dir()
+    return profiler.run('intrinsic_lora_render')
+
+def export_trace(path: str):
+    if not profiler.spans:
+        return "Nothing recorded yet. Render first."
+    profiler.export_chrome_trace(path)
+
+def get_timings() -> list:
+    """Per stage timings of the last render."""
+    return profiler.summary()
+
+def record_peak_memory(peak: dict):
+    global _peak_memory
+    _peak_memory = max_peak_memory(_peak_memory, peak)
+
+def get_peak_memory():
+    """Highest memory use of the model batches of the last render, or None before one ran the model."""
+    return _peak_memory
\ No newline at end of file
@@ -0,0 +1,135 @@
+import gc
+import importlib
+import threading
+import time
+
+class GeneratorManager:
+    """Keeps loaded generators resident between renders.
+
+    Generators are keyed on (model path, config, device, dtype, backend) and released
+    again after idle_timeout seconds without use, or when the available system
+    memory drops below min_free_memory_mb. A generator running a batch is never
+    released by check(), and its idle time counts from the end of its last batch.
+    Only the key last asked for is kept, check() releases the others as soon as
+    they finish their batches.
+
+    Models load outside the lock, so check() and release() on the main thread
+    don't wait for a load on a background thread. A second get() for a key that
+    is loading waits for that load instead of starting another.
+    """
+
+    def __init__(self, idle_timeout: float = 600, min_free_memory_mb: int = 0):
+        self.idle_timeout = idle_timeout
+        self.min_free_memory_mb = min_free_memory_mb
+        self._generators = {}
+        self._last_used = {}
+        # the key last passed to get(), any other is released once it's idle
+        self._current = None
+        # key -> Event set once the load of that key has finished or failed
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def make_key(self, pretrained_model_name_or_path, config=None, device=None, dtype=None, precision='fp32', channels_last=False, compile_unet=False, fuse_lora=False, tiny_vae=None, memory_budget_mb=0):
+        # torch and diffusers are only imported once a model is needed
+        from intrinsic_lora_addon.intrinsic_lora import default_device
+        return (pretrained_model_name_or_path, config or None, device or default_device(), str(dtype) if dtype else None, precision, channels_last, compile_unet, fuse_lora, tiny_vae or None, memory_budget_mb or 0)
+
+    def get(self, pretrained_model_name_or_path, config=None, device=None, dtype=None, precision='fp32', channels_last=False, compile_unet=False, fuse_lora=False, tiny_vae=None, memory_budget_mb=0):
+        from intrinsic_lora_addon.intrinsic_lora import IntrinsicLoRAImageGenerator
+        key = self.make_key(pretrained_model_name_or_path, config, device, dtype, precision, channels_last, compile_unet, fuse_lora, tiny_vae, memory_budget_mb)
+        while True:
+            with self._lock:
+                self._current = key
+                generator = self._generators.get(key)
+                if generator is not None:
+                    self._last_used[key] = time.monotonic()
+                    return generator
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    # only one model is kept around per process, a different key replaces it once
+                    # it's done with its batch, the next check() releases it then
+                    for other in [other for other, loaded in self._generators.items() if not loaded.in_use]:
+                        self.release(other)
+                    break
+            # another thread is loading this key, use its generator once it's done, or retry if it failed
+            loading.wait()
+        try:
+            generator = IntrinsicLoRAImageGenerator(pretrained_model_name_or_path=pretrained_model_name_or_path, config=config, device=key[2], dtype=dtype, precision=precision, channels_last=channels_last, compile_unet=compile_unet, fuse_lora=fuse_lora, tiny_vae=tiny_vae or None, memory_budget_mb=memory_budget_mb or 0)
+            with self._lock:
+                self._generators[key] = generator
+                self._last_used[key] = time.monotonic()
+            return generator
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def is_loaded(self, pretrained_model_name_or_path=None, config=None, device=None, dtype=None, **backend) -> bool:
+        """Whether any generator is loaded, or the one get() would return for the same arguments."""
+        with self._lock:
+            if pretrained_model_name_or_path is None:
+                return len(self._generators) > 0
+            return self.make_key(pretrained_model_name_or_path, config, device, dtype, **backend) in self._generators
+
+    def release(self, key=None) -> int:
+        """Release one generator, or all of them if no key is given. Returns the number released."""
+        with self._lock:
+            keys = [key] if key is not None else list(self._generators.keys())
+            released = 0
+            for k in keys:
+                generator = self._generators.pop(k, None)
+                self._last_used.pop(k, None)
+                if generator is not None:
+                    generator.close()
+                    released += 1
+            if released:
+                gc.collect()
+            return released
+
+    def check(self) -> int:
+        """Release idle generators replaced by another key, idle too long, or when memory is running low.
+
+        Returns right away without releasing anything if another thread holds the lock.
+        """
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            if not self._generators:
+                return 0
+            now = time.monotonic()
+            released = 0
+            idle = [key for key, generator in self._generators.items() if not generator.in_use]
+            for key in [key for key in idle if key != self._current]:
+                released += self.release(key)
+            idle = [key for key in idle if key in self._generators]
+            if self.idle_timeout > 0:
+                for key in idle:
+                    if now - max(self._last_used[key], self._generators[key].last_used) > self.idle_timeout:
+                        released += self.release(key)
+            if self.min_free_memory_mb > 0 and self._generators:
+                available = available_memory_mb()
+                if available is not None and available < self.min_free_memory_mb:
+                    for key in idle:
+                        if key in self._generators:
+                            released += self.release(key)
+            return released
+        finally:
+            self._lock.release()
+
+def preload():
+    """Import torch, diffusers and the generator module, e.g. on a background thread before the first render."""
+    importlib.import_module('intrinsic_lora_addon.intrinsic_lora')
+
+def available_memory_mb():
+    """Available system memory in MB, or None where it can't be determined."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+manager = GeneratorManager()
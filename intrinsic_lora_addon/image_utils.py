@@ -1,167 +1,215 @@
+import os
 import bpy
 import numpy as np
-
-def create_projector_object(obj):
-    """Create a projector object"""
-    obj_data = obj.data.copy()
-    projector = bpy.data.objects.new(name="TextureProjector", object_data=obj_data)
-    projector.data.uv_layers.remove(projector.data.uv_layers[0])
-    projector.data.uv_layers.new(name="bake")
-    bpy.context.collection.objects.link(projector)
-    return projector
-
-def setup_projector_material(depth_map = None, normal_map = None, albedo_map = None, shading_map = None):
-    """Set up projector material with the rendered image"""
-    projector_material = bpy.data.materials.new(name="TextureProjectorMaterial")
-    projector_material.use_nodes = True
-    projector_material.node_tree.nodes.clear()
-    bdsf_node = projector_material.node_tree.nodes.new('ShaderNodeBsdfPrincipled')
-    output_node = projector_material.node_tree.nodes.new('ShaderNodeOutputMaterial')
-    if depth_map:
-        depth_map_node = projector_material.node_tree.nodes.new('ShaderNodeTexImage')
-        depth_map_node.image = depth_map
-        #displacement_map = projector_material.node_tree.nodes.new(type='ShaderNodeDisplacement')
-        #projector_material.node_tree.links.new(depth_map_node.outputs[0], displacement_map.inputs['Height'])
-        projector_material.node_tree.links.new(depth_map_node.outputs[0], bdsf_node.inputs['Base Color'])
-    if normal_map:
-        normal_map_node = projector_material.node_tree.nodes.new('ShaderNodeTexImage')
-        normal_map_node.image = normal_map
-        normal_map = projector_material.node_tree.nodes.new(type='ShaderNodeNormalMap')
-        projector_material.node_tree.links.new(normal_map_node.outputs[0], normal_map.inputs[1])
-        projector_material.node_tree.links.new(normal_map.outputs[0], bdsf_node.inputs['Normal'])
-    if albedo_map:
-        albedo_map_node = projector_material.node_tree.nodes.new('ShaderNodeTexImage')
-        albedo_map_node.image = albedo_map
-        projector_material.node_tree.links.new(albedo_map_node.outputs[0], bdsf_node.inputs['Base Color'])
-    if shading_map:
-        shading_map_node = projector_material.node_tree.nodes.new('ShaderNodeTexImage')
-        shading_map_node.image = shading_map
-        projector_material.node_tree.links.new(shading_map_node.outputs[0], bdsf_node.inputs['Base Color'])
-    
-    projector_material.node_tree.links.new(bdsf_node.outputs[0], output_node.inputs[0])
-    return projector_material
-
-def assign_material_to_projector(projector, projector_material):
-    """Assign projector material to projector object"""
-    if not projector.data.materials:
-        projector.data.materials.append(projector_material)
-    else:
-        projector.data.materials[0] = projector_material
-
-def set_projector_position_and_orientation(projector, target_object):
-    """Set projector position and orientation"""
-    projector.location = target_object.location
-    projector.rotation_euler = target_object.rotation_euler
-
-def bake_from_active(projector, target_object, depth: bool, normal: bool, albedo: bool, shading: bool, size: int):
-    bpy.context.active_object.select_set(False)
-    projector.select_set(True)
-    #bpy.context.view_layer.objects.active = target_object
-    bpy.context.view_layer.objects.active = target_object
-    target_object.select_set(True)
-    bpy.context.scene.render.bake.use_selected_to_active = True
-    types = []
-    if depth:
-        types.append('DIFFUSE')
-    if normal:
-        types.append('NORMAL')
-    if albedo:
-        types.append('DIFFUSE')
-    if shading:
-        types.append('DIFFUSE')
-
-    for type in types:
-        create_texture_node(target_object, type, size, size)
-        bpy.ops.object.bake(type=type, use_clear=True, cage_extrusion=0.1)
-
-def create_texture_node(obj, texture_name, image_width, image_height):
-    """Create a texture node for baking"""
+from intrinsic_lora_addon.profiling import profiler
+from intrinsic_lora_addon.uv_projection import convert_normal_map
+
+# custom property on the images this addon creates, so they can be reused and cleaned up
+GENERATED_KEY = "intrinsic_lora"
+# names of the image nodes this addon adds start with this
+NODE_PREFIX = "Intrinsic LoRA"
+
+@profiler.timed()
+def image_from_array(name, array: np.ndarray, color: bool = True, image=None):
+    """Create a float image datablock from an HxW or HxWxC array (top row first, floats in 0-1 or uint8)
+
+    color arrays are taken to be sRGB and are stored linear, other arrays are stored as non-color data.
+    With image, or an image called name this addon created earlier, its pixels are
+    replaced instead (resized if needed), so materials using it update in place.
+    """
+    if array.dtype == np.uint8:
+        array = array.astype(np.float32) / 255.
+    if array.ndim == 2:
+        array = np.repeat(array[..., None], 3, axis=2)
+    height, width = array.shape[:2]
+    rgba = np.ones((height, width, 4), dtype=np.float32)
+    rgba[..., :array.shape[2]] = array[..., :4]
+    if color:
+        rgba[..., :3] = srgb_to_linear(rgba[..., :3])
+    if image is None:
+        image = bpy.data.images.get(name)
+        if image is not None and not image.get(GENERATED_KEY):
+            # someone else's image
+            image = None
+    if image is None:
+        image = bpy.data.images.new(name=name, width=width, height=height, float_buffer=True)
+        image[GENERATED_KEY] = True
+        if not color:
+            image.colorspace_settings.name = 'Non-Color'
+    elif tuple(image.size) != (width, height):
+        image.scale(width, height)
+    image.pixels.foreach_set(rgba[::-1].ravel())
+    image.update()
+    return image
+
+def srgb_to_linear(values: np.ndarray) -> np.ndarray:
+    values = np.clip(values, 0., 1.)
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4).astype(np.float32)
+
+def linear_to_srgb(values: np.ndarray) -> np.ndarray:
+    values = np.clip(values, 0., 1.)
+    return np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055).astype(np.float32)
+
+def save_image(image, path: str) -> str:
+    """Save image as a PNG file at path"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    image.filepath_raw = path
+    image.file_format = 'PNG'
+    image.save()
+    return path
+
+def has_node_material(obj) -> bool:
+    """Whether obj's active material slot holds a material with a node tree, where the maps go"""
+    materials = obj.data.materials
+    if not materials or obj.active_material_index >= len(materials):
+        return False
+    material = materials[obj.active_material_index]
+    return material is not None and material.node_tree is not None
+
+def add_image_node(obj, image, name: str = None):
+    """Add an image texture node for image to the active material and make it active
+
+    With name, the node of that name is reused if the material has one, so
+    generating again updates the node instead of adding another.
+    """
     material = obj.data.materials[obj.active_material_index]
-    image = bpy.data.images.new(name=texture_name, width=image_width, height=image_height)
-    texture_node_image = material.node_tree.nodes.new('ShaderNodeTexImage')
+    nodes = material.node_tree.nodes
+    texture_node_image = nodes.get(name) if name else None
+    if texture_node_image is None or texture_node_image.type != 'TEX_IMAGE':
+        texture_node_image = nodes.new('ShaderNodeTexImage')
+        if name:
+            texture_node_image.name = texture_node_image.label = name
     texture_node_image.image = image
-    material.node_tree.nodes.active = texture_node_image
+    nodes.active = texture_node_image
     return texture_node_image
 
-    
-def remove_projector(projector):
-    bpy.data.materials.remove(projector.data.materials[0])
-    bpy.data.objects.remove(projector)
-
-def world_to_model_normal(world_normal, tangent, bitangent):
-    tangent = np.array(tangent)
-    bitangent = np.array(bitangent)
-    normal = np.array(world_normal)
-
-    TBN = np.column_stack((tangent, bitangent, normal)).T
-    model_normal = np.linalg.inv(TBN) @ normal
-
-    return model_normal
-
-def transform_normal_map(obj):
-    bpy.context.view_layer.objects.active = obj
-    
-    # Ensure the object has a UV map
+def image_memory(image) -> int:
+    """Bytes taken by an image's pixels while loaded"""
+    if not image.has_data:
+        return 0
+    width, height = image.size
+    return width * height * image.channels * (4 if image.is_float else 1)
+
+def remove_unused_datablocks():
+    """Remove this addon's image nodes that lost their image and its images nothing uses any more.
+
+    Returns the number of images and nodes removed and the bytes of pixels freed.
+    """
+    nodes_removed = 0
+    for material in bpy.data.materials:
+        if material.node_tree is None:
+            continue
+        nodes = material.node_tree.nodes
+        for node in [node for node in nodes if node.type == 'TEX_IMAGE' and node.name.startswith(NODE_PREFIX) and node.image is None]:
+            nodes.remove(node)
+            nodes_removed += 1
+    images_removed = 0
+    freed = 0
+    for image in [image for image in bpy.data.images if image.get(GENERATED_KEY) and image.users == 0]:
+        freed += image_memory(image)
+        bpy.data.images.remove(image)
+        images_removed += 1
+    return images_removed, nodes_removed, freed
+
+@profiler.timed()
+def get_mesh_arrays(obj):
+    """World space triangles (T, 3, 3), their UVs (T, 3, 2) and normals (T, 3) of the evaluated mesh"""
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        mesh.calc_loop_triangles()
+        count = len(mesh.loop_triangles)
+        loops = np.empty(count * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get('loops', loops)
+        vertices = np.empty(count * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get('vertices', vertices)
+        normals = np.empty(count * 3, dtype=np.float32)
+        mesh.loop_triangles.foreach_get('normal', normals)
+        co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        uv = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        mesh.uv_layers.active.data.foreach_get('uv', uv)
+    finally:
+        evaluated.to_mesh_clear()
+
+    matrix = np.array(obj.matrix_world, dtype=np.float64)
+    co = co.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+    normals = normals.reshape(-1, 3) @ np.linalg.inv(matrix[:3, :3])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    return co[vertices].reshape(-1, 3, 3), uv.reshape(-1, 2)[loops].reshape(-1, 3, 2), normals
+
+def image_to_array(image) -> np.ndarray:
+    """Pixels of an image datablock as an HxWx4 float array, top row first"""
+    width, height = image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(height, width, 4)[::-1]
+
+@profiler.timed()
+def get_tangent_arrays(obj, world_space: bool = False):
+    """UVs (T, 3, 2), normals and tangents (T, 3, 3) and bitangent signs (T, 3) per triangle corner of the evaluated mesh
+
+    Normals and tangents are in object space, or in world space with world_space.
+    Raises RuntimeError for meshes Blender can't compute tangents for (n-gons).
+    """
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        mesh.calc_tangents(uvmap=mesh.uv_layers.active.name)
+        mesh.calc_loop_triangles()
+        loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get('loops', loops)
+        loop_count = len(mesh.loops)
+        normals = np.empty(loop_count * 3, dtype=np.float32)
+        mesh.loops.foreach_get('normal', normals)
+        tangents = np.empty(loop_count * 3, dtype=np.float32)
+        mesh.loops.foreach_get('tangent', tangents)
+        signs = np.empty(loop_count, dtype=np.float32)
+        mesh.loops.foreach_get('bitangent_sign', signs)
+        uv = np.empty(loop_count * 2, dtype=np.float32)
+        mesh.uv_layers.active.data.foreach_get('uv', uv)
+    finally:
+        evaluated.to_mesh_clear()
+
+    normals = normals.reshape(-1, 3)
+    tangents = tangents.reshape(-1, 3)
+    if world_space:
+        matrix = np.array(obj.matrix_world, dtype=np.float64)[:3, :3]
+        # normals take the inverse transpose, tangents follow the surface
+        normals = normals @ np.linalg.inv(matrix)
+        tangents = tangents @ matrix.T
+        if np.linalg.det(matrix) < 0:
+            signs = -signs
+    loops = loops.reshape(-1, 3)
+    return uv.reshape(-1, 2)[loops], normals[loops], tangents[loops], signs[loops]
+
+@profiler.timed()
+def transform_normal_map(obj, to_tangent: bool = True, world_space: bool = False):
+    """Convert the normal map in the active image node between object (or world) space and tangent space.
+
+    The converted map goes to an image named after the source and suffix, in an image
+    node of that name, both reused if converting again. The node becomes the active
+    node. Returns an error message, or None.
+    """
     if not obj.data.uv_layers:
         return "Object has no UV map."
+    if not obj.data.materials:
+        return "Object has no material."
     material = obj.data.materials[obj.active_material_index]
-    # Select the normal map texture
-    normal_map_node = material.node_tree.nodes.active
-    
-    if not normal_map_node:
-        return "No normal map found in material nodes."
-
-        # Get the normal map image
-    normal_map_texture = normal_map_node.image
-    
-    if not normal_map_texture:
-        return "No normal map image found."
-    # Get the tangent and bitangent from UV map
-    mesh = obj.data
-    #bm = bpy.data.meshes.new(obj.name + "_temp")
-    #bm.from_mesh(mesh)
-    #bm.calc_tangents()
-
-    difference_values = []
-
-    # Loop through each polygon and access its vertices and normals
-    for polygon in mesh.polygons:
-        # Access vertex indices and corresponding normals from the polygon
-        vertex_indices = polygon.loop_indices-1
-        vertex_normals = [mesh.vertices[index].normal for index in vertex_indices]
-
-    # Process each vertex normal
-    for vertex_normal in vertex_normals:
-        # Get the corresponding pixel value from the normal map texture
-        # This might require additional logic depending on UV mapping
-
-        # Assuming UV coordinates are available in 'loop_data' for each vertex
-        loop_data = mesh.loops[polygon.loop_indices[0]]
-        uv_coord = loop_data.uv
-
-        # Implement UV to pixel mapping logic here to get the corresponding pixel
-        # This can involve texture coordinates and image dimensions
-        # (Replace this with your UV mapping logic)
-        map_pixel_index = calculate_pixel_index(uv_coord, normal_map_texture.width, normal_map_texture.height)
-        map_normal_pixel = normal_map_texture.pixels[map_pixel_index][:3]
-
-        # Calculate difference between vertex normal and map normal
-        difference = [v - m for v, m in zip(vertex_normal, map_normal)]
-        difference_values.append(difference)
-
-    # Create a new image data block for the difference map
-    difference_map = bpy.data.images.new("difference_normal_map", width=normal_map_texture.width, height=normal_map_texture.height)
-
-    # Fill the pixels with the calculated difference values
-    pixels = difference_map.pixels
-    for i, difference in enumerate(difference_values):
-        # Convert difference values back to (0, 255) range
-        pixel_data = [(d * 127.5) + 127.5 for d in difference]
-        pixels[i][:3] = pixel_data
-        
-    model_space_normal_map_node = obj.data.materials[0].node_tree.nodes.new(type='ShaderNodeTexImage')
-    model_space_normal_map_node.image = difference_map
-
-
-    return "Model space normal map created successfully."
-
+    node = material.node_tree.nodes.active
+    if node is None or node.type != 'TEX_IMAGE' or node.image is None:
+        return "Make the image node with the normal map the active node."
+    try:
+        uv_triangles, normals, tangents, signs = get_tangent_arrays(obj, world_space)
+    except RuntimeError as e:
+        return f"Can't compute tangents, triangulate n-gons first. ({e})"
+
+    normal_map = image_to_array(node.image)
+    converted = convert_normal_map(normal_map, uv_triangles, normals, tangents, signs, to_tangent)
+    suffix = "tangent" if to_tangent else "world" if world_space else "object"
+    image = image_from_array(f"{node.image.name}_{suffix}", converted, color=False)
+    location = node.location.copy()
+    new_node = add_image_node(obj, image, f"{NODE_PREFIX} {image.name}")
+    new_node.location = (location.x, location.y - 300)
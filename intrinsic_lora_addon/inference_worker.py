@@ -0,0 +1,392 @@
+"""
+Inference worker process that owns the model, and the client Blender uses to talk to it.
+
+The worker is started by WorkerClient when nothing is listening on the port,
+or by hand with
+
+    python -m intrinsic_lora_addon.inference_worker --port 53411
+
+It keeps running after Blender exits, so the model stays warm across
+restarts and addon reloads. Images are passed through shared memory, the
+connection only carries small control messages.
+"""
+import argparse
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing import AuthenticationError, resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from intrinsic_lora_addon.profiling import profiler
+from intrinsic_lora_addon.result_cache import get_result_cache
+
+DEFAULT_PORT = 53411
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "intrinsic_lora")
+KEY_FILE = os.path.join(CACHE_DIR, "worker.key")
+LOG_FILE = os.path.join(CACHE_DIR, "worker.log")
+
+class InferenceCancelled(Exception):
+    pass
+
+def get_authkey() -> bytes:
+    """Shared secret for the local connection, created on first use."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    try:
+        fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    with open(KEY_FILE) as f:
+        return f.read().strip().encode()
+
+def share_array(array: np.ndarray):
+    """Copy array into a new shared memory block. Returns the block and a descriptor to send."""
+    array = np.ascontiguousarray(array)
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+    return shm, {'name': shm.name, 'shape': array.shape, 'dtype': array.dtype.str}
+
+def read_shared(descriptor: dict) -> np.ndarray:
+    """Copy an array out of a shared memory block owned by the other process."""
+    shm = SharedMemory(name=descriptor['name'])
+    if os.name == 'posix':
+        # attaching registers the block with our resource tracker, but the other side owns it
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    try:
+        return np.ndarray(descriptor['shape'], np.dtype(descriptor['dtype']), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+def release_shared(blocks: list):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+    blocks.clear()
+
+def run_generate(conn, message: dict, manager) -> list:
+    def progress(stage, progress):
+        while conn.poll():
+            if conn.recv().get('cmd') == 'cancel':
+                raise InferenceCancelled()
+        conn.send({'status': 'progress', 'stage': stage, 'progress': progress})
+
+    profiler.torch_trace_dir = message.get('torch_trace_dir')
+    try:
+        with profiler.run('worker'):
+            with profiler.stage('read_shared'):
+                images = [read_shared(descriptor) for descriptor in message['images']]
+            progress('load', 0.0)
+            with profiler.stage('get_generator'):
+                generator = manager.get(message['model'], config=message.get('config'), **message.get('backend', {}))
+            cache = message.get('cache')
+            generator.result_cache = get_result_cache(**cache) if cache else None
+            results = generator.generate_batch(images, message['tasks'], progress_callback=progress, output_type='np', **message.get('options', {}))
+    except InferenceCancelled:
+        conn.send({'status': 'cancelled'})
+        return []
+    except Exception as e:
+        traceback.print_exc()
+        conn.send({'status': 'error', 'message': str(e)})
+        return []
+
+    blocks = []
+    descriptors = []
+    for result in results:
+        descriptors.append({})
+        for task, image in result.items():
+            shm, descriptors[-1][task] = share_array(image)
+            blocks.append(shm)
+    conn.send({'status': 'done', 'results': descriptors, 'profile': profiler.spans, 'peak_memory': generator.last_peak_memory})
+    return blocks
+
+def handle_connection(conn, manager) -> bool:
+    """Serve one client until it disconnects. Returns True if the worker should shut down."""
+    blocks = []
+    try:
+        while True:
+            message = conn.recv()
+            # the client has copied the previous results by the time it sends anything else
+            release_shared(blocks)
+            cmd = message.get('cmd')
+            if cmd == 'ping':
+                conn.send({'status': 'ok', 'pid': os.getpid(), 'loaded': manager.is_loaded()})
+            elif cmd == 'warm_up':
+                manager.get(message['model'], config=message.get('config'), **message.get('backend', {}))
+                conn.send({'status': 'ok'})
+            elif cmd == 'release':
+                conn.send({'status': 'ok', 'released': manager.release()})
+            elif cmd == 'shutdown':
+                manager.release()
+                conn.send({'status': 'ok'})
+                return True
+            elif cmd == 'generate':
+                blocks = run_generate(conn, message, manager)
+            elif cmd == 'cancel':
+                # nothing is running any more
+                pass
+            else:
+                conn.send({'status': 'error', 'message': f'Unknown command {cmd}'})
+    except (EOFError, OSError):
+        return False
+    finally:
+        release_shared(blocks)
+
+def serve(port: int = DEFAULT_PORT, idle_timeout: float = 600):
+    from intrinsic_lora_addon.generator_manager import manager
+    manager.idle_timeout = idle_timeout
+
+    def check_idle():
+        while True:
+            time.sleep(30)
+            manager.check()
+    threading.Thread(target=check_idle, daemon=True).start()
+
+    with Listener(('127.0.0.1', port), authkey=get_authkey()) as listener:
+        print(f'Intrinsic LoRA worker listening on port {port}', flush=True)
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError):
+                continue
+            with conn:
+                if handle_connection(conn, manager):
+                    break
+    manager.release()
+
+class WorkerJob:
+    """A generate request running in the worker. poll() it from a timer until it's no longer running."""
+
+    def __init__(self, conn, input_blocks):
+        self.conn = conn
+        self.input_blocks = input_blocks
+        self.status = 'running'
+        self.stage = 'queued'
+        self.progress = 0.0
+        self.results = None
+        self.message = None
+        # stages recorded in the worker
+        self.profile = []
+        # peak memory of the model batch in the worker, see PeakMemory.result()
+        self.peak_memory = None
+        # set by the caller, whatever it needs to apply the results
+        self.views = None
+
+    def poll(self) -> str:
+        try:
+            while self.status == 'running' and self.conn.poll():
+                message = self.conn.recv()
+                status = message['status']
+                if status == 'progress':
+                    self.stage = message['stage']
+                    self.progress = message['progress']
+                elif status == 'done':
+                    self.results = [{task: read_shared(descriptor) for task, descriptor in result.items()} for result in message['results']]
+                    self.profile = message.get('profile', [])
+                    self.peak_memory = message.get('peak_memory')
+                    self.progress = 1.0
+                    self.status = 'done'
+                else:
+                    self.message = message.get('message')
+                    self.status = status
+        except (EOFError, OSError):
+            self.status = 'error'
+            self.message = 'Lost connection to the inference worker.'
+        if self.status != 'running':
+            self.close()
+        return self.status
+
+    def cancel(self):
+        if self.status == 'running':
+            try:
+                self.conn.send({'cmd': 'cancel'})
+            except OSError:
+                pass
+            self.status = 'cancelled'
+        self.close()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        release_shared(self.input_blocks)
+
+class LocalJob:
+    """function(progress_callback) running on a thread in this process, polled like a WorkerJob.
+
+    function returns the results. A cancel takes effect at the next progress callback.
+    The generator runs one batch at a time, so a cancelled job still holds up the next
+    one until then.
+    """
+
+    def __init__(self, function):
+        self.status = 'running'
+        self.stage = 'queued'
+        self.progress = 0.0
+        self.results = None
+        self.message = None
+        # stages are recorded by this process's profiler directly
+        self.profile = []
+        self.views = None
+        self._outcome = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self.run, args=(function,), name="intrinsic_lora_job", daemon=True)
+        self._thread.start()
+
+    def run(self, function):
+        try:
+            self.report('load', 0.0)
+            self._outcome = ('done', function(self.report), None)
+        except InferenceCancelled:
+            self._outcome = ('cancelled', None, None)
+        except Exception as e:
+            traceback.print_exc()
+            self._outcome = ('error', None, str(e))
+
+    def report(self, stage, progress):
+        if self._cancelled.is_set():
+            raise InferenceCancelled()
+        self.stage = stage
+        self.progress = progress
+
+    def poll(self) -> str:
+        if self.status == 'running' and self._outcome is not None:
+            self.status, self.results, self.message = self._outcome
+            if self.status == 'done':
+                self.progress = 1.0
+        return self.status
+
+    def cancel(self):
+        if self.status == 'running':
+            self._cancelled.set()
+            self.status = 'cancelled'
+
+class RemoteGenerator:
+    """generate_batch through the inference worker, for code written against a generator in this process."""
+
+    def __init__(self, client, model: str, config: str = None, backend: dict = None, cache: dict = None, torch_trace_dir: str = None, poll_interval: float = 0.05):
+        self.client = client
+        self.model = model
+        self.config = config
+        self.backend = backend
+        self.cache = cache
+        self.torch_trace_dir = torch_trace_dir
+        self.poll_interval = poll_interval
+        self.last_peak_memory = None
+
+    def generate_batch(self, input_images: list, tasks: list, output_dir=None, progress_callback=None, output_type: str = 'np', **options) -> list:
+        """Blocks until the worker is done. Results are always arrays, output_dir and output_type are ignored."""
+        job = self.client.submit(input_images, tasks, self.model, self.config, options, self.cache, self.backend, self.torch_trace_dir)
+        try:
+            while job.poll() == 'running':
+                if progress_callback:
+                    progress_callback(job.stage, job.progress)
+                time.sleep(self.poll_interval)
+        except InferenceCancelled:
+            job.cancel()
+            raise
+        if job.status != 'done':
+            raise RuntimeError(job.message or f'Inference {job.status}')
+        profiler.add_spans(job.profile)
+        self.last_peak_memory = job.peak_memory
+        return job.results
+
+class WorkerClient:
+
+    def __init__(self, port: int = DEFAULT_PORT, python_executable: str = None, idle_timeout: float = 600):
+        self.port = port
+        self.python_executable = python_executable or sys.executable
+        self.idle_timeout = idle_timeout
+
+    def connect(self, start: bool = True, timeout: float = 60):
+        address = ('127.0.0.1', self.port)
+        try:
+            return Client(address, authkey=get_authkey())
+        except ConnectionRefusedError:
+            if not start:
+                raise
+        self.start_worker()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return Client(address, authkey=get_authkey())
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Inference worker did not start. See {LOG_FILE}')
+                time.sleep(0.5)
+
+    def start_worker(self):
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(package_dir), env.get('PYTHONPATH')]))
+        command = [self.python_executable, '-m', f'{__package__}.inference_worker', '--port', str(self.port), '--idle-timeout', str(self.idle_timeout)]
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(LOG_FILE, 'a') as log:
+            if os.name == 'nt':
+                subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, creationflags=subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP)
+            else:
+                subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def is_running(self) -> bool:
+        try:
+            with self.connect(start=False) as conn:
+                conn.send({'cmd': 'ping'})
+                return conn.recv()['status'] == 'ok'
+        except (ConnectionRefusedError, EOFError, OSError):
+            return False
+
+    def request(self, message: dict, start: bool = True) -> dict:
+        with self.connect(start=start) as conn:
+            conn.send(message)
+            return conn.recv()
+
+    def warm_up(self, model: str, config: str = None, backend: dict = None):
+        """Ask the worker to load the model. Returns without waiting for the load to finish."""
+        conn = self.connect()
+        conn.send({'cmd': 'warm_up', 'model': model, 'config': config, 'backend': backend or {}})
+        conn.close()
+
+    def release(self) -> int:
+        try:
+            return self.request({'cmd': 'release'}, start=False).get('released', 0)
+        except (ConnectionRefusedError, EOFError, OSError):
+            return 0
+
+    def submit(self, images: list, tasks: list, model: str, config: str = None, options: dict = None, cache: dict = None, backend: dict = None, torch_trace_dir: str = None) -> WorkerJob:
+        """Start generating tasks for a list of images. The job's results are one dict of task -> array per image.
+
+        cache holds the worker's result cache directory and max_size_mb, None disables it.
+        backend holds the precision, channels_last and compile_unet settings for the model.
+        With torch_trace_dir set, the worker writes torch profiler traces of the model stages there.
+        """
+        conn = self.connect()
+        input_blocks = []
+        descriptors = []
+        for image in images:
+            shm, descriptor = share_array(image)
+            input_blocks.append(shm)
+            descriptors.append(descriptor)
+        try:
+            conn.send({'cmd': 'generate', 'images': descriptors, 'tasks': tasks, 'model': model, 'config': config, 'options': options or {}, 'cache': cache, 'backend': backend or {}, 'torch_trace_dir': torch_trace_dir})
+        except OSError:
+            conn.close()
+            release_shared(input_blocks)
+            raise
+        return WorkerJob(conn, input_blocks)
+
+def main():
+    parser = argparse.ArgumentParser(description='Intrinsic LoRA inference worker')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--idle-timeout', type=float, default=600, help='Release the model after this many idle seconds. 0 keeps it loaded')
+    args = parser.parse_args()
+    serve(args.port, args.idle_timeout)
+
+if __name__ == '__main__':
+    main()
@@ -1,95 +1,515 @@
 from collections import defaultdict
+from contextlib import contextmanager, nullcontext
 import gc
+import logging
 import os
+import threading
+import time
 import torch
 import numpy as np
 from PIL import Image
 from pathlib import Path
 from torchvision import transforms
 from torchvision.transforms.functional import pil_to_tensor, to_pil_image
-from diffusers import StableDiffusionPipeline
-from diffusers.loaders import LoraLoaderMixin
+from diffusers import AutoencoderTiny
+from safetensors.torch import load_file
+from intrinsic_lora_addon.component_store import ComponentStore
+from intrinsic_lora_addon.fused_lora import FusedLoraRegistry, FusedLoraStore, fuse_lora
+from intrinsic_lora_addon.lora_registry import LORA_FILES, LoraRegistry, get_lora_path
+from intrinsic_lora_addon.memory_budget import module_mb, plan_batch, plan_offload
+from intrinsic_lora_addon.profiling import PeakMemory, profiler
+from intrinsic_lora_addon.prompt_cache import PromptEmbeddingCache, file_fingerprint
+from intrinsic_lora_addon.result_cache import hash_image
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+FAST_VAE_STAGES = ('decode', 'encode', 'both')
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
 
 class IntrinsicLoRAImageGenerator:
-    def __init__(self, pretrained_model_name_or_path, config=None):
+    """Runs the intrinsic LoRAs on top of a Stable Diffusion 1.5 checkpoint.
+
+    precision picks how the model runs: 'fp32', 'bf16' (fp32 weights with bf16
+    autocast) or 'int8' (dynamically quantized unet linear layers, CPU only).
+    channels_last converts the unet and vae to the channels last memory format,
+    which is faster for convolutions on most CPUs, and compile_unet runs the unet
+    through torch.compile.
+
+    fuse_lora merges each task's LoRA into the unet weights instead of running
+    LoRA layers next to them. The fused weights are saved per task the first
+    time and memory mapped from then on.
+
+    tiny_vae is a distilled tiny autoencoder (taesd), either a diffusers folder or
+    a single weights file. Calls with fast_vae then run the vae encode, decode or
+    both through it instead of the full vae, which is several times faster at a
+    small loss in quality.
+
+    memory_budget_mb caps the memory the model uses for its weights and activations
+    (on the GPU with CUDA). Within it, batches are split, attention is sliced and
+    the vae runs in smaller tiles as needed, and on CUDA the models are offloaded
+    to the CPU between stages when they don't all fit. 0 runs without a cap. The
+    peak reached by the last batch is in last_peak_memory either way.
+    """
+
+    def __init__(self, pretrained_model_name_or_path, config=None, device=None, dtype=None, result_cache=None, precision: str = 'fp32', channels_last: bool = False, compile_unet: bool = False, fuse_lora: bool = False, tiny_vae: str = None, memory_budget_mb: int = 0):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, expected one of {", ".join(PRECISIONS)}')
+        if fuse_lora and precision == 'int8':
+            raise ValueError('Fused LoRA weights can not be swapped into int8 quantized layers')
         self.pretrained_model_name_or_path = pretrained_model_name_or_path
         self.config = config
+        self.precision = precision
+        self.channels_last = channels_last
+        self.compile_unet = compile_unet
+        self.compiled_unet = None
+        self.fuse_lora = fuse_lora
         self.unet = None
         self.tokenizer = None
         self.text_encoder = None
         self.vae = None
-        self.scheduler = None
+        self.tiny_vae_path = tiny_vae
+        self.tiny_vae = None
         self.max_timestep = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.task = None
+        # quantized linear layers only have CPU kernels
+        self.device = 'cpu' if precision == 'int8' else device or default_device()
+        self.dtype = dtype or torch.float32
+        self.lora_registry = None
+        self.prompt_cache = None
+        self.result_cache = result_cache
+        self.memory_budget_mb = memory_budget_mb
+        self.weights_mb = {}
+        # None, 'model' or 'sequential' CPU offload, decided once the weights are loaded
+        self.offload = None
+        self.attention_slicing = False
+        self.last_peak_memory = None
+        # batches running the model, and when the last one finished, see lease()
+        self.active_batches = 0
+        self.last_used = time.monotonic()
+        self._lease_lock = threading.Lock()
+        # run_batch changes shared state (adapters, fused weights, slicing, tiling), one batch runs at a time
+        self._run_lock = threading.Lock()
         self.load_model()
 
+    @profiler.timed()
     def load_model(self):
+        self.prompt_cache = PromptEmbeddingCache(self.pretrained_model_name_or_path)
+        available_tasks = [task for task in LORA_FILES if os.path.exists(get_lora_path(task))]
 
-        self.pipeline = StableDiffusionPipeline.from_single_file(self.pretrained_model_name_or_path, original_config_file=self.config, local_files_only=True if self.config else False, load_safety_checker=False)
-        self.pipeline.to(self.device)
-        self.unet = self.pipeline.unet
-        self.text_encoder = self.pipeline.text_encoder
-        self.tokenizer = self.pipeline.tokenizer
-        self.pipeline.text_encoder = self.text_encoder
-        self.vae = self.pipeline.vae
-        self.scheduler = self.pipeline.scheduler
-        self.max_timestep = self.pipeline.scheduler.config.num_train_timesteps
-        
+        # with every prompt embedding cached, the text encoder is never needed
+        text_encoder = not self.prompt_cache.has_all(available_tasks)
+        store = ComponentStore(self.pretrained_model_name_or_path, self.config, self.dtype)
+        if store.has(text_encoder):
+            with profiler.stage('load_components'):
+                components = store.load(text_encoder)
+        else:
+            # once per checkpoint
+            with profiler.stage('convert_checkpoint'):
+                components = store.convert(text_encoder)
+        self.weights_mb = {name: module_mb(components[name]) for name in ('unet', 'vae', 'text_encoder') if components[name] is not None}
+        self.offload = plan_offload(self.memory_budget_mb, self.weights_mb, torch.device(self.device).type, self.fuse_lora)
+        if self.offload:
+            logger.info('%s CPU offload to stay within %d MB', self.offload.capitalize(), self.memory_budget_mb)
+        else:
+            with profiler.stage('to_device'):
+                for name in ('unet', 'vae', 'text_encoder'):
+                    if components[name] is not None:
+                        components[name].to(self.device)
+        self.unet = components['unet']
+        self.text_encoder = components['text_encoder']
+        self.tokenizer = components['tokenizer']
+        self.vae = components['vae']
+        if self.tiny_vae_path:
+            with profiler.stage('load_tiny_vae'):
+                self.tiny_vae = load_tiny_vae(self.tiny_vae_path, self.dtype).to(self.device)
+        self.max_timestep = components['num_train_timesteps']
+        # offloaded models keep their LoRAs on the CPU with them
+        self.lora_registry = LoraRegistry(self.unet, self.text_encoder, 'cpu' if self.offload else self.device)
+        with profiler.stage('load_loras'):
+            if self.fuse_lora:
+                self.prepare_fused(available_tasks)
+            else:
+                self.lora_registry.load_all()
+        with profiler.stage('apply_backend'):
+            self.apply_backend()
+
+    def prepare_fused(self, tasks: list):
+        """Fuse and save the tasks that have no fused weights yet, then switch to the fused registry."""
+        store = FusedLoraStore(self.pretrained_model_name_or_path, self.dtype)
+        missing = [task for task in tasks if not store.has(task)]
+        if missing or not self.prompt_cache.has_all(tasks):
+            with torch.inference_mode():
+                for task in missing:
+                    start = time.perf_counter()
+                    self.lora_registry.load(task)
+                    store.save(task, fuse_lora(self.unet, task))
+                    logger.info('Fused %s LoRA in %.1f s', task, time.perf_counter() - start)
+                # the prompts need the text encoder LoRA, which is gone once unloaded
+                for task in tasks:
+                    self.encode_prompt(task)
+            self.lora_registry.unload()
+        self.text_encoder = None
+        self.tokenizer = None
+        self.lora_registry = FusedLoraRegistry(self.unet, store, self.device, self.dtype, self.channels_last)
+
+    def apply_backend(self):
+        if self.precision == 'int8':
+            # after the LoRAs are loaded, so they wrap fp32 layers; the small LoRA layers stay fp32
+            qconfig = torch.ao.quantization.default_dynamic_qconfig
+            layers = {name: qconfig for name, module in self.unet.named_modules() if isinstance(module, torch.nn.Linear) and '.lora_' not in name}
+            torch.ao.quantization.quantize_dynamic(self.unet, layers, dtype=torch.qint8, inplace=True)
+        if self.channels_last:
+            self.unet.to(memory_format=torch.channels_last)
+            self.vae.to(memory_format=torch.channels_last)
+            if self.tiny_vae is not None:
+                self.tiny_vae.to(memory_format=torch.channels_last)
+        if self.compile_unet:
+            # the routed mixed task batches add hooks per call and stay eager
+            self.compiled_unet = torch.compile(self.unet)
+        if self.offload == 'sequential':
+            from accelerate import cpu_offload
+            for model in (self.unet, self.vae, self.text_encoder):
+                if model is not None:
+                    cpu_offload(model, execution_device=torch.device(self.device))
+
+    @contextmanager
+    def on_device(self, model):
+        """With model offload, model is on the device only while the block runs."""
+        if self.offload != 'model' or model is None or model is self.tiny_vae:
+            yield
+            return
+        model.to(self.device)
+        try:
+            yield
+        finally:
+            model.to('cpu')
+            self.release_memory()
+
+    def release_memory(self):
+        """Free what the last stage left behind, when running under a memory budget."""
+        if not self.memory_budget_mb:
+            return
+        gc.collect()
+        if torch.device(self.device).type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def plan_memory(self, pixels: int, count: int, batch_size: int) -> dict:
+        """Batch sizes, attention slicing and vae tile size for count images of pixels each. See plan_batch."""
+        if self.offload == 'sequential':
+            resident = 0.
+        elif self.offload == 'model':
+            resident = max(self.weights_mb.values())
+        else:
+            resident = sum(self.weights_mb.values())
+        return plan_batch(self.memory_budget_mb, resident, pixels, count, batch_size, 0.5 if self.precision == 'bf16' else 1.)
+
+    def set_attention_slicing(self, enabled: bool):
+        if enabled != self.attention_slicing:
+            self.unet.set_attention_slice('max' if enabled else None)
+            self.attention_slicing = enabled
+
+    def autocast(self):
+        if self.precision == 'bf16':
+            return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16)
+        return nullcontext()
+
+    def backend_name(self) -> str:
+        """Short description of how the model runs, e.g. bf16+channels_last."""
+        return '+'.join([self.precision] + [flag for flag, enabled in (('channels_last', self.channels_last), ('compile', self.compile_unet), ('fused', self.fuse_lora), ('tiny_vae', self.tiny_vae is not None), (f'{self.offload}_offload', self.offload is not None)) if enabled])
 
     def generate_image(self, input_image_path, output_dir, task: str = None) -> Image.Image:
         if not task:
             print('Task not specified')
             return None
-        
-        if task != self.task:
-            self.pipeline.unload_lora_weights()
-            model_path = self.get_lora_path(task)
-            self.unet, self.text_encoder = load_lora_weights(self.pipeline.unet, self.pipeline.text_encoder, os.path.join(os.path.dirname(__file__), model_path), self.device)
-            self.pipeline.unet = self.unet
-            self.pipeline.text_encoder = self.text_encoder
-
-        self.task = task
-
-        image_transforms = transforms.Compose([
-            transforms.Resize(512, interpolation=transforms.InterpolationMode.BILINEAR),
-            transforms.CenterCrop(512),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
-        ])
-        with torch.inference_mode():
-            with Image.open(input_image_path) as orig_img:
-                orig_img = orig_img.convert("RGB")
-                orig_img_tensor = image_transforms(orig_img).unsqueeze(0).to(self.device)
-
-                timesteps = torch.randint(self.max_timestep - 1, self.max_timestep, (1,), device=self.device).long()
-                original_image_embeds = self.vae.encode(orig_img_tensor).latent_dist.mode()
-                original_image_embeds = original_image_embeds * self.vae.config.scaling_factor
-
-                prompt = self.get_prompt(self.task)
-                text_inputs = tokenize_prompt(self.tokenizer, prompt).input_ids.to(self.device)
-                encoder_hidden_states = self.text_encoder(text_inputs)[0]
-
-                model_pred = self.unet(original_image_embeds, timesteps, encoder_hidden_states).sample
-                image = self.vae.decode(model_pred / self.vae.config.scaling_factor, return_dict=False)[0]
-
-                if self.task == 'depth':
-                    imax = image.max()
-                    imin = image.min()
-                    image = (image-imin)/(imax-imin)
-                    image = image.squeeze().mean(0)
-                    image = image.cpu().numpy() * 255.
-                    val_image = Image.fromarray(image.astype(np.uint8))
-                elif self.task == 'normal':
-                    image = tensor2np(image.clamp(-1.,1.).squeeze())
-                    val_image = Image.fromarray((255 - image).astype(np.uint8))
-                else:
-                    image = tensor2np(image.clamp(-1., 1.).squeeze())
-                    val_image = Image.fromarray(image)
+        return self.generate_images(input_image_path, [task], output_dir)[task]
+
+    def generate_images(self, input_image, tasks: list, output_dir=None, progress_callback=None, output_type: str = 'pil', tiled: bool = False, tile_overlap: int = 128, tile_batch_size: int = 4, resolution: int = 512, fast_vae: str = None) -> dict:
+        """Run several tasks on one image in a single batch. Returns a dict of task -> image.
+
+        input_image can be a path, a PIL image or an HxWxC numpy array (top row first,
+        floats in 0-1 or uint8). The image is encoded once, the unet runs over all tasks
+        as one batch with each sample routed through its own adapter, and the results
+        are decoded in one vae call.
+
+        With output_type 'np' the results are float32 arrays in 0-1 (HxW for depth,
+        HxWx3 otherwise) instead of 8 bit PIL images.
+
+        progress_callback(stage, progress) is called before each stage; it may raise
+        to abort the run.
+
+        With tiled, the image keeps its own size instead of being cropped to 512. The
+        latents are split into overlapping 512 pixel tiles which go through the unet
+        tile_batch_size at a time and are blended back with feathered weights, and the
+        vae encodes and decodes in tiles. Memory then depends on the tile batch rather
+        than on the image size.
+
+        Without tiling the image is cropped to resolution. The model is trained at 512;
+        256 takes about a quarter of the time and is good enough for a preview.
+
+        fast_vae runs the 'decode', 'encode' or 'both' vae stages through the tiny
+        autoencoder, which has to be loaded with tiny_vae.
+        """
+        return self.generate_batch([input_image], tasks, output_dir, progress_callback, output_type, tiled, tile_overlap, tile_batch_size, resolution=resolution, fast_vae=fast_vae)[0]
+
+    def generate_batch(self, input_images: list, tasks: list, output_dir=None, progress_callback=None, output_type: str = 'pil', tiled: bool = False, tile_overlap: int = 128, tile_batch_size: int = 4, batch_size: int = 8, resolution: int = 512, fast_vae: str = None) -> list:
+        """Run several tasks on several images. Returns one dict of task -> image per input image.
+
+        Without tiling all images are encoded in one vae call and every (image, task)
+        pair goes through the unet and the vae decoder in batches of batch_size.
+        See generate_images for the other arguments.
+
+        With a result_cache set, maps already generated for the same pixels, task and
+        model are loaded from it, and only the images missing a map run the model.
+
+        Safe to call from several threads, the model runs one batch at a time.
+        """
+        if fast_vae is not None and fast_vae not in FAST_VAE_STAGES:
+            raise ValueError(f'Unknown fast_vae {fast_vae}, expected one of {", ".join(FAST_VAE_STAGES)}')
+        if fast_vae and self.tiny_vae is None:
+            raise ValueError('fast_vae needs a tiny autoencoder, load the generator with tiny_vae')
+        tasks = list(dict.fromkeys(tasks))
+        if not tasks or not input_images:
+            return [{} for _ in input_images]
+
+        report_progress = progress_callback or (lambda stage, progress: None)
+        arrays = [{} for _ in input_images]
+        keys = None
+        if self.result_cache is not None:
+            with profiler.stage('result_cache_lookup'):
+                keys = [{task: self.result_key(image_hash, task, tiled, tile_overlap, resolution, fast_vae) for task in tasks} for image_hash in map(hash_image, input_images)]
+                for image_keys, image_arrays in zip(keys, arrays):
+                    for task, key in image_keys.items():
+                        cached = self.result_cache.get(key)
+                        if cached is not None:
+                            image_arrays[task] = cached
+
+        missing = [index for index, image_arrays in enumerate(arrays) if len(image_arrays) < len(tasks)]
+        self.last_peak_memory = None
+        if missing:
+            missing_tasks = [task for task in tasks if any(task not in arrays[index] for index in missing)]
+            with self.lease(), self._run_lock, PeakMemory() as peak:
+                computed = self.run_batch([input_images[index] for index in missing], missing_tasks, report_progress, tiled, tile_overlap, tile_batch_size, batch_size, resolution, fast_vae)
+            self.last_peak_memory = peak.result()
+            for index, image_arrays in zip(missing, computed):
+                for task, image in image_arrays.items():
+                    if task in arrays[index]:
+                        continue
+                    arrays[index][task] = image
+                    if keys is not None:
+                        with profiler.stage('result_cache_store'):
+                            self.result_cache.put(keys[index][task], image)
+
+        results = []
+        for image_index, input_image in enumerate(input_images):
+            result = {}
+            for task in tasks:
+                image = arrays[image_index][task]
+                result[task] = image if output_type == 'np' else to_image(image)
                 if output_dir:
-                    pred_path = f'{output_dir}/{Path(input_image_path).stem}_{self.task}.png'
-                    val_image.save(pred_path)
-                return val_image
+                    if isinstance(input_image, (str, os.PathLike)):
+                        stem = Path(input_image).stem
+                    else:
+                        stem = 'intrinsic_render' if len(input_images) == 1 else f'intrinsic_render_{image_index}'
+                    with profiler.stage('save_png'):
+                        to_image(image).save(f'{output_dir}/{stem}_{task}.png')
+            results.append(result)
+        report_progress('done', 1.0)
+        return results
+
+    @contextmanager
+    def lease(self):
+        """Mark the generator in use while the block runs, so the GeneratorManager doesn't release it meanwhile."""
+        with self._lease_lock:
+            self.active_batches += 1
+        try:
+            yield
+        finally:
+            with self._lease_lock:
+                self.active_batches -= 1
+                self.last_used = time.monotonic()
+
+    @property
+    def in_use(self) -> bool:
+        return self.active_batches > 0
+
+    def result_key(self, image_hash: str, task: str, tiled: bool, tile_overlap: int, resolution: int = 512, fast_vae: str = None) -> str:
+        """Result cache key for one map: input pixels, task, checkpoint, LoRA file, size, dtype, vae and memory budget slicing and tiling."""
+        config_hash = file_fingerprint(self.config) if self.config else None
+        size = f'tiled{tile_overlap}' if tiled else f'crop{resolution}'
+        parts = (image_hash, task, self.prompt_cache.checkpoint_hash, config_hash, file_fingerprint(get_lora_path(task)), size, self.dtype, self.precision, self.fuse_lora)
+        if fast_vae:
+            parts += (fast_vae, file_fingerprint(tiny_vae_file(self.tiny_vae_path)))
+        # slicing and the vae tile size change the maps, and only depend on the budget and the image size
+        plan = self.plan_memory(512 * 512 if tiled else resolution * resolution, 1, 1)
+        if plan['attention_slicing'] or plan['tile_size']:
+            parts += ('sliced' if plan['attention_slicing'] else 'full', plan['tile_size'])
+        return self.result_cache.key(*parts)
+
+    def run_batch(self, input_images: list, tasks: list, report_progress, tiled: bool, tile_overlap: int, tile_batch_size: int, batch_size: int, resolution: int = 512, fast_vae: str = None) -> list:
+        """Run the model. Returns one dict of task -> float32 array per input image."""
+        encoder = self.tiny_vae if fast_vae in ('encode', 'both') else self.vae
+        decoder = self.tiny_vae if fast_vae in ('decode', 'both') else self.vae
+        vaes = {encoder, decoder}
+        # tiled runs the unet on 512 pixel tiles
+        plan = self.plan_memory(512 * 512 if tiled else resolution * resolution, len(input_images), tile_batch_size if tiled else batch_size)
+        self.set_attention_slicing(plan['attention_slicing'])
+        tile_sizes = {vae: (vae.tile_sample_min_size, vae.tile_latent_min_size) for vae in vaes}
+        report_progress('encode', 0.0)
+        if tiled or plan['tile_size']:
+            for vae in vaes:
+                vae.enable_tiling()
+                if plan['tile_size']:
+                    sample_size, latent_size = tile_sizes[vae]
+                    vae.tile_sample_min_size = min(sample_size, plan['tile_size'])
+                    vae.tile_latent_min_size = vae.tile_sample_min_size // (sample_size // latent_size)
+        try:
+            with torch.inference_mode(), self.autocast():
+                with profiler.stage('encode_prompt'):
+                    encoder_hidden_states = torch.cat([self.encode_prompt(task) for task in tasks])
+                if tiled:
+                    images = []
+                    for index, input_image in enumerate(input_images):
+                        report_progress('unet', 0.25 + 0.5 * index / len(input_images))
+                        with self.on_device(encoder):
+                            latents = self.encode_images(self.load_image_tensor(input_image, crop=False), encoder)
+                        with self.on_device(self.unet):
+                            model_pred = self.run_unet_tiled(latents, encoder_hidden_states, tasks, tile_overlap // 8, plan['batch_size'])
+                        del latents
+                        self.release_memory()
+                        # one task at a time keeps the decode bounded by the vae tile size
+                        with self.on_device(decoder):
+                            images.append(torch.cat([self.decode_latents(pred.unsqueeze(0), decoder) for pred in model_pred]))
+                        del model_pred
+                        self.release_memory()
+                    report_progress('decode', 0.75)
+                else:
+                    with self.on_device(encoder):
+                        latents = torch.cat([
+                            self.encode_images(torch.cat([self.load_image_tensor(input_image, resolution=resolution) for input_image in chunk]), encoder)
+                            for chunk in batched(input_images, plan['encode_batch_size'])])
+                    self.release_memory()
+                    samples = [(image_index, task_index) for image_index in range(len(input_images)) for task_index in range(len(tasks))]
+                    report_progress('unet', 0.25)
+                    with self.on_device(self.unet):
+                        model_pred = torch.cat([
+                            self.run_unet(
+                                torch.cat([latents[image_index:image_index + 1] for image_index, _ in chunk]),
+                                torch.cat([encoder_hidden_states[task_index:task_index + 1] for _, task_index in chunk]),
+                                [tasks[task_index] for _, task_index in chunk])
+                            for chunk in batched(samples, max(1, plan['batch_size']))])
+                    del latents
+                    self.release_memory()
+                    report_progress('decode', 0.75)
+                    with self.on_device(decoder):
+                        decoded = torch.cat([self.decode_latents(chunk, decoder) for chunk in model_pred.split(max(1, plan['decode_batch_size']))])
+                    del model_pred
+                    images = list(decoded.split(len(tasks)))
+        finally:
+            for vae, (sample_size, latent_size) in tile_sizes.items():
+                vae.tile_sample_min_size = sample_size
+                vae.tile_latent_min_size = latent_size
+            if tiled or plan['tile_size']:
+                for vae in vaes:
+                    vae.disable_tiling()
+        with profiler.stage('postprocess'):
+            return [{task: postprocess_array(task, image[task_index:task_index + 1]) for task_index, task in enumerate(tasks)} for image in images]
+
+    @profiler.timed('vae_encode', torch_profile=True)
+    def encode_images(self, image_tensor, vae=None):
+        vae = vae or self.vae
+        output = vae.encode(image_tensor)
+        # the tiny autoencoder has no distribution, and a scaling factor of 1 as its latents are already scaled
+        latents = output.latents if isinstance(vae, AutoencoderTiny) else output.latent_dist.mode()
+        return latents * vae.config.scaling_factor
+
+    @profiler.timed('vae_decode', torch_profile=True)
+    def decode_latents(self, latents, vae=None):
+        vae = vae or self.vae
+        return vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+
+    @profiler.timed('preprocess')
+    def load_image_tensor(self, input_image, crop: bool = True, resolution: int = 512):
+        if crop:
+            image_transforms = transforms.Compose([
+                transforms.Resize(resolution, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True),
+                transforms.CenterCrop(resolution),
+                transforms.Normalize([0.5], [0.5]),
+            ])
+        else:
+            image_transforms = transforms.Compose([
+                ResizeToMultiple(min_size=512, multiple=8),
+                transforms.Normalize([0.5], [0.5]),
+            ])
+        if isinstance(input_image, np.ndarray):
+            image = input_image[..., :3]
+            if image.dtype == np.uint8:
+                image = image.astype(np.float32) / 255.
+            image_tensor = torch.from_numpy(np.ascontiguousarray(image, dtype=np.float32)).permute(2, 0, 1)
+        elif isinstance(input_image, Image.Image):
+            image_tensor = transforms.functional.to_tensor(input_image.convert("RGB"))
+        else:
+            with Image.open(input_image) as orig_img:
+                image_tensor = transforms.functional.to_tensor(orig_img.convert("RGB"))
+        return image_transforms(image_tensor).unsqueeze(0).to(self.device, self.dtype)
+
+    def encode_prompt(self, task: str):
+        embedding = self.prompt_cache.get(task)
+        if embedding is None:
+            if self.text_encoder is None:
+                raise RuntimeError(f'No cached prompt embedding for {task} and the text encoder is not loaded. Release the model and render again.')
+            self.lora_registry.activate(task)
+            text_inputs = tokenize_prompt(self.tokenizer, self.get_prompt(task)).input_ids.to(self.device)
+            with self.on_device(self.text_encoder):
+                embedding = self.text_encoder(text_inputs)[0]
+            self.prompt_cache.put(task, embedding)
+        return embedding.to(self.device, self.dtype)
+
+    def run_unet(self, latents, encoder_hidden_states, tasks: list):
+        timesteps = torch.full((len(tasks),), self.max_timestep - 1, device=self.device, dtype=torch.long)
+        if len(set(tasks)) == 1:
+            with profiler.stage('lora_switch'):
+                switch_time = self.lora_registry.activate(tasks[0])
+            if switch_time:
+                logger.debug('Switched to %s adapter in %.2f ms', tasks[0], switch_time * 1000)
+            unet = self.compiled_unet or self.unet
+            with profiler.stage('unet', torch_profile=True):
+                return unet(latents, timesteps, encoder_hidden_states).sample
+        if self.fuse_lora:
+            # fused weights hold one task at a time, so run each task's samples on their own
+            output = None
+            for task in dict.fromkeys(tasks):
+                indices = [index for index, t in enumerate(tasks) if t == task]
+                pred = self.run_unet(latents[indices], encoder_hidden_states[indices], [task] * len(indices))
+                if output is None:
+                    output = pred.new_empty((len(tasks),) + pred.shape[1:])
+                output[indices] = pred
+            return output
+        with self.lora_registry.routed(tasks), profiler.stage('unet', torch_profile=True):
+            return self.unet(latents, timesteps, encoder_hidden_states).sample
+
+    def run_unet_tiled(self, latents, encoder_hidden_states, tasks: list, overlap: int, batch_size: int, tile_size: int = 64):
+        """Run the unet over overlapping latent tiles of one image for every task."""
+        _, channels, height, width = latents.shape
+        tile_height = min(tile_size, height)
+        tile_width = min(tile_size, width)
+        tiles = [(y, x) for y in tile_starts(height, tile_height, overlap) for x in tile_starts(width, tile_width, overlap)]
+        feather = feather_weights(tile_height, tile_width, overlap).to(latents.device, latents.dtype)
+
+        weights = torch.zeros((1, 1, height, width), device=latents.device, dtype=latents.dtype)
+        for y, x in tiles:
+            weights[..., y:y + tile_height, x:x + tile_width] += feather
+        output = torch.zeros((len(tasks), channels, height, width), device=latents.device, dtype=latents.dtype)
+
+        jobs = [(index, y, x) for index in range(len(tasks)) for y, x in tiles]
+        for chunk in batched(jobs, batch_size):
+            tile_latents = torch.cat([latents[:, :, y:y + tile_height, x:x + tile_width] for _, y, x in chunk])
+            states = torch.cat([encoder_hidden_states[index:index + 1] for index, _, _ in chunk])
+            pred = self.run_unet(tile_latents, states, [tasks[index] for index, _, _ in chunk])
+            for (index, y, x), tile_pred in zip(chunk, pred):
+                output[index, :, y:y + tile_height, x:x + tile_width] += tile_pred * feather
+        return output / weights
 
     def get_prompt(self, task: str):
         if task == 'normal':
@@ -103,26 +523,35 @@ class IntrinsicLoRAImageGenerator:
         else:
             raise NotImplementedError('Not implemented')
         
-    def get_lora_path(self, task: str):
-        if task == 'normal':
-            return "pretrained_weights/intrinsic_lora_normal.safetensors"
-        elif task == 'depth':
-            return "pretrained_weights/intrinsic_lora_depth.safetensors"
-        elif task == 'albedo':
-            return "pretrained_weights/intrinsic_lora_albedo.safetensors"
-        elif task == 'shading':
-            return "pretrained_weights/intrinsic_lora_shading.safetensors"
-        else:
-            raise NotImplementedError('Not implemented')
-        
     def close(self):
-        self.pipeline.unload_lora_weights()
-        self.pipeline.maybe_free_model_hooks()
-        del self.pipeline
+        if self.unet is None:
+            return
+        self.lora_registry.unload()
+        self.lora_registry = None
+        self.unet = None
+        self.compiled_unet = None
+        self.text_encoder = None
+        self.tokenizer = None
+        self.vae = None
+        self.tiny_vae = None
         gc.collect()
         if self.device == 'cuda':
             torch.cuda.empty_cache()
         
+def tiny_vae_file(path: str) -> str:
+    """The weights file of a tiny autoencoder given as a file or as a diffusers folder."""
+    if os.path.isdir(path):
+        return os.path.join(path, 'diffusion_pytorch_model.safetensors')
+    return path
+
+def load_tiny_vae(path: str, dtype) -> AutoencoderTiny:
+    """Load a tiny autoencoder from a diffusers folder, or from a weights file with the default taesd config."""
+    if os.path.isdir(path):
+        return AutoencoderTiny.from_pretrained(path, torch_dtype=dtype)
+    vae = AutoencoderTiny()
+    vae.load_state_dict(load_file(path))
+    return vae.to(dtype=dtype).eval()
+
 def tokenize_prompt(tokenizer, prompt, tokenizer_max_length=None):
     if tokenizer_max_length is not None:
         max_length = tokenizer_max_length
@@ -138,18 +567,58 @@ def tokenize_prompt(tokenizer, prompt, tokenizer_max_length=None):
     )
     return text_inputs
 
-def tensor2np(tensor):
-    return (255*(tensor.cpu().permute(1,2,0).numpy()*0.5+0.5)).astype(np.uint8)
+def batched(items: list, size: int):
+    size = max(1, size)
+    return [items[start:start + size] for start in range(0, len(items), size)]
 
-def load_lora_weights(unet, text_encoder, input_dir, device):
-    lora_state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(input_dir)
+class ResizeToMultiple:
+    """Resize so the short side is at least min_size and both sides are a multiple of multiple."""
 
-    LoraLoaderMixin.load_lora_into_unet(
-        lora_state_dict, network_alphas=network_alphas, unet=unet
-    )
-    LoraLoaderMixin.load_lora_into_text_encoder(
-        lora_state_dict, network_alphas=network_alphas, text_encoder=text_encoder
-    )
-    unet.to(device)
-    text_encoder.to(device)
-    return unet, text_encoder
\ No newline at end of file
+    def __init__(self, min_size: int, multiple: int):
+        self.min_size = min_size
+        self.multiple = multiple
+
+    def __call__(self, image):
+        height, width = image.shape[-2:]
+        scale = max(1., self.min_size / min(height, width))
+        size = [max(self.multiple, round(side * scale / self.multiple) * self.multiple) for side in (height, width)]
+        if size == [height, width]:
+            return image
+        return transforms.functional.resize(image, size, interpolation=transforms.InterpolationMode.BILINEAR, antialias=True)
+
+def tile_starts(size: int, tile: int, overlap: int) -> list:
+    step = max(1, tile - overlap)
+    starts = list(range(0, max(size - tile, 0) + 1, step))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+def feather_weights(height: int, width: int, overlap: int):
+    """Blend weights for a tile, ramping up linearly over the overlap at each edge."""
+    def ramp(size):
+        position = torch.arange(size, dtype=torch.float32)
+        return torch.minimum(torch.minimum(position + 1, size - position), torch.tensor(overlap + 1.)) / (overlap + 1)
+    return ramp(height)[:, None] * ramp(width)[None, :]
+
+def postprocess_array(task: str, image) -> np.ndarray:
+    """Turn a decoded vae sample into a float32 array in 0-1."""
+    image = image.float()
+    if task == 'depth':
+        imax = image.max()
+        imin = image.min()
+        image = (image-imin)/(imax-imin)
+        image = image.squeeze().mean(0)
+        return image.float().cpu().numpy()
+    elif task == 'normal':
+        return 1. - tensor2np(image.clamp(-1.,1.).squeeze())
+    else:
+        return tensor2np(image.clamp(-1., 1.).squeeze())
+
+def postprocess(task: str, image) -> Image.Image:
+    return to_image(postprocess_array(task, image))
+
+def to_image(array: np.ndarray) -> Image.Image:
+    return Image.fromarray((array.clip(0., 1.) * 255.).round().astype(np.uint8))
+
+def tensor2np(tensor):
+    return tensor.float().cpu().permute(1,2,0).numpy()*0.5+0.5
@@ -0,0 +1,132 @@
+import os
+import time
+from contextlib import contextmanager
+from functools import partial
+from diffusers.loaders import LoraLoaderMixin
+from diffusers.utils import recurse_remove_peft_layers
+from peft.tuners.tuners_utils import BaseTunerLayer
+
+WEIGHTS_DIR = os.path.join(os.path.dirname(__file__), "pretrained_weights")
+
+LORA_FILES = {
+    'normal': "intrinsic_lora_normal.safetensors",
+    'depth': "intrinsic_lora_depth.safetensors",
+    'albedo': "intrinsic_lora_albedo.safetensors",
+    'shading': "intrinsic_lora_shading.safetensors",
+}
+
+def get_lora_path(task: str):
+    if task not in LORA_FILES:
+        raise NotImplementedError('Not implemented')
+    return os.path.join(WEIGHTS_DIR, LORA_FILES[task])
+
+class LoraRegistry:
+    """Holds the task LoRAs as named adapters on the unet (and text encoder).
+
+    Each LoRA is read once; switching task only changes which adapter is active.
+    """
+
+    def __init__(self, unet, text_encoder, device):
+        self.unet = unet
+        self.text_encoder = text_encoder
+        self.device = device
+        self.adapters = []
+        self.active = None
+        self.load_times = {}
+        self.last_switch_time = 0.0
+
+    def load(self, task: str):
+        if task in self.adapters:
+            return
+        start = time.perf_counter()
+        load_lora_weights(self.unet, self.text_encoder, get_lora_path(task), self.device, adapter_name=task)
+        self.adapters.append(task)
+        self.load_times[task] = time.perf_counter() - start
+        # loading may have changed which adapter the layers use
+        self.active = None
+
+    def load_all(self):
+        """Load every task LoRA found in the weights folder."""
+        for task in LORA_FILES:
+            if os.path.exists(get_lora_path(task)):
+                self.load(task)
+
+    def activate(self, task: str) -> float:
+        """Make task the active adapter. Returns the switch time in seconds."""
+        self.load(task)
+        if task == self.active:
+            self.last_switch_time = 0.0
+            return self.last_switch_time
+        start = time.perf_counter()
+        set_active_adapter(self.unet, task)
+        if self.text_encoder is not None:
+            set_active_adapter(self.text_encoder, task)
+        self.active = task
+        self.last_switch_time = time.perf_counter() - start
+        return self.last_switch_time
+
+    @contextmanager
+    def routed(self, tasks: list):
+        """Route each sample of a unet batch through the adapter of its task.
+
+        tasks holds the task for every sample in the batch. The base layers run
+        once for the whole batch and each task's low-rank update is added to its
+        own samples only.
+        """
+        for task in tasks:
+            self.load(task)
+        groups = {task: [index for index, t in enumerate(tasks) if t == task] for task in dict.fromkeys(tasks)}
+        layers = [module for module in self.unet.modules() if isinstance(module, BaseTunerLayer)]
+        handles = []
+        try:
+            for layer in layers:
+                layer.enable_adapters(False)
+                handles.append(layer.register_forward_hook(partial(add_routed_lora, groups=groups)))
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+            for layer in layers:
+                layer.enable_adapters(True)
+            self.active = None
+
+    def unload(self):
+        recurse_remove_peft_layers(self.unet)
+        if hasattr(self.unet, "peft_config"):
+            del self.unet.peft_config
+        if self.text_encoder is not None:
+            recurse_remove_peft_layers(self.text_encoder)
+            if hasattr(self.text_encoder, "peft_config"):
+                del self.text_encoder.peft_config
+        self.adapters = []
+        self.active = None
+
+def set_active_adapter(model, adapter_name: str):
+    for module in model.modules():
+        if isinstance(module, BaseTunerLayer):
+            module.set_adapter(adapter_name)
+
+def add_routed_lora(module, args, output, groups):
+    x = args[0]
+    for task, indices in groups.items():
+        if task not in module.lora_A:
+            continue
+        lora_A = module.lora_A[task]
+        sub_batch = x[indices].to(lora_A.weight.dtype)
+        delta = module.lora_B[task](lora_A(module.lora_dropout[task](sub_batch))) * module.scaling[task]
+        output[indices] += delta.to(output.dtype)
+    return output
+
+def load_lora_weights(unet, text_encoder, input_dir, device, adapter_name=None):
+    lora_state_dict, network_alphas = LoraLoaderMixin.lora_state_dict(input_dir)
+
+    LoraLoaderMixin.load_lora_into_unet(
+        lora_state_dict, network_alphas=network_alphas, unet=unet, adapter_name=adapter_name
+    )
+    unet.to(device)
+    if text_encoder is not None:
+        LoraLoaderMixin.load_lora_into_text_encoder(
+            lora_state_dict, network_alphas=network_alphas, text_encoder=text_encoder, adapter_name=adapter_name
+        )
+        text_encoder.to(device)
+    return unet, text_encoder
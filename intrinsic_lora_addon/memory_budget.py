@@ -0,0 +1,71 @@
+"""
+Choosing how the model runs within a memory budget.
+
+The estimates are for Stable Diffusion 1.5 activations in fp32 at 512x512 and
+scale with the number of pixels; bf16 autocast halves them. They err on the
+high side. Every render records the peak it actually reached
+(IntrinsicLoRAImageGenerator.last_peak_memory), which is what to size a machine by.
+"""
+import math
+
+REFERENCE_PIXELS = 512 * 512
+# one unet sample, without the attention scores
+UNET_MB = 900
+# attention scores of one unet sample; sliced attention runs one head at a time
+ATTENTION_MB = 640
+ATTENTION_HEADS = 8
+VAE_ENCODE_MB = 1400
+VAE_DECODE_MB = 2800
+MIN_TILE_SIZE = 128
+
+def module_mb(module) -> float:
+    """Memory taken by a torch module's parameters and buffers."""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) / 2**20
+
+def plan_offload(budget_mb: float, weights_mb: dict, device_type: str, fused: bool = False):
+    """None, 'model' or 'sequential' CPU offload for models of weights_mb (name -> MB) on a CUDA device.
+
+    Model offload keeps one model at a time on the device, sequential offload
+    streams the layers of each model and is much slower. Fused LoRA weights are
+    swapped on the device, so they can't be offloaded.
+    """
+    if not budget_mb or device_type != 'cuda' or fused or not weights_mb:
+        return None
+    if sum(weights_mb.values()) + UNET_MB <= budget_mb:
+        return None
+    if max(weights_mb.values()) + UNET_MB <= budget_mb:
+        return 'model'
+    return 'sequential'
+
+def plan_batch(budget_mb: float, resident_mb: float, pixels: int, count: int, batch_size: int, activation_scale: float = 1.) -> dict:
+    """How to run count images of pixels each, with resident_mb of the budget taken by the weights.
+
+    Returns the images per vae encode, unet samples per call, latents per vae
+    decode, whether to slice attention and the vae tile size in pixels (None to
+    not tile). Without a budget that's batch_size of each and no slicing or tiling.
+    """
+    if not budget_mb:
+        return {'encode_batch_size': max(1, min(count, batch_size)), 'batch_size': batch_size, 'decode_batch_size': batch_size, 'attention_slicing': False, 'tile_size': None}
+    available = max(budget_mb - resident_mb, 1.)
+    scale = pixels / REFERENCE_PIXELS * activation_scale
+    unet = (UNET_MB + ATTENTION_MB) * scale
+    attention_slicing = unet > available
+    if attention_slicing:
+        unet = (UNET_MB + ATTENTION_MB / ATTENTION_HEADS) * scale
+    encode = VAE_ENCODE_MB * scale
+    decode = VAE_DECODE_MB * scale
+    tile_size = None
+    if decode > available:
+        # the vae then runs on tiles of tile_size pixels, one at a time
+        tile_size = max(MIN_TILE_SIZE, int(512 * math.sqrt(available / (VAE_DECODE_MB * activation_scale))) // 64 * 64)
+        tile_scale = tile_size * tile_size / REFERENCE_PIXELS * activation_scale
+        encode = VAE_ENCODE_MB * tile_scale
+        decode = VAE_DECODE_MB * tile_scale
+    return {
+        'encode_batch_size': int(min(max(available // encode, 1), max(1, count))),
+        'batch_size': int(min(max(available // unet, 1), batch_size)),
+        'decode_batch_size': int(min(max(available // decode, 1), batch_size)),
+        'attention_slicing': attention_slicing,
+        'tile_size': tile_size,
+    }
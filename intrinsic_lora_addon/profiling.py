@@ -0,0 +1,258 @@
+"""
+Per-stage timing and memory instrumentation.
+
+Code marks its stages with
+
+    with profiler.stage('vae_encode'):
+        ...
+
+or decorates a function with @profiler.timed() to make each call a stage. A
+stage records wall time, CPU time and the peak resident memory seen while it
+ran. Stages are only recorded inside profiler.run(), which starts a new
+trace, so code paths run outside a render cost a context manager and nothing
+else. The last trace can be summarized per stage or exported in the Chrome
+trace format (chrome://tracing, https://ui.perfetto.dev).
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "intrinsic_lora", "profiles")
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes, 0 where it can't be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def reset_peak_rss() -> bool:
+    """Reset the kernel's peak resident set size of this process. Returns False where that isn't possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes since the last reset_peak_rss(), 0 where it can't be read."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+def cuda_peak_memory():
+    """Peak CUDA memory allocated by torch, if torch is in use with CUDA."""
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda.max_memory_allocated()
+
+def reset_cuda_peak_memory():
+    if cuda_peak_memory() is not None:
+        sys.modules['torch'].cuda.reset_peak_memory_stats()
+
+class PeakMemory:
+    """Peak resident memory of the process, and CUDA memory if torch uses it, while the block runs.
+
+    On Linux the kernel's high-water mark is reset at the start, so even short
+    peaks count; elsewhere the resident set size is sampled.
+    """
+
+    def __init__(self, sample_interval: float = 0.01):
+        self.sample_interval = sample_interval
+        self.peak_rss = 0
+        self.gpu_peak = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._kernel_peak = False
+
+    def __enter__(self):
+        self.peak_rss = current_rss()
+        reset_cuda_peak_memory()
+        self._kernel_peak = reset_peak_rss() and peak_rss() > 0
+        if not self._kernel_peak:
+            self._sampler = threading.Thread(target=self.sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        self.peak_rss = max(self.peak_rss, peak_rss() if self._kernel_peak else current_rss())
+        self.gpu_peak = cuda_peak_memory()
+
+    def sample(self):
+        while not self._stop.wait(self.sample_interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def result(self) -> dict:
+        """The peaks in MB, gpu_peak_mb is None without CUDA."""
+        return {'peak_rss_mb': self.peak_rss / 2**20, 'gpu_peak_mb': self.gpu_peak / 2**20 if self.gpu_peak is not None else None}
+
+def max_peak_memory(*peaks):
+    """The highest of several PeakMemory results, skipping None. None if there are none."""
+    peaks = [peak for peak in peaks if peak]
+    if not peaks:
+        return None
+    gpu_peaks = [peak['gpu_peak_mb'] for peak in peaks if peak.get('gpu_peak_mb') is not None]
+    return {'peak_rss_mb': max(peak['peak_rss_mb'] for peak in peaks), 'gpu_peak_mb': max(gpu_peaks) if gpu_peaks else None}
+
+class Profiler:
+
+    def __init__(self, sample_interval: float = 0.01):
+        self.sample_interval = sample_interval
+        self.spans = []
+        self.samples = []
+        self.name = None
+        # torch profiler traces of the model stages are written here when set
+        self.torch_trace_dir = None
+        self._open = []
+        self._depth = threading.local()
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop = threading.Event()
+
+    @property
+    def active(self) -> bool:
+        return self.name is not None
+
+    @contextmanager
+    def run(self, name: str):
+        """Start a new trace and record stages until the block ends. Nested runs just add a stage."""
+        if self.active:
+            with self.stage(name):
+                yield
+            return
+        with self._lock:
+            self.spans = []
+            self.samples = []
+            self.name = name
+        reset_cuda_peak_memory()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self.sample, daemon=True)
+        self._sampler.start()
+        try:
+            with self.stage(name):
+                yield
+        finally:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+            self.name = None
+
+    @contextmanager
+    def stage(self, name: str, torch_profile: bool = False):
+        """Record one stage. With torch_profile, the stage also runs under the torch profiler if enabled."""
+        if not self.active:
+            yield
+            return
+        depth = getattr(self._depth, 'value', 0)
+        self._depth.value = depth + 1
+        rss = current_rss()
+        span = {'name': name, 'start': time.time(), 'depth': depth, 'thread': threading.get_ident(), 'pid': os.getpid(), 'peak_rss': rss}
+        with self._lock:
+            self._open.append(span)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            with self.torch_profile(name) if torch_profile else nullcontext():
+                yield
+        finally:
+            span['wall'] = time.perf_counter() - wall
+            span['cpu'] = time.process_time() - cpu
+            span['peak_rss'] = max(span['peak_rss'], current_rss())
+            gpu = cuda_peak_memory()
+            if gpu is not None:
+                # peak since the run or the last model batch started
+                span['gpu_peak'] = gpu
+            self._depth.value = depth
+            with self._lock:
+                self._open.remove(span)
+                self.spans.append(span)
+
+    def timed(self, name: str = None, torch_profile: bool = False):
+        """Decorator recording every call of a function as a stage, named after the function by default."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__, torch_profile):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def torch_profile(self, name: str):
+        if not self.torch_trace_dir:
+            return nullcontext()
+        return torch_profiler(os.path.join(self.torch_trace_dir, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_{len(self.spans)}.json"))
+
+    def sample(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = current_rss()
+            with self._lock:
+                self.samples.append((time.time(), rss))
+                for span in self._open:
+                    span['peak_rss'] = max(span['peak_rss'], rss)
+
+    def add_spans(self, spans: list):
+        """Add stages recorded elsewhere, e.g. in the inference worker process."""
+        if not self.active:
+            return
+        depth = getattr(self._depth, 'value', 0)
+        with self._lock:
+            self.spans.extend(dict(span, depth=span['depth'] + depth) for span in spans)
+
+    def summary(self) -> list:
+        """Stages of the last trace in the order they started, with repeated stages added up."""
+        stages = {}
+        for span in sorted(self.spans, key=lambda span: span['start']):
+            entry = stages.setdefault(span['name'], {'name': span['name'], 'depth': span['depth'], 'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0})
+            entry['count'] += 1
+            entry['wall'] += span['wall']
+            entry['cpu'] += span['cpu']
+            entry['peak_rss'] = max(entry['peak_rss'], span['peak_rss'])
+            if 'gpu_peak' in span:
+                entry['gpu_peak'] = max(entry.get('gpu_peak', 0), span['gpu_peak'])
+        return list(stages.values())
+
+    def chrome_trace(self) -> dict:
+        events = []
+        for span in self.spans:
+            args = {'cpu_ms': span['cpu'] * 1000, 'peak_rss_mb': span['peak_rss'] / 2**20}
+            if 'gpu_peak' in span:
+                args['gpu_peak_mb'] = span['gpu_peak'] / 2**20
+            events.append({'name': span['name'], 'ph': 'X', 'ts': span['start'] * 1e6, 'dur': span['wall'] * 1e6, 'pid': span['pid'], 'tid': span['thread'], 'args': args})
+        pid = os.getpid()
+        events.extend({'name': 'rss', 'ph': 'C', 'ts': timestamp * 1e6, 'pid': pid, 'args': {'MB': rss / 2**20}} for timestamp, rss in self.samples)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path: str):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+@contextmanager
+def torch_profiler(path: str):
+    """Run the block under torch.profiler and write its Chrome trace to path."""
+    import torch
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True) as torch_profile:
+        yield
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch_profile.export_chrome_trace(path)
+
+profiler = Profiler()
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import threading
+from safetensors.torch import load_file, save_file
+from intrinsic_lora_addon.lora_registry import WEIGHTS_DIR, get_lora_path
+
+EMBEDDINGS_DIR = os.path.join(WEIGHTS_DIR, "prompt_embeddings")
+FINGERPRINTS_FILE = os.path.join(WEIGHTS_DIR, "fingerprints.json")
+
+_fingerprints = None
+_fingerprints_lock = threading.Lock()
+
+def file_fingerprint(path, chunk_size=8 << 20) -> str:
+    """SHA-256 of a whole (possibly multi-GB) weights file.
+
+    Fine-tunes of one model can share most of their bytes, so all of the file is
+    hashed. That happens once per file: the digest is kept in FINGERPRINTS_FILE,
+    keyed on the path, size and mtime, and hashed again only when those change.
+    """
+    global _fingerprints
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    with _fingerprints_lock:
+        if _fingerprints is None:
+            try:
+                with open(FINGERPRINTS_FILE) as f:
+                    _fingerprints = json.load(f)
+            except (OSError, ValueError):
+                _fingerprints = {}
+        entry = _fingerprints.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['digest']
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()[:16]
+    with _fingerprints_lock:
+        _fingerprints[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest}
+        try:
+            os.makedirs(os.path.dirname(FINGERPRINTS_FILE), exist_ok=True)
+            temp_path = f"{FINGERPRINTS_FILE}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(_fingerprints, f, indent=2)
+            os.replace(temp_path, FINGERPRINTS_FILE)
+        except OSError:
+            # a read-only weights folder just hashes again next session
+            pass
+    return digest
+
+class PromptEmbeddingCache:
+    """Text encoder outputs for the fixed task prompts, stored as safetensors files.
+
+    Entries are keyed on (checkpoint hash, LoRA file hash, task), so a changed
+    checkpoint or LoRA simply misses instead of returning stale embeddings.
+    """
+
+    def __init__(self, checkpoint_path, directory=EMBEDDINGS_DIR):
+        self.checkpoint_hash = file_fingerprint(checkpoint_path)
+        self.directory = directory
+        self.embeddings = {}
+
+    def key(self, task: str) -> str:
+        return f"{self.checkpoint_hash}_{file_fingerprint(get_lora_path(task))}_{task}"
+
+    def path(self, task: str) -> str:
+        return os.path.join(self.directory, f"{self.key(task)}.safetensors")
+
+    def get(self, task: str):
+        key = self.key(task)
+        if key not in self.embeddings:
+            path = self.path(task)
+            if not os.path.exists(path):
+                return None
+            self.embeddings[key] = load_file(path)["embedding"]
+        return self.embeddings[key]
+
+    def put(self, task: str, embedding):
+        embedding = embedding.detach().float().cpu().contiguous()
+        self.embeddings[self.key(task)] = embedding
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(task)
+        save_file({"embedding": embedding}, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    def has_all(self, tasks) -> bool:
+        return all(self.get(task) is not None for task in tasks)
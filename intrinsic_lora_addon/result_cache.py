@@ -0,0 +1,156 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+# bump when the postprocessing of the maps changes, so older entries miss
+CACHE_VERSION = 1
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "intrinsic_lora", "results")
+
+def hash_image(input_image) -> str:
+    """Hash of an input image's pixels. Accepts the same inputs as generate_batch."""
+    sha = hashlib.sha256()
+    if isinstance(input_image, np.ndarray):
+        image = np.ascontiguousarray(input_image)
+        sha.update(f"{image.shape}{image.dtype.str}".encode())
+        sha.update(image.data)
+    elif not isinstance(input_image, (str, os.PathLike)):
+        # a PIL image
+        sha.update(f"{input_image.size}{input_image.mode}".encode())
+        sha.update(input_image.tobytes())
+    else:
+        with open(input_image, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+class ResultCache:
+    """Generated maps stored as .npy files, keyed by a hash of everything that decides them.
+
+    The directory is bounded to max_size_mb and the least recently used entries are
+    evicted first; a hit touches the file's mtime. Entries are written to a temporary
+    file and renamed into place, so several processes or machines can share one
+    directory.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_size_mb: float = 2048):
+        self.directory = directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, *parts) -> str:
+        return hashlib.sha256("|".join(str(part) for part in (CACHE_VERSION,) + parts).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+    def get(self, key: str):
+        path = self.path(key)
+        try:
+            array = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # missing, evicted by another process meanwhile, or a broken file
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return array
+
+    def put(self, key: str, array: np.ndarray):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.asarray(array, dtype=np.float32))
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = self.scan_size()
+            else:
+                self._size += os.path.getsize(path)
+            if self._size > self.max_size:
+                self.evict()
+
+    def entries(self) -> list:
+        """(mtime, size, path) of every entry, oldest first."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def scan_size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # rescanned, since other processes sharing the directory add and evict too
+        entries = self.entries()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self) -> int:
+        """Remove every entry. Returns the number of bytes freed."""
+        with self._lock:
+            freed = 0
+            for _, size, path in self.entries():
+                try:
+                    os.remove(path)
+                    freed += size
+                except OSError:
+                    pass
+            self._size = 0
+            return freed
+
+    def stats(self, scan: bool = True) -> dict:
+        """Hit and eviction counts and the directory size.
+
+        The size is scanned once and then kept up to date by put() and evict(). Without
+        scan, size_mb is None until then, so e.g. a UI redraw never walks the directory.
+        """
+        lookups = self.hits + self.misses
+        with self._lock:
+            if self._size is None and scan:
+                self._size = self.scan_size()
+            size = self._size
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'size_mb': size / (1024 * 1024) if size is not None else None,
+        }
+
+_caches = {}
+
+def get_result_cache(directory: str = None, max_size_mb: float = 2048) -> ResultCache:
+    """Shared cache instance per directory, so the statistics add up across renders."""
+    directory = os.path.abspath(os.path.expanduser(directory or CACHE_DIR))
+    cache = _caches.get(directory)
+    if cache is None:
+        cache = _caches[directory] = ResultCache(directory, max_size_mb)
+    cache.max_size = max_size_mb * 1024 * 1024
+    return cache
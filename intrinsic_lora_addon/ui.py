@@ -0,0 +1,584 @@
+import bpy
+from contextlib import ExitStack
+
+from bpy_extras.io_utils import ExportHelper
+
+from . import generate_texture
+
+from bpy.props import (PointerProperty)
+
+from bpy.types import (Panel,
+                       PropertyGroup,
+                       )
+
+class ModelSelector(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    model: bpy.props.StringProperty(
+        name="Model",
+        description="The path to the model to use for rendering (sd 1.5)",
+        default="",
+    )
+
+    config: bpy.props.StringProperty(
+        name="Config",
+        description="Config for the model. Required for offline.",
+        default="",
+    )
+
+    preload_libraries: bpy.props.BoolProperty(
+        name="Preload Libraries",
+        description="Import torch and diffusers in the background when the addon is enabled, so the first render starts sooner. Blender may be less responsive for a few seconds",
+        default=False,
+    )
+
+    idle_timeout: bpy.props.IntProperty(
+        name="Idle Timeout (min)",
+        description="Release the loaded model after this many minutes without rendering. 0 keeps it loaded",
+        default=10,
+        min=0,
+    )
+
+    min_free_memory: bpy.props.IntProperty(
+        name="Min Free Memory (MB)",
+        description="Release the loaded model when available system memory drops below this. 0 disables",
+        default=0,
+        min=0,
+    )
+
+    memory_budget: bpy.props.IntProperty(
+        name="Memory Budget (MB)",
+        description="Keep the model's memory use below this: batches are split, attention is sliced, the VAE runs in smaller tiles and with CUDA the models are moved to the CPU between stages as needed. Slower the lower it is. 0 for no limit",
+        default=0,
+        min=0,
+    )
+
+    precision: bpy.props.EnumProperty(
+        name="Precision",
+        description="How the model runs. See the accuracy report from 'python -m intrinsic_lora_addon.cli report' to pick one",
+        items=[
+            ('fp32', "FP32", "Full precision"),
+            ('bf16', "BF16", "bfloat16 autocast. Faster on CPUs and GPUs with bf16 support"),
+            ('int8', "INT8 (CPU)", "Dynamic int8 quantization of the unet's linear layers. Always runs on the CPU"),
+        ],
+        default='fp32',
+    )
+
+    channels_last: bpy.props.BoolProperty(
+        name="Channels Last",
+        description="Use the channels last memory format for the unet and vae, usually faster on CPU",
+        default=False,
+    )
+
+    compile_unet: bpy.props.BoolProperty(
+        name="Compile",
+        description="Compile the unet with torch.compile. The first render takes longer",
+        default=False,
+    )
+
+    fuse_lora: bpy.props.BoolProperty(
+        name="Fuse LoRA",
+        description="Merge each task's LoRA into the model weights. Faster per render; the fused weights are saved next to the LoRAs on first use. Not available with INT8",
+        default=False,
+    )
+
+    tiny_vae: bpy.props.StringProperty(
+        name="Tiny Autoencoder",
+        description="Distilled tiny autoencoder (taesd) weights, a .safetensors file or a diffusers folder. Much faster than the full VAE at a small loss in quality",
+        default="",
+        subtype='FILE_PATH',
+    )
+
+    fast_vae: bpy.props.EnumProperty(
+        name="Use Tiny Autoencoder",
+        description="Which renders encode and decode with the tiny autoencoder. Compare the error with 'python -m intrinsic_lora_addon.cli report --tiny-vae'",
+        items=[
+            ('off', "Off", "Always use the full VAE"),
+            ('preview', "Previews", "Only for the preview pass of Preview First"),
+            ('decode', "Decode", "Decode every render with the tiny autoencoder, encode with the full VAE"),
+            ('both', "Encode and Decode", "Encode and decode every render with the tiny autoencoder"),
+        ],
+        default='preview',
+    )
+
+    use_worker: bpy.props.BoolProperty(
+        name="Use Inference Worker",
+        description="Run the model in a separate process, so Blender stays responsive and the model stays loaded across Blender restarts",
+        default=False,
+    )
+
+    worker_port: bpy.props.IntProperty(
+        name="Worker Port",
+        description="Local port the inference worker listens on",
+        default=53411,
+        min=1024,
+        max=65535,
+    )
+
+    worker_python: bpy.props.StringProperty(
+        name="Worker Python",
+        description="Python executable used to start the inference worker. Empty uses Blender's python",
+        default="",
+        subtype='FILE_PATH',
+    )
+
+    use_result_cache: bpy.props.BoolProperty(
+        name="Cache Results",
+        description="Reuse maps already generated for the same render, task and model instead of running the model again",
+        default=True,
+    )
+
+    cache_dir: bpy.props.StringProperty(
+        name="Cache Folder",
+        description="Folder for cached maps. Can be shared between machines. Empty uses ~/.cache/intrinsic_lora/results",
+        default="",
+        subtype='DIR_PATH',
+    )
+
+    cache_size: bpy.props.IntProperty(
+        name="Cache Size (MB)",
+        description="Least recently used maps are removed when the cache grows above this",
+        default=2048,
+        min=1,
+    )
+
+    torch_profile: bpy.props.BoolProperty(
+        name="Profile Model",
+        description="Run the unet and vae stages under the torch profiler and save a trace per stage. Slows rendering down",
+        default=False,
+    )
+
+    profile_dir: bpy.props.StringProperty(
+        name="Profile Folder",
+        description="Folder for the torch profiler traces. Empty uses ~/.cache/intrinsic_lora/profiles",
+        default="",
+        subtype='DIR_PATH',
+    )
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "model")
+        layout.prop(self, "config")
+        layout.prop(self, "preload_libraries")
+        layout.prop(self, "idle_timeout")
+        layout.prop(self, "min_free_memory")
+        layout.prop(self, "memory_budget")
+        layout.separator()
+        layout.prop(self, "precision")
+        row = layout.row()
+        row.prop(self, "channels_last")
+        row.prop(self, "compile_unet")
+        row = layout.row()
+        row.enabled = self.precision != 'int8'
+        row.prop(self, "fuse_lora")
+        layout.prop(self, "tiny_vae")
+        if self.tiny_vae:
+            layout.prop(self, "fast_vae")
+        layout.separator()
+        layout.prop(self, "use_result_cache")
+        if self.use_result_cache:
+            layout.prop(self, "cache_dir")
+            layout.prop(self, "cache_size")
+            # never scans the cache folder, which may be shared or on a network drive
+            stats = generate_texture.get_cache_stats(scan=False)
+            if stats:
+                used = f", {stats['size_mb']:.0f} MB used" if stats['size_mb'] is not None else ""
+                layout.label(text=f"{stats['hits']} hits, {stats['misses']} misses this session{used}")
+        layout.separator()
+        layout.prop(self, "use_worker")
+        if self.use_worker:
+            layout.prop(self, "worker_port")
+            layout.prop(self, "worker_python")
+        layout.separator()
+        layout.prop(self, "torch_profile")
+        if self.torch_profile:
+            layout.prop(self, "profile_dir")
+
+class IntrinsicLoRAProperties(PropertyGroup):
+
+    normal_map: bpy.props.BoolProperty(
+        name="Normal Map",
+        description="Render normal map",
+        default=False,
+    )
+
+    depth_map: bpy.props.BoolProperty(
+        name="Depth Map",
+        description="Render depth map",
+        default=False,
+    )
+
+    albedo_map: bpy.props.BoolProperty(
+        name="Albedo Map",
+        description="Render albedo map",
+        default=False,
+    )
+
+    shading_map: bpy.props.BoolProperty(
+        name="Shading Map",
+        description="Render shading map",
+        default=False,
+    )
+
+    size: bpy.props.IntProperty(
+        name="Size",
+        description="Size of the rendered image",
+        default=512,
+    )
+
+    tiled: bpy.props.BoolProperty(
+        name="Tiled",
+        description="Run sizes above 512 as overlapping 512 tiles at full resolution instead of upscaling a 512 result",
+        default=False,
+    )
+
+    tile_overlap: bpy.props.IntProperty(
+        name="Tile Overlap",
+        description="Overlap between tiles in pixels",
+        default=128,
+        min=0,
+        max=448,
+        step=8,
+    )
+
+    tile_batch_size: bpy.props.IntProperty(
+        name="Tile Batch Size",
+        description="Number of tiles run through the model at once. Lower uses less memory",
+        default=2,
+        min=1,
+    )
+
+    normal_space: bpy.props.EnumProperty(
+        name="Normal Space",
+        description="Space of the generated normal maps",
+        items=[
+            ('TANGENT', "Tangent", "Tangent space, for the Normal Map node set to Tangent Space"),
+            ('WORLD', "World", "World space, for the Normal Map node set to World Space"),
+        ],
+        default='TANGENT',
+    )
+
+    multi_view: bpy.props.BoolProperty(
+        name="Multi View",
+        description="Render from several cameras around the object and merge the results into its UV map",
+        default=False,
+    )
+
+    view_count: bpy.props.IntProperty(
+        name="Views",
+        description="Number of cameras around the object",
+        default=4,
+        min=2,
+        max=16,
+    )
+
+    view_elevation: bpy.props.FloatProperty(
+        name="Elevation",
+        description="Height of the cameras above the object's center, as an angle",
+        default=0.35,
+        min=-1.5,
+        max=1.5,
+        subtype='ANGLE',
+    )
+
+    all_selected: bpy.props.BoolProperty(
+        name="All Selected",
+        description="Generate for every selected mesh with a UV map. Their renders run through the model as one batch, and each object's maps are baked into its own material",
+        default=False,
+    )
+
+    progressive: bpy.props.BoolProperty(
+        name="Preview First",
+        description="Run a quick low resolution pass first and show it in the material while the full maps are generated in the background",
+        default=False,
+    )
+
+    preview_size: bpy.props.IntProperty(
+        name="Preview Size",
+        description="Resolution the model runs at for the preview",
+        default=256,
+        min=128,
+        max=512,
+        step=64,
+    )
+
+    frame_range: bpy.props.BoolProperty(
+        name="Frame Range",
+        description="Generate maps for every frame of the scene's frame range. They are saved as PNG sequences in the render output folder and added to the material as image sequences",
+        default=False,
+    )
+
+    batch_size: bpy.props.IntProperty(
+        name="Batch Size",
+        description="Images run through the model at once. Frames rendered ahead, or the renders of all selected objects, are batched together",
+        default=4,
+        min=1,
+    )
+
+    save_to_disk: bpy.props.BoolProperty(
+        name="Save to Disk",
+        description="Also save the render and the generated maps as PNG files in the render output folder",
+        default=False,
+    )
+
+    model: bpy.props.StringProperty(
+        name="Model",
+        description="The path to the model to use for rendering (sd 1.5)",
+        default="",
+    )
+
+    show_timings: bpy.props.BoolProperty(
+        name="Timings",
+        description="Show how long each stage of the last render took and how much memory it used",
+        default=False,
+    )
+
+
+class IntrinsicLoRASettings(Panel):
+
+    bl_idname = "RENDER_PT_intrinsic_lora_settings"
+    bl_label = "Intrinsic LoRA Settings"
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = "render"
+
+    def draw(self, context):
+        layout = self.layout
+        scene = context.scene
+        intrinsic_lora_properties = scene.intrinsic_lora_properties
+
+        layout.prop(intrinsic_lora_properties, "normal_map")
+        layout.prop(intrinsic_lora_properties, "depth_map")
+        layout.prop(intrinsic_lora_properties, "albedo_map")
+        layout.prop(intrinsic_lora_properties, "shading_map")
+
+        layout.prop(intrinsic_lora_properties, "size")
+        layout.prop(intrinsic_lora_properties, "tiled")
+        if intrinsic_lora_properties.tiled:
+            layout.prop(intrinsic_lora_properties, "tile_overlap")
+            layout.prop(intrinsic_lora_properties, "tile_batch_size")
+        if intrinsic_lora_properties.normal_map:
+            layout.prop(intrinsic_lora_properties, "normal_space")
+        layout.prop(intrinsic_lora_properties, "multi_view")
+        if intrinsic_lora_properties.multi_view:
+            layout.prop(intrinsic_lora_properties, "view_count")
+            layout.prop(intrinsic_lora_properties, "view_elevation")
+        layout.prop(intrinsic_lora_properties, "frame_range")
+        if not intrinsic_lora_properties.frame_range:
+            layout.prop(intrinsic_lora_properties, "all_selected")
+        if intrinsic_lora_properties.frame_range or intrinsic_lora_properties.all_selected:
+            layout.prop(intrinsic_lora_properties, "batch_size")
+        if not intrinsic_lora_properties.frame_range:
+            layout.prop(intrinsic_lora_properties, "progressive")
+            if intrinsic_lora_properties.progressive:
+                layout.prop(intrinsic_lora_properties, "preview_size")
+        layout.separator()
+        layout.prop(intrinsic_lora_properties, "save_to_disk")
+
+        col = self.layout.column(align=True)
+        if context.preferences.addons[__package__].preferences.use_worker or intrinsic_lora_properties.progressive or intrinsic_lora_properties.frame_range:
+            col.operator(RenderBackground_operator.bl_idname, text="Render")
+        else:
+            col.operator(RenderButton_operator.bl_idname, text="Render")
+        row = col.row(align=True)
+        row.operator(WarmUpButton_operator.bl_idname, text="Warm Up")
+        row.operator(ReleaseButton_operator.bl_idname, text="Release")
+        row.operator(CleanUpButton_operator.bl_idname, text="Clean Up")
+        col.operator_menu_enum(ConvertNormalMapButton_operator.bl_idname, "conversion", text="Convert Normal Map")
+
+        layout.prop(intrinsic_lora_properties, "show_timings")
+        if intrinsic_lora_properties.show_timings:
+            box = layout.box()
+            timings = generate_texture.get_timings()
+            if not timings:
+                box.label(text="Nothing recorded yet")
+            for stage in timings:
+                count = f" x{stage['count']}" if stage['count'] > 1 else ""
+                row = box.row()
+                row.label(text="    " * stage['depth'] + stage['name'] + count)
+                row.label(text=f"{stage['wall'] * 1000:.0f} ms ({stage['cpu'] * 1000:.0f} cpu)")
+                row.label(text=f"{stage['peak_rss'] / 2**20:.0f} MB")
+            peak = generate_texture.get_peak_memory()
+            if peak:
+                gpu = f", {peak['gpu_peak_mb']:.0f} MB GPU" if peak['gpu_peak_mb'] is not None else ""
+                box.label(text=f"Model peak memory: {peak['peak_rss_mb']:.0f} MB{gpu}")
+            box.operator(ExportTrace_operator.bl_idname, text="Export Trace")
+
+class RenderButton_operator(bpy.types.Operator):
+    bl_idname = "intrinsic_lora.render_button"
+    bl_label = "Render"
+
+    def execute(self, context):
+        result = generate_texture.execute()
+        if result:
+            self.report({'ERROR'}, result)
+        return {'FINISHED'}
+    
+class RenderBackground_operator(bpy.types.Operator):
+    bl_idname = "intrinsic_lora.render_background"
+    bl_label = "Render"
+    bl_description = "Render while the model runs in the background, in the inference worker if enabled. Press Esc to cancel"
+
+    _timer = None
+    _render = None
+    _profile = None
+
+    def invoke(self, context, event):
+        frame_range = context.scene.intrinsic_lora_properties.frame_range
+        # a frame range is one object at a time
+        objects, error = generate_texture.get_targets(single=frame_range)
+        if error:
+            self.report({'ERROR'}, error)
+            return {'CANCELLED'}
+        # the trace covers the whole modal run, up to the last bake
+        self._profile = ExitStack()
+        self._profile.enter_context(generate_texture.profile_run())
+        try:
+            if frame_range:
+                self._render = generate_texture.FrameRangeRender(objects[0])
+            else:
+                self._render = generate_texture.BackgroundRender(objects)
+        except (OSError, TimeoutError) as e:
+            self._profile.close()
+            self.report({'ERROR'}, f"Could not reach the inference worker: {e}")
+            return {'CANCELLED'}
+        self._timer = context.window_manager.event_timer_add(0.2, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            # a finished preview stays in the material
+            self._render.cancel()
+            self.finish(context)
+            self.report({'INFO'}, "Intrinsic LoRA render cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        status = self._render.poll()
+        if status == 'running':
+            context.workspace.status_text_set(f"Intrinsic LoRA: {self._render.stage} (Esc to cancel)")
+            return {'PASS_THROUGH'}
+
+        self.finish(context)
+        if status == 'done':
+            peak = generate_texture.get_peak_memory()
+            if peak:
+                gpu = f", {peak['gpu_peak_mb']:.0f} MB GPU" if peak['gpu_peak_mb'] is not None else ""
+                self.report({'INFO'}, f"Intrinsic LoRA render done, peak memory {peak['peak_rss_mb']:.0f} MB{gpu}")
+            return {'FINISHED'}
+        self.report({'ERROR'} if status == 'error' else {'INFO'}, self._render.message or f"Intrinsic LoRA render {status}")
+        return {'CANCELLED'}
+
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        context.workspace.status_text_set(None)
+        self._profile.close()
+
+class WarmUpButton_operator(bpy.types.Operator):
+    bl_idname = "intrinsic_lora.warm_up_button"
+    bl_label = "Warm Up"
+    bl_description = "Load the model now so the next render starts right away"
+
+    def execute(self, context):
+        result = generate_texture.warm_up()
+        if result:
+            self.report({'ERROR'}, result)
+        return {'FINISHED'}
+
+class ReleaseButton_operator(bpy.types.Operator):
+    bl_idname = "intrinsic_lora.release_button"
+    bl_label = "Release"
+    bl_description = "Unload the model and free its memory"
+
+    def execute(self, context):
+        result = generate_texture.release()
+        if result:
+            self.report({'INFO'}, result)
+        return {'FINISHED'}
+
+class CleanUpButton_operator(bpy.types.Operator):
+    bl_idname = "intrinsic_lora.clean_up_button"
+    bl_label = "Clean Up"
+    bl_description = "Remove the generated images no material uses any more and image nodes left without an image"
+
+    def execute(self, context):
+        self.report({'INFO'}, generate_texture.clean_up())
+        return {'FINISHED'}
+
+class ExportTrace_operator(bpy.types.Operator, ExportHelper):
+    bl_idname = "intrinsic_lora.export_trace"
+    bl_label = "Export Trace"
+    bl_description = "Save the timings of the last render as a Chrome trace (chrome://tracing or ui.perfetto.dev)"
+
+    filename_ext = ".json"
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    def execute(self, context):
+        result = generate_texture.export_trace(self.filepath)
+        if result:
+            self.report({'ERROR'}, result)
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+class ConvertNormalMapButton_operator(bpy.types.Operator):
+    bl_idname = "intrinsic_lora.convert_normal_map_button"
+    bl_label = "Convert Normal Map"
+    bl_description = "Convert the normal map in the active image node of the selected object's material to a new image"
+
+    conversion: bpy.props.EnumProperty(
+        name="Conversion",
+        items=[
+            ('WORLD_TO_TANGENT', "World to Tangent", "World space maps, e.g. generated with Normal Space set to World, to tangent space for the Normal Map node"),
+            ('OBJECT_TO_TANGENT', "Object to Tangent", "Object space to tangent space"),
+            ('TANGENT_TO_OBJECT', "Tangent to Object", "Tangent space to object space"),
+            ('TANGENT_TO_WORLD', "Tangent to World", "Tangent space to world space"),
+        ],
+        default='WORLD_TO_TANGENT',
+    )
+
+    def execute(self, context):
+        result = generate_texture.convert_normal_map(self.conversion)
+        if result:
+            self.report({'ERROR'}, result)
+        return {'FINISHED'}
+    
+def check_generators():
+    generate_texture.check_generators()
+    return 30.0
+
+def register():
+    bpy.utils.register_class(ModelSelector)
+    prefs = bpy.context.preferences.addons[__package__].preferences
+
+    bpy.utils.register_class(RenderButton_operator)
+    bpy.utils.register_class(RenderBackground_operator)
+    bpy.utils.register_class(WarmUpButton_operator)
+    bpy.utils.register_class(ReleaseButton_operator)
+    bpy.utils.register_class(CleanUpButton_operator)
+    bpy.utils.register_class(ExportTrace_operator)
+    bpy.utils.register_class(ConvertNormalMapButton_operator)
+    bpy.utils.register_class(IntrinsicLoRAProperties)
+    bpy.types.Scene.intrinsic_lora_properties = PointerProperty(type=IntrinsicLoRAProperties)
+    bpy.utils.register_class(IntrinsicLoRASettings)
+    bpy.app.timers.register(check_generators, first_interval=30.0, persistent=True)
+    if prefs.preload_libraries:
+        generate_texture.prewarm()
+
+def unregister():
+    if bpy.app.timers.is_registered(check_generators):
+        bpy.app.timers.unregister(check_generators)
+    # the inference worker keeps its model across addon reloads
+    generate_texture.release(include_worker=False)
+    bpy.utils.unregister_class(RenderButton_operator)
+    bpy.utils.unregister_class(RenderBackground_operator)
+    bpy.utils.unregister_class(WarmUpButton_operator)
+    bpy.utils.unregister_class(ReleaseButton_operator)
+    bpy.utils.unregister_class(CleanUpButton_operator)
+    bpy.utils.unregister_class(ExportTrace_operator)
+    bpy.utils.unregister_class(ConvertNormalMapButton_operator)
+    bpy.utils.unregister_class(ModelSelector)
+
+    bpy.utils.unregister_class(IntrinsicLoRAProperties)
+    bpy.utils.unregister_class(IntrinsicLoRASettings)
@@ -0,0 +1,283 @@
+"""
+Vectorized projection of camera images into a mesh's UV layout.
+
+Everything here works on plain numpy arrays, so it runs outside of Blender and
+in worker threads. Image arrays are top row first. Pixel coordinates are x right,
+y down, with pixel centers at +0.5.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+def rasterize(triangles: np.ndarray, width: int, height: int, chunk_size: int = 1 << 22):
+    """Find the pixel centers covered by each triangle.
+
+    triangles is (T, 3, 2) in pixel coordinates. Yields (triangle index, x, y, barycentric)
+    arrays in triangle order, at most about chunk_size pixels at a time.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64)
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    denominator = (b[:, 1] - c[:, 1]) * (a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (a[:, 1] - c[:, 1])
+    degenerate = np.abs(denominator) < 1e-12
+    denominator = np.where(degenerate, 1., denominator)
+
+    # barycentrics as affine functions of the pixel center: w = gx * x + gy * y + k
+    gx = np.stack([(b[:, 1] - c[:, 1]), (c[:, 1] - a[:, 1])], axis=1) / denominator[:, None]
+    gy = np.stack([(c[:, 0] - b[:, 0]), (a[:, 0] - c[:, 0])], axis=1) / denominator[:, None]
+    k = -(gx * c[:, None, 0] + gy * c[:, None, 1])
+    gx = np.concatenate([gx, -gx.sum(1, keepdims=True)], axis=1)
+    gy = np.concatenate([gy, -gy.sum(1, keepdims=True)], axis=1)
+    k = np.concatenate([k, 1. - k.sum(1, keepdims=True)], axis=1)
+
+    x0 = np.clip(np.ceil(triangles[..., 0].min(1) - 0.5), 0, width).astype(np.int64)
+    x1 = np.clip(np.floor(triangles[..., 0].max(1) - 0.5), -1, width - 1).astype(np.int64)
+    y0 = np.clip(np.ceil(triangles[..., 1].min(1) - 0.5), 0, height).astype(np.int64)
+    y1 = np.clip(np.floor(triangles[..., 1].max(1) - 0.5), -1, height - 1).astype(np.int64)
+    rows = np.maximum(y1 - y0 + 1, 0)
+    rows[degenerate | (x1 < x0)] = 0
+
+    # the span of every row of every triangle, from where each barycentric crosses zero.
+    # Only covered pixels are generated, there is no per pixel inside test
+    row_tri = np.repeat(np.arange(len(triangles)), rows)
+    row_y = y0[row_tri] + np.arange(rows.sum()) - np.repeat(np.cumsum(rows) - rows, rows)
+    row_gx = gx[row_tri]
+    # barycentrics along the row are row_gx * x + offset
+    offset = gy[row_tri] * (row_y + 0.5)[:, None] + k[row_tri]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = (-1e-6 - offset) / row_gx
+    low = np.where(row_gx > 0, crossing, -np.inf).max(1)
+    high = np.where(row_gx < 0, crossing, np.inf).min(1)
+    # rows parallel to an edge are either all inside or all outside of it
+    outside = ((row_gx == 0) & (offset < -1e-6)).any(1)
+    span_x0 = np.maximum(np.ceil(np.maximum(low, -1.) - 0.5).astype(np.int64), x0[row_tri])
+    span_x1 = np.minimum(np.floor(np.minimum(high, width + 1.) - 0.5).astype(np.int64), x1[row_tri])
+    counts = np.where(outside, 0, np.maximum(span_x1 - span_x0 + 1, 0))
+
+    valid = np.nonzero(counts)[0]
+    cumulative = np.cumsum(counts[valid])
+    start = 0
+    while start < len(valid):
+        done = cumulative[start - 1] if start else 0
+        end = max(int(np.searchsorted(cumulative, done + chunk_size, side='right')), start + 1)
+        ids = valid[start:end]
+        start = end
+
+        # per pixel values are repeated per span values, cheaper than gathering them
+        span_counts = counts[ids]
+        px = np.repeat(span_x0[ids] - (np.cumsum(span_counts) - span_counts), span_counts) + np.arange(span_counts.sum())
+        center = px + 0.5
+        barycentric = np.empty((len(px), 3))
+        barycentric[:, 0] = np.repeat(row_gx[ids, 0], span_counts) * center + np.repeat(offset[ids, 0], span_counts)
+        barycentric[:, 1] = np.repeat(row_gx[ids, 1], span_counts) * center + np.repeat(offset[ids, 1], span_counts)
+        barycentric[:, 2] = 1. - barycentric[:, 0] - barycentric[:, 1]
+        yield np.repeat(row_tri[ids], span_counts), px, np.repeat(row_y[ids], span_counts), barycentric
+
+def uv_to_pixels(uv_triangles: np.ndarray, width: int, height: int) -> np.ndarray:
+    pixels = np.empty(uv_triangles.shape, dtype=np.float64)
+    pixels[..., 0] = uv_triangles[..., 0] * width
+    pixels[..., 1] = (1. - uv_triangles[..., 1]) * height
+    return pixels
+
+def uv_texels(uv_triangles: np.ndarray, width: int, height: int):
+    """Texels of a width x height texture covered by the UV triangles (T, 3, 2).
+
+    Returns (triangle index, flat texel index, barycentric), in no particular order.
+    Texels on shared edges go to the first triangle.
+    """
+    parts = list(rasterize(uv_to_pixels(uv_triangles, width, height), width, height))
+    if not parts:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros((0, 3))
+    tri = np.concatenate([part[0] for part in parts])
+    texel = np.concatenate([part[2] * width + part[1] for part in parts])
+    barycentric = np.concatenate([part[3] for part in parts])
+    # written in reverse, so the first triangle's fragment is written last and wins
+    first = np.empty(width * height, dtype=np.int64)
+    first[texel[::-1]] = np.arange(len(texel) - 1, -1, -1)
+    keep = first[texel] == np.arange(len(texel))
+    if keep.all():
+        return tri, texel, barycentric
+    return tri[keep], texel[keep], barycentric.compress(keep, axis=0)
+
+def interpolate(values: np.ndarray, tri: np.ndarray, barycentric: np.ndarray) -> np.ndarray:
+    """Interpolate per corner values (T, 3, C) at the given triangles and barycentrics."""
+    return np.einsum('nk,nkc->nc', barycentric, values[tri])
+
+def project(points: np.ndarray, view: dict):
+    """Project world space points (N, 3). Returns normalized device xy (N, 2) and view depth (N,)."""
+    homogeneous = np.concatenate([points, np.ones((len(points), 1))], axis=1)
+    view_space = homogeneous @ view['view_matrix'].T
+    clip = view_space @ view['projection_matrix'].T
+    w = clip[:, 3:]
+    ndc = clip[:, :2] / np.where(np.abs(w) < 1e-12, 1e-12, w)
+    return ndc, -view_space[:, 2]
+
+def to_pixels(ndc: np.ndarray, width: int, height: int) -> np.ndarray:
+    return np.stack([(ndc[..., 0] * 0.5 + 0.5) * width, (0.5 - ndc[..., 1] * 0.5) * height], axis=-1)
+
+def depth_buffer(triangles: np.ndarray, view: dict, width: int, height: int, near: float = 1e-4) -> np.ndarray:
+    """Rasterize world space triangles (T, 3, 3) into a (height, width) buffer of nearest view depth."""
+    ndc, depth = project(triangles.reshape(-1, 3), view)
+    pixels = to_pixels(ndc, width, height).reshape(-1, 3, 2)
+    depth = depth.reshape(-1, 3)
+    in_front = (depth > near).all(axis=1)
+    pixels = pixels[in_front]
+    depth = depth[in_front]
+
+    buffer = np.full(width * height, np.inf)
+    for tri, px, py, barycentric in rasterize(pixels, width, height):
+        if view['perspective']:
+            # depth is only linear in screen space as 1 / depth
+            pixel_depth = 1. / np.einsum('nk,nk->n', barycentric, 1. / depth[tri])
+        else:
+            pixel_depth = np.einsum('nk,nk->n', barycentric, depth[tri])
+        flat = py * width + px
+        # the nearest fragment is written last and wins
+        order = np.argsort(-pixel_depth)
+        chunk = np.full(width * height, np.inf)
+        chunk[flat[order]] = pixel_depth[order]
+        np.minimum(buffer, chunk, out=buffer)
+    return buffer.reshape(height, width)
+
+def sample_bilinear(image: np.ndarray, pixels: np.ndarray) -> np.ndarray:
+    """Sample an HxW or HxWxC image at pixel coordinates (N, 2)."""
+    height, width = image.shape[:2]
+    x = np.clip(pixels[:, 0] - 0.5, 0, width - 1)
+    y = np.clip(pixels[:, 1] - 0.5, 0, height - 1)
+    x0 = np.minimum(np.floor(x).astype(np.int64), width - 2) if width > 1 else np.zeros(len(x), np.int64)
+    y0 = np.minimum(np.floor(y).astype(np.int64), height - 2) if height > 1 else np.zeros(len(y), np.int64)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (x - x0)
+    fy = (y - y0)
+    if image.ndim == 3:
+        fx = fx[:, None]
+        fy = fy[:, None]
+    top = image[y0, x0] * (1 - fx) + image[y0, x1] * fx
+    bottom = image[y1, x0] * (1 - fx) + image[y1, x1] * fx
+    return (top * (1 - fy) + bottom * fy).astype(np.float32)
+
+def view_weights(positions: np.ndarray, normals: np.ndarray, triangles: np.ndarray, view: dict, resolution: int = 512, facing_power: float = 2.0, depth_bias: float = 0.01):
+    """Weight of one view for every texel, from visibility and facing angle.
+
+    Returns (weights, ndc) with ndc the texels' normalized device coordinates in the view.
+    """
+    ndc, depth = project(positions, view)
+    buffer = depth_buffer(triangles, view, resolution, resolution)
+    pixels = to_pixels(ndc, resolution, resolution)
+    inside = (np.abs(ndc) <= 1.).all(axis=1) & (depth > 0)
+    ix = np.clip(pixels[:, 0].astype(np.int64), 0, resolution - 1)
+    iy = np.clip(pixels[:, 1].astype(np.int64), 0, resolution - 1)
+    visible = inside & (depth <= buffer[iy, ix] * (1. + depth_bias) + 1e-4)
+
+    if view['perspective']:
+        direction = view['camera_location'][None, :] - positions
+    else:
+        direction = np.broadcast_to(view['view_matrix'][2, :3], positions.shape)
+    direction = direction / np.maximum(np.linalg.norm(direction, axis=1, keepdims=True), 1e-12)
+    facing = np.clip(np.einsum('nc,nc->n', normals, direction), 0., 1.)
+    return np.where(visible, facing ** facing_power, 0.), ndc
+
+def camera_to_world_normals(normal_map: np.ndarray, view: dict) -> np.ndarray:
+    """Rotate a camera space normal map (encoded as n * 0.5 + 0.5) to world space."""
+    normals = normal_map[..., :3] * 2. - 1.
+    # rows of the view rotation are the camera axes in world space
+    world = normals @ view['view_matrix'][:3, :3]
+    world /= np.maximum(np.linalg.norm(world, axis=-1, keepdims=True), 1e-12)
+    return (world * 0.5 + 0.5).astype(np.float32)
+
+def tangent_frames(corners: np.ndarray, tri: np.ndarray, barycentric: np.ndarray) -> np.ndarray:
+    """Orthonormal tangent frames (N, 3, 3), rows tangent, bitangent and normal.
+
+    corners is (T, 3, 7) per corner normal, tangent and bitangent sign, as
+    Blender's calc_tangents gives them.
+    """
+    values = interpolate(corners, tri, barycentric)
+    normal = np.ascontiguousarray(values[:, 0:3])
+    normal /= np.maximum(np.sqrt(np.einsum('nc,nc->n', normal, normal)), 1e-12)[:, None]
+    tangent = np.ascontiguousarray(values[:, 3:6])
+    tangent -= normal * np.einsum('nc,nc->n', tangent, normal)[:, None]
+    tangent /= np.maximum(np.sqrt(np.einsum('nc,nc->n', tangent, tangent)), 1e-12)[:, None]
+    frames = np.empty((len(values), 3, 3), dtype=values.dtype)
+    frames[:, 0] = tangent
+    frames[:, 1] = np.cross(normal, tangent) * np.where(values[:, 6:7] < 0, -1., 1.).astype(values.dtype)
+    frames[:, 2] = normal
+    return frames
+
+def convert_normal_map(normal_map: np.ndarray, uv_triangles: np.ndarray, normals: np.ndarray, tangents: np.ndarray, bitangent_signs: np.ndarray, to_tangent: bool = True, max_workers: int = None, chunk_size: int = 1 << 16) -> np.ndarray:
+    """Convert a normal map (encoded as n * 0.5 + 0.5) between object and tangent space.
+
+    uv_triangles is (T, 3, 2), normals and tangents (T, 3, 3) and bitangent_signs
+    (T, 3) per corner. Each texel gets the tangent frame interpolated at its UV
+    position. The frames are orthonormal, so going back is a transpose rather
+    than an inverse. Texels outside the UV islands keep their value.
+
+    Runs in float32, in small chunks that stay in cache, with the triangles
+    split over a thread pool.
+    """
+    height, width = normal_map.shape[:2]
+    source = normal_map[..., :3].reshape(-1, 3)
+    result = source.astype(np.float32)
+    pixels = uv_to_pixels(uv_triangles, width, height)
+    corners = np.concatenate([normals, tangents, bitangent_signs[..., None]], axis=2).astype(np.float32)
+
+    def convert_triangles(start, end):
+        # texels on edges shared between groups are written twice, the frames agree there
+        for tri, px, py, barycentric in rasterize(pixels[start:end], width, height, chunk_size):
+            texel = py * width + px
+            frames = tangent_frames(corners[start:end], tri, barycentric.astype(np.float32))
+            values = source[texel].astype(np.float32) * 2. - 1.
+            if to_tangent:
+                converted = np.einsum('nkc,nc->nk', frames, values)
+            else:
+                converted = np.einsum('nkc,nk->nc', frames, values)
+            converted /= np.maximum(np.sqrt(np.einsum('nc,nc->n', converted, converted)), 1e-12)[:, None]
+            result[texel] = converted * 0.5 + 0.5
+
+    bounds = np.linspace(0, len(pixels), min(len(pixels), 16) + 1).astype(np.int64)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(convert_triangles, bounds[:-1], bounds[1:]))
+    return result.reshape(height, width, 3)
+
+def merge_views(triangles: np.ndarray, uv_triangles: np.ndarray, normals: np.ndarray, views: list, view_maps: list, size: int, max_workers: int = None) -> dict:
+    """Project the maps of several views into one UV texture per map.
+
+    triangles (T, 3, 3) and normals (T, 3) are in world space, uv_triangles is (T, 3, 2).
+    view_maps holds a dict of name -> image array for each view. Each texel is the
+    average of the views that see it, weighted by how directly they face it. Returns
+    a dict of name -> (size, size, C) array plus 'coverage' with the summed weights.
+    """
+    tri, texel, barycentric = uv_texels(uv_triangles, size, size)
+    positions = interpolate(triangles, tri, barycentric)
+    texel_normals = normals[tri]
+
+    def project_view(view, maps):
+        weights, ndc = view_weights(positions, texel_normals, triangles, view)
+        seen = weights > 0
+        samples = {}
+        for name, image in maps.items():
+            height, width = image.shape[:2]
+            samples[name] = sample_bilinear(image, to_pixels(ndc[seen], width, height))
+        return seen, weights[seen], samples
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        projections = list(executor.map(project_view, views, view_maps))
+
+    total = np.zeros(len(texel))
+    sums = {}
+    for seen, weights, samples in projections:
+        total[seen] += weights
+        for name, values in samples.items():
+            if name not in sums:
+                sums[name] = np.zeros((len(texel),) + values.shape[1:])
+            sums[name][seen] += values * (weights if values.ndim == 1 else weights[:, None])
+
+    covered = total > 0
+    merged = {}
+    for name, values in sums.items():
+        texture = np.zeros((size * size,) + values.shape[1:], dtype=np.float32)
+        weight = total[covered] if values.ndim == 1 else total[covered][:, None]
+        texture[texel[covered]] = values[covered] / weight
+        merged[name] = texture.reshape((size, size) + values.shape[1:])
+    coverage = np.zeros(size * size, dtype=np.float32)
+    coverage[texel] = total
+    merged['coverage'] = coverage.reshape(size, size)
+    return merged